@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сжатия: два прохода (CRF 23, затем CRF 28) против одного профиля кодирования.
+Кэш результатов отключен
+
+Запуск из корня репозитория:
+    python bench/bench_compression.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Кэш результатов отключается до импорта config: иначе повторный запуск
+# замеряет попадание в кэш, а не кодирование
+os.environ["RESULT_CACHE_MAX_BYTES"] = "0"
+
+from bench.fixtures import make_fixture
+from video_processor import VideoProcessor
+
+
+def run_two_pass(input_path: Path, work_dir: Path) -> Path:
+    """Воспроизводит старый конвейер: кодирование CRF 23 и повторное сжатие CRF 28"""
+    first = work_dir / "legacy_first.mp4"
+    second = work_dir / "legacy_compressed.mp4"
+    for src, dst, crf in ((input_path, first, '23'), (first, second, '28')):
+        subprocess.run([
+            'ffmpeg', '-y', '-v', 'error', '-i', str(src),
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', crf,
+            '-c:a', 'copy', str(dst)
+        ], check=True)
+    first.unlink()
+    return second
+
+
+async def run_single_profile(input_path: Path, work_dir: Path) -> Path:
+    """Новый конвейер: одно кодирование с профилем сжатия"""
+    processor = VideoProcessor()
+    result_files = await processor.process_video(
+        input_path=input_path,
+        output_dir=work_dir,
+        copies=1,
+        compression=True,
+        add_frames=False
+    )
+    return result_files[0]
+
+
+def main():
+    input_path = make_fixture()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        
+        started = time.perf_counter()
+        legacy = run_two_pass(input_path, work_dir)
+        legacy_time = time.perf_counter() - started
+        legacy_size = os.path.getsize(legacy)
+        
+        started = time.perf_counter()
+        single = asyncio.run(run_single_profile(input_path, work_dir))
+        single_time = time.perf_counter() - started
+        single_size = os.path.getsize(single)
+    
+    print()
+    print(f"Фикстура: {input_path.name} ({os.path.getsize(input_path)} байт)")
+    print(f"{'Режим':<24}{'Время, с':>10}{'Размер, байт':>16}")
+    print(f"{'два прохода (было)':<24}{legacy_time:>10.2f}{legacy_size:>16}")
+    print(f"{'один профиль (стало)':<24}{single_time:>10.2f}{single_size:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк VideoProcessor.process_video по матрице копии × сжатие × рамки
+
+Для каждого случая: время, процессорное время (Python и FFmpeg), пиковый RSS,
+размер выхода и качество первой копии относительно входа (SSIM и PSNR).
+Каждый случай запускается в отдельном процессе: getrusage считает только его
+FFmpeg, а оценка скорости кодирования и кэш ffprobe не переходят между случаями.
+Кэш результатов отключен. Рамки и сжатие меняют кадр, поэтому SSIM/PSNR у них
+ниже - сравнивать имеет смысл один и тот же случай между коммитами.
+
+Запуск из корня репозитория:
+    python bench/bench_matrix.py [--quick] [--output bench/results/<коммит>.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fixtures import make_fixture
+from bench.report import default_report_path, save_section
+
+# Клипы: (ширина, высота, длительность, fps)
+FIXTURE_SPECS = [
+    (640, 360, 5, 30),
+    (1280, 720, 10, 30),
+    (1920, 1080, 10, 30),
+]
+COPIES = (1, 2, 3)
+# ru_maxrss в Linux - килобайты, в macOS - байты
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def run_case(case: dict, result_file: Path):
+    """Выполняет один случай в текущем процессе и пишет замеры в result_file"""
+    from video_processor import VideoProcessor
+
+    input_path = Path(case["input"])
+    output_dir = Path(case["output_dir"])
+    processor = VideoProcessor()
+
+    wall_started = time.perf_counter()
+    result_files = asyncio.run(processor.process_video(
+        input_path=input_path,
+        output_dir=output_dir,
+        copies=case["copies"],
+        compression=case["compression"],
+        add_frames=case["add_frames"],
+        session_id="bench"
+    ))
+    wall = time.perf_counter() - wall_started
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, 3),
+        "peak_rss_bytes": max(own.ru_maxrss, children.ru_maxrss) * RSS_UNIT,
+        "output_bytes": sum(path.stat().st_size for path in result_files),
+        "outputs": [str(path) for path in result_files],
+    }
+    result_file.write_text(json.dumps(result), encoding="utf-8")
+
+
+def measure_quality(distorted: Path, reference: Path) -> dict:
+    """
+    SSIM и PSNR выхода относительно входа. Выход приводится к размеру входа
+    (сжатие уменьшает разрешение), поэтому метрика учитывает и масштабирование.
+    """
+    graph = (
+        "[0:v][1:v]scale2ref=flags=bicubic[dist][ref];"
+        "[dist]split[dist1][dist2];[ref]split[ref1][ref2];"
+        "[dist1][ref1]ssim;[dist2][ref2]psnr"
+    )
+    cmd = [
+        'ffmpeg', '-hide_banner', '-nostats', '-i', str(distorted), '-i', str(reference),
+        '-lavfi', graph, '-f', 'null', '-'
+    ]
+    stderr = subprocess.run(cmd, capture_output=True, text=True).stderr
+    ssim = re.search(r"SSIM .*All:([\d.]+)", stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", stderr)
+    return {
+        "ssim": float(ssim.group(1)) if ssim else None,
+        "psnr": float(psnr.group(1)) if psnr else None,
+    }
+
+
+def bench_case(input_path: Path, copies: int, compression: bool, add_frames: bool, work_dir: Path) -> Optional[dict]:
+    """Запускает случай в дочернем процессе и добавляет оценку качества"""
+    output_dir = work_dir / f"{input_path.stem}_{copies}_{int(compression)}_{int(add_frames)}"
+    output_dir.mkdir()
+    result_file = output_dir / "result.json"
+    case = {
+        "input": str(input_path),
+        "output_dir": str(output_dir),
+        "copies": copies,
+        "compression": compression,
+        "add_frames": add_frames,
+    }
+    env = {**os.environ, "RESULT_CACHE_MAX_BYTES": "0", "PYTHONUNBUFFERED": "1"}
+    completed = subprocess.run(
+        [sys.executable, __file__, "--case", json.dumps(case), "--result-file", str(result_file)],
+        env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0 or not result_file.exists():
+        print(f"❌ Случай {case} завершился с ошибкой:\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+        return None
+
+    result = json.loads(result_file.read_text(encoding="utf-8"))
+    outputs = [Path(path) for path in result.pop("outputs")]
+    quality = measure_quality(outputs[0], input_path) if outputs else {"ssim": None, "psnr": None}
+    for output in outputs:
+        output.unlink(missing_ok=True)
+    return {
+        "fixture": input_path.stem,
+        "copies": copies,
+        "compression": compression,
+        "add_frames": add_frames,
+        **result,
+        **quality,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк process_video по матрице параметров")
+    parser.add_argument("--quick", action="store_true", help="Только первая фикстура")
+    parser.add_argument("--output", type=Path, default=None, help="Файл отчета (по умолчанию bench/results/<коммит>.json)")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(json.loads(args.case), args.result_file)
+        return
+
+    specs = FIXTURE_SPECS[:1] if args.quick else FIXTURE_SPECS
+    rows = []
+    print(f"{'Фикстура':<30}{'Копии':>6}{'Сжатие':>8}{'Рамки':>7}{'Время, с':>10}{'CPU, с':>9}"
+          f"{'RSS, МБ':>9}{'Размер, байт':>14}{'SSIM':>8}{'PSNR':>7}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for width, height, duration, fps in specs:
+            input_path = make_fixture(width, height, duration, fps)
+            for copies, compression, add_frames in itertools.product(COPIES, (False, True), (False, True)):
+                row = bench_case(input_path, copies, compression, add_frames, Path(tmp))
+                if row is None:
+                    continue
+                rows.append(row)
+                ssim = f"{row['ssim']:.4f}" if row["ssim"] is not None else "-"
+                psnr = f"{row['psnr']:.1f}" if row["psnr"] is not None else "-"
+                print(f"{row['fixture']:<30}{copies:>6}{'да' if compression else 'нет':>8}"
+                      f"{'да' if add_frames else 'нет':>7}{row['wall_seconds']:>10.2f}{row['cpu_seconds']:>9.2f}"
+                      f"{row['peak_rss_bytes'] / 1024 / 1024:>9.1f}{row['output_bytes']:>14}{ssim:>8}{psnr:>7}")
+
+    save_section(args.output or default_report_path(), "process", rows, {
+        "fixtures": [f"{w}x{h}_{d}s_{f}fps" for w, h, d, f in specs],
+        "copies": list(COPIES),
+    })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк профилей кодирования: скорость (кадров/с) и размер выхода на фикстурах
+
+Кэш результатов не используется - FFmpeg запускается напрямую с аргументами профиля.
+
+Запуск из корня репозитория:
+    python bench/bench_profiles.py
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fixtures import make_fixture
+from encoder_profiles import ENCODER_PROFILES
+from media_probe import probe_media
+
+# Клипы: (ширина, высота, длительность, fps)
+FIXTURE_SPECS = [
+    (1280, 720, 10, 30),
+    (1920, 1080, 10, 60),
+]
+
+
+def encode(input_path: Path, output_path: Path, profile) -> float:
+    """Кодирует вход профилем и возвращает время в секундах"""
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-i', str(input_path)]
+    filters = profile.video_filters()
+    if filters:
+        cmd += ['-vf', ','.join(filters)]
+    cmd += [*profile.codec_args(), '-c:a', 'copy', str(output_path)]
+
+    started = time.perf_counter()
+    subprocess.run(cmd, check=True)
+    return time.perf_counter() - started
+
+
+def main():
+    print(f"{'Фикстура':<34}{'Профиль':<10}{'Время, с':>10}{'Кадр/с':>10}{'Размер, байт':>16}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for width, height, duration, fps in FIXTURE_SPECS:
+            input_path = make_fixture(width, height, duration, fps)
+            media_info = probe_media(input_path)
+            frames = media_info.duration * media_info.fps
+
+            for name, base_profile in ENCODER_PROFILES.items():
+                profile = base_profile.for_input(media_info)
+                output_path = Path(tmp) / f"{input_path.stem}_{name}.mp4"
+                elapsed = encode(input_path, output_path, profile)
+                print(f"{input_path.stem:<34}{name:<10}{elapsed:>10.2f}"
+                      f"{frames / elapsed:>10.1f}{os.path.getsize(output_path):>16}")
+                output_path.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк POST /upload в одном процессе (httpx + ASGITransport, без сети)
+
+Измеряет пропускную способность и задержки приема видео при 1, 4 и 16 одновременных
+клиентах: чтение запроса, запись в хранилище исходников, ffprobe и постановку задачи.
+Кодирование не запускается - задачи остаются в очереди временной базы.
+Все клиенты загружают одну фикстуру, поэтому хранилище исходников дедуплицирует
+файл: замеряется чтение, хэширование и запись во временный файл.
+
+Запуск из корня репозитория:
+    python bench/bench_upload.py [--requests-per-client 4] [--output bench/results/<коммит>.json]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fixtures import make_fixture
+from bench.report import default_report_path, percentile, save_section
+
+CONCURRENCY = (1, 4, 16)
+
+
+async def run_level(app, video: bytes, filename: str, clients: int, requests_per_client: int) -> dict:
+    """Запускает clients клиентов, каждый отправляет requests_per_client загрузок подряд"""
+    import httpx
+
+    latencies = []
+    errors = 0
+
+    async def client_loop(client: httpx.AsyncClient, client_num: int):
+        nonlocal errors
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            response = await client.post(
+                "/upload",
+                files={"file": (filename, video, "video/mp4")},
+                data={"user_id": f"bench-{client_num}", "copies": "1"}
+            )
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, i) for i in range(clients)))
+        wall = time.perf_counter() - started
+
+    total = clients * requests_per_client
+    return {
+        "clients": clients,
+        "requests": total,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(total / wall, 2),
+        "throughput_mb_s": round(total * len(video) / wall / 1024 / 1024, 2),
+        "p50_seconds": round(percentile(latencies, 50), 4),
+        "p95_seconds": round(percentile(latencies, 95), 4),
+        "max_seconds": round(max(latencies), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк /upload")
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--output", type=Path, default=None, help="Файл отчета (по умолчанию bench/results/<коммит>.json)")
+    args = parser.parse_args()
+
+    fixture = make_fixture(1280, 720, 10, 30)
+    video = fixture.read_bytes()
+    report_path = (args.output or default_report_path()).resolve()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Приложение создает каталоги и базу относительно рабочего каталога -
+        # бенчмарк не должен трогать данные настоящего запуска
+        os.chdir(tmp)
+        os.environ["JOB_STORE_PATH"] = str(Path(tmp) / "bench.db")
+        os.environ["INPUT_STORE_DIR"] = str(Path(tmp) / "input_store")
+        os.environ["TRACE_DIR"] = str(Path(tmp) / "traces")
+        os.environ["EMBEDDED_WORKER"] = "false"
+        from main import app, job_store
+
+        rows = []
+        print(f"{'Клиенты':>8}{'Запросы':>9}{'Ошибки':>8}{'Запр/с':>9}{'МБ/с':>8}{'p50, с':>9}{'p95, с':>9}")
+        for clients in CONCURRENCY:
+            row = asyncio.run(run_level(app, video, fixture.name, clients, args.requests_per_client))
+            rows.append(row)
+            print(f"{row['clients']:>8}{row['requests']:>9}{row['errors']:>8}{row['throughput_rps']:>9.2f}"
+                  f"{row['throughput_mb_s']:>8.1f}{row['p50_seconds']:>9.3f}{row['p95_seconds']:>9.3f}")
+        job_store.flush()
+
+    save_section(report_path, "upload", rows, {
+        "fixture": fixture.name,
+        "fixture_bytes": len(video),
+        "requests_per_client": args.requests_per_client,
+    })
+
+
+if __name__ == "__main__":
+    main()
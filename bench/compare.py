@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Сравнение двух отчетов бенчмарков (bench_matrix.py, bench_upload.py)
+
+Выводит изменение каждой метрики и завершается с кодом 1, если есть регрессия
+больше порога. Отчеты сняты на разных машинах сравнивать бессмысленно -
+в этом случае выводится предупреждение.
+
+Запуск из корня репозитория:
+    python bench/compare.py bench/results/<было>.json bench/results/<стало>.json [--threshold 0.1]
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# Метрики раздела: имя -> True, если больше - лучше
+PROCESS_METRICS = {
+    "wall_seconds": False,
+    "cpu_seconds": False,
+    "peak_rss_bytes": False,
+    "output_bytes": False,
+    "ssim": True,
+    "psnr": True,
+}
+UPLOAD_METRICS = {
+    "throughput_rps": True,
+    "p50_seconds": False,
+    "p95_seconds": False,
+}
+# Качество сравнивается по абсолютной разнице, а не в процентах
+QUALITY_TOLERANCE = {"ssim": 0.005, "psnr": 0.5}
+
+SECTIONS = {
+    "process": (("fixture", "copies", "compression", "add_frames"), PROCESS_METRICS),
+    "upload": (("clients",), UPLOAD_METRICS),
+}
+
+
+def _format(value) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.4g}"
+
+
+def is_regression(metric: str, before: float, after: float, higher_is_better: bool, threshold: float) -> bool:
+    if metric in QUALITY_TOLERANCE:
+        return before - after > QUALITY_TOLERANCE[metric]
+    if before == 0:
+        return False
+    change = (after - before) / before
+    return change < -threshold if higher_is_better else change > threshold
+
+
+def compare_section(name: str, before: dict, after: dict, threshold: float) -> int:
+    """Печатает сравнение раздела, возвращает число регрессий"""
+    key_fields, metrics = SECTIONS[name]
+    before_rows = {tuple(row[field] for field in key_fields): row for row in before["rows"]}
+    regressions = 0
+
+    print(f"\n== {name} ==")
+    for row in after["rows"]:
+        key = tuple(row[field] for field in key_fields)
+        old = before_rows.get(key)
+        label = " ".join(f"{field}={value}" for field, value in zip(key_fields, key))
+        if old is None:
+            print(f"{label}: нет в базовом отчете")
+            continue
+        parts = []
+        for metric, higher_is_better in metrics.items():
+            if old.get(metric) is None or row.get(metric) is None:
+                continue
+            mark = ""
+            if is_regression(metric, old[metric], row[metric], higher_is_better, threshold):
+                mark = " ❌"
+                regressions += 1
+            if old[metric]:
+                change = f"{(row[metric] - old[metric]) / old[metric] * 100:+.1f}%"
+            else:
+                change = _format(row[metric])
+            parts.append(f"{metric} {_format(old[metric])} -> {_format(row[metric])} ({change}){mark}")
+        print(f"{label}:\n    " + "\n    ".join(parts))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение отчетов бенчмарков")
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.1, help="Допустимое ухудшение (0.1 - 10%%)")
+    args = parser.parse_args()
+
+    reports = []
+    for path in (args.before, args.after):
+        with open(path, "r", encoding="utf-8") as f:
+            reports.append(json.load(f))
+    before, after = reports
+
+    print(f"Было:  {before.get('commit')}{' (изменен)' if before.get('dirty') else ''}")
+    print(f"Стало: {after.get('commit')}{' (изменен)' if after.get('dirty') else ''}")
+    if before.get("host") != after.get("host"):
+        print("⚠️ Отчеты сняты на разных машинах или версиях FFmpeg")
+
+    regressions = 0
+    for name in SECTIONS:
+        if name in before and name in after:
+            regressions += compare_section(name, before[name], after[name], args.threshold)
+
+    print(f"\nРегрессий: {regressions}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Генерация детерминированных тестовых клипов для бенчмарков
+"""
+
+import subprocess
+from pathlib import Path
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def make_fixture(width: int = 1280, height: int = 720, duration: int = 10, fps: int = 30) -> Path:
+    """Создает клип testsrc + sine (H.264/AAC) и возвращает путь к нему"""
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    path = FIXTURES_DIR / f"testsrc_{width}x{height}_{duration}s_{fps}fps.mp4"
+    if path.exists():
+        return path
+    
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=size={width}x{height}:rate={fps}:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'medium', '-crf', '18', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-shortest',
+        str(path)
+    ]
+    print(f"🎞️ Генерируем фикстуру: {path.name}")
+    subprocess.run(cmd, check=True)
+    return path
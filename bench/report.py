@@ -0,0 +1,81 @@
+"""
+JSON-отчет бенчмарков: один файл на коммит, разделы дописываются отдельными скриптами
+
+Отчеты разных коммитов сравнивает bench/compare.py.
+"""
+
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from pathlib import Path
+from typing import List, Optional
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def git_commit() -> dict:
+    """Текущий коммит и наличие незакоммиченных изменений"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": bool(status.strip())}
+
+
+def host_info() -> dict:
+    """Машина, на которой сняты цифры: без нее отчеты разных хостов не сравнить"""
+    try:
+        ffmpeg_version = subprocess.run(
+            ['ffmpeg', '-version'], capture_output=True, text=True
+        ).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        ffmpeg_version = None
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg_version,
+    }
+
+
+def default_report_path() -> Path:
+    commit = git_commit()["commit"]
+    return RESULTS_DIR / f"{commit[:12] if commit else 'local'}.json"
+
+
+def save_section(path: Path, section: str, rows: List[dict], settings: Optional[dict] = None):
+    """Записывает раздел отчета, сохраняя остальные разделы файла"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    report = {}
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+    report.update(git_commit())
+    report["host"] = host_info()
+    report[section] = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "settings": settings or {},
+        "rows": rows,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📝 Отчет записан: {path}")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0-100) методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
@@ -25,3 +25,53 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")  # ID чата для уведомлений
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "52428800"))  # 50MB в байтах
+
+# Ограничения FFmpeg (0 - определить автоматически по числу ядер)
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", "0"))
+FFMPEG_THREADS_PER_JOB = int(os.getenv("FFMPEG_THREADS_PER_JOB", "0"))
+
+# Сколько секунд хранить обработанные файлы (скачивание можно повторять и перематывать)
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", "3600"))
+
+# Кэш результатов обработки (0 - кэш отключен)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))  # 2GB
+
+# Хранилище сессий и задач (SQLite), общее для веб-приложения и бота
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "videobot.db")
+JOB_STORE_TTL_SECONDS = int(os.getenv("JOB_STORE_TTL_SECONDS", "86400"))  # сутки
+
+# Профиль кодирования по умолчанию для задач без сжатия: fast, balanced или small
+ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "fast")
+
+# Максимальный размер видео, которое Bot API принимает от бота (sendVideo)
+TELEGRAM_MAX_UPLOAD_SIZE = int(os.getenv("TELEGRAM_MAX_UPLOAD_SIZE", "52428800"))  # 50MB
+
+# Длинные ролики режутся на сегменты, которые кодируются параллельно (секунды, 0 - отключено)
+SEGMENT_PARALLEL_MIN_DURATION = int(os.getenv("SEGMENT_PARALLEL_MIN_DURATION", "300"))
+
+# Хранилище исходных видео по содержимому, общее для веб-приложения и бота
+INPUT_STORE_DIR = os.getenv("INPUT_STORE_DIR", "input_store")
+INPUT_STORE_MAX_BYTES = int(os.getenv("INPUT_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))  # 2GB
+
+# Обработчики задач: процессы worker.py забирают задачи веб-приложения из очереди в SQLite
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "0"))  # 0 - по одному на каждые четыре ядра
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "2"))  # процессы uvicorn
+# Обрабатывать очередь в процессе веб-приложения (запуск одним `uvicorn main:app` без worker.py)
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "False").lower() == "true"
+
+# Порты /metrics для процессов без FastAPI (0 - не запускать): бот и обработчики (порт + номер обработчика)
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Трассировка этапов задач (JSON-строки, GET /jobs/{id}/trace), хранится JOB_STORE_TTL_SECONDS
+TRACE_DIR = os.getenv("TRACE_DIR", "traces")
+
+# Профилирование запросов веб-приложения по заголовку X-Profile (cprofile или yappi)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Проверка готовых копий: кроме ffprobe сравнивать фрагмент копии с исходником по SSIM
+# (рамка обрезается до сравнения, поэтому порог касается только самого кадра)
+VERIFY_OUTPUT_SSIM = os.getenv("VERIFY_OUTPUT_SSIM", "False").lower() == "true"
+VERIFY_MIN_SSIM = float(os.getenv("VERIFY_MIN_SSIM", "0.8"))
@@ -0,0 +1,142 @@
+"""
+Профили кодирования x264: именованные пресеты скорости и размера
+"""
+
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+from config import ENCODER_PROFILE
+from media_probe import MediaInfo
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """Параметры кодирования, которые определяются один раз до запуска FFmpeg"""
+    name: str = 'custom'
+    crf: int = 23
+    preset: str = 'veryfast'
+    tune: Optional[str] = None  # film, animation, grain...
+    maxrate: Optional[str] = None  # Например '2M', ограничивает пиковый битрейт
+    max_height: Optional[int] = None  # Уменьшение разрешения, если видео выше
+    max_fps: Optional[int] = None  # Ограничение частоты кадров, если видео чаще
+    bitrate: Optional[int] = None  # Средний битрейт видео (бит/с) вместо CRF - режим целевого размера
+
+    def video_filters(self) -> List[str]:
+        """Фильтры, которые профиль добавляет перед рамкой"""
+        filters = []
+        if self.max_height:
+            # -2 сохраняет пропорции и четную ширину для libx264
+            filters.append(f"scale=-2:'min(ih,{self.max_height})'")
+        if self.max_fps:
+            filters.append(f"fps={self.max_fps}")
+        return filters
+
+    def codec_args(self, threads: Optional[int] = None) -> List[str]:
+        """Аргументы видеокодера для FFmpeg"""
+        args = ['-c:v', 'libx264', '-preset', self.preset]
+        if self.bitrate:
+            args += ['-b:v', str(self.bitrate)]
+        else:
+            args += ['-crf', str(self.crf)]
+        if self.tune:
+            args += ['-tune', self.tune]
+        if threads:
+            args += ['-threads', str(threads)]
+        if self.maxrate:
+            args += ['-maxrate', self.maxrate, '-bufsize', self.maxrate]
+        return args
+
+    def for_input(self, media_info: Optional[MediaInfo]) -> "EncodingProfile":
+        """
+        Убирает ограничения, которые входу не нужны: scale для видео ниже
+        max_height и fps для видео реже max_fps только зря нагружают граф фильтров
+        """
+        if media_info is None:
+            return self
+        changes = {}
+        if self.max_height and media_info.height <= self.max_height:
+            changes['max_height'] = None
+        if self.max_fps and 0 < media_info.fps <= self.max_fps + 0.01:
+            changes['max_fps'] = None
+        return replace(self, **changes) if changes else self
+
+
+# fast - уникализация копий без заметной потери качества за минимальное время;
+# balanced - тот же CRF, но пресет medium дает файл заметно меньше;
+# small - сжатие для отправки: выше CRF, до 720p и 30 кадров/с
+ENCODER_PROFILES: Dict[str, EncodingProfile] = {
+    'fast': EncodingProfile(name='fast', preset='veryfast', crf=23),
+    'balanced': EncodingProfile(name='balanced', preset='medium', crf=23),
+    'small': EncodingProfile(name='small', preset='medium', crf=28, tune='film', max_height=720, max_fps=30),
+}
+
+
+def get_profile(name: str) -> EncodingProfile:
+    """Профиль по имени"""
+    try:
+        return ENCODER_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестный профиль кодирования: {name} (доступны: {', '.join(ENCODER_PROFILES)})")
+
+
+def select_profile(
+    media_info: Optional[MediaInfo],
+    compression: bool = False,
+    profile_name: Optional[str] = None
+) -> EncodingProfile:
+    """
+    Выбирает профиль для задачи: явно запрошенный, иначе small для сжатия
+    и профиль по умолчанию (ENCODER_PROFILE) для остальных задач.
+    Затем профиль подстраивается под параметры входа.
+    """
+    if profile_name is None:
+        profile_name = 'small' if compression else ENCODER_PROFILE
+    return get_profile(profile_name).for_input(media_info)
+
+
+# Режим целевого размера: доля бюджета на видео и аудио (остальное - контейнер MP4)
+TARGET_SIZE_HEADROOM = 0.95
+# Битрейт аудио, если ffprobe его не сообщил
+DEFAULT_AUDIO_BITRATE = 128_000
+# Ниже этого битрейта видео становится непригодным к просмотру
+MIN_VIDEO_BITRATE = 150_000
+# При низком битрейте уменьшаем разрешение: (битрейт меньше, максимальная высота)
+BITRATE_HEIGHT_LIMITS = [
+    (600_000, 480),
+    (1_500_000, 720),
+]
+
+
+def target_size_profile(
+    profile: EncodingProfile,
+    media_info: MediaInfo,
+    target_bytes: int
+) -> EncodingProfile:
+    """
+    Профиль со средним битрейтом, при котором выход укладывается в target_bytes:
+    бюджет target_bytes * 8 / длительность за вычетом битрейта аудио (оно копируется)
+
+    Raises:
+        ValueError: Видео слишком длинное для такого размера
+    """
+    audio_bitrate = (media_info.audio_bit_rate or DEFAULT_AUDIO_BITRATE) if media_info.has_audio else 0
+    total_bitrate = target_bytes * 8 * TARGET_SIZE_HEADROOM / media_info.duration
+    video_bitrate = int(total_bitrate - audio_bitrate)
+    if video_bitrate < MIN_VIDEO_BITRATE:
+        raise ValueError(
+            f"Видео длительностью {media_info.duration:.0f} с не уместить в "
+            f"{target_bytes // (1024 * 1024)}MB с приемлемым качеством"
+        )
+
+    max_height = profile.max_height
+    for bitrate_limit, height in BITRATE_HEIGHT_LIMITS:
+        if video_bitrate < bitrate_limit:
+            max_height = min(max_height or height, height)
+            break
+
+    return replace(
+        profile,
+        name=f"{profile.name}-target",
+        bitrate=video_bitrate,
+        max_height=max_height,
+    ).for_input(media_info)
@@ -0,0 +1,150 @@
+"""
+Запуск FFmpeg через asyncio: прогресс и stderr читаются по мере вывода, без потоков
+"""
+
+import asyncio
+import os
+import signal
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+# Сколько последних строк stderr хранить для сообщений об ошибках
+STDERR_TAIL_LINES = 200
+
+# Максимальная длина строки вывода FFmpeg
+STREAM_LIMIT = 1024 * 1024
+
+# Ключи из вывода `ffmpeg -progress`, которые передаются наружу
+PROGRESS_KEYS = ('frame', 'fps', 'out_time', 'out_time_us', 'speed', 'total_size')
+
+ProgressCallback = Callable[[dict], None]
+
+
+class FFmpegTimeout(Exception):
+    """FFmpeg не завершился за отведенное время и был остановлен"""
+
+    def __init__(self, cmd: List[str], timeout: float, stderr: str):
+        super().__init__(f"FFmpeg не завершился за {timeout:.0f} с")
+        self.cmd = cmd
+        self.timeout = timeout
+        self.stderr = stderr
+
+
+@dataclass
+class FFmpegResult:
+    """Итог запуска FFmpeg: код возврата, хвост stderr и последняя скорость"""
+    cmd: List[str]
+    returncode: int
+    stderr: str
+    speed: float = 0.0
+
+
+def parse_progress_block(raw: dict) -> dict:
+    """Преобразует блок key=value из `-progress pipe:1` в типизированный словарь"""
+    progress = {}
+    if raw.get('frame', '').isdigit():
+        progress['frame'] = int(raw['frame'])
+    try:
+        progress['fps'] = float(raw.get('fps', ''))
+    except ValueError:
+        pass
+    if raw.get('out_time') and raw['out_time'] != 'N/A':
+        progress['out_time'] = raw['out_time']
+    if raw.get('out_time_us', '').isdigit():
+        progress['out_time_seconds'] = int(raw['out_time_us']) / 1_000_000
+    speed = raw.get('speed', '').rstrip('x').strip()
+    try:
+        progress['speed'] = float(speed)
+    except ValueError:
+        pass
+    if raw.get('total_size', '').isdigit():
+        progress['total_size'] = int(raw['total_size'])
+    return progress
+
+
+def kill_process_group(process: asyncio.subprocess.Process):
+    """Убивает FFmpeg вместе с его группой процессов"""
+    if process.returncode is not None:
+        return
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        print(f"🛑 Процесс FFmpeg {process.pid} остановлен")
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run_ffmpeg(
+    cmd: List[str],
+    timeout: float,
+    progress_callback: Optional[ProgressCallback] = None,
+    env: Optional[dict] = None
+) -> FFmpegResult:
+    """
+    Запускает FFmpeg и читает `-progress pipe:1` и stderr по мере вывода.
+    stderr хранится кольцевым буфером из STDERR_TAIL_LINES строк.
+    Процесс запускается в своей группе: при отмене корутины или таймауте
+    группа убивается целиком.
+
+    Raises:
+        FFmpegTimeout: Процесс не уложился в timeout
+        asyncio.CancelledError: Корутина отменена (процесс уже убит)
+    """
+    cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env,
+        limit=STREAM_LIMIT,
+        start_new_session=True
+    )
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    last_speed = 0.0
+
+    async def read_progress():
+        nonlocal last_speed
+        raw = {}
+        async for line in process.stdout:
+            key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+            if key in PROGRESS_KEYS:
+                raw[key] = value
+            elif key == 'progress':
+                # Блок прогресса заканчивается строкой progress=continue|end
+                progress = parse_progress_block(raw)
+                last_speed = progress.get('speed', last_speed)
+                if progress_callback is not None:
+                    try:
+                        progress_callback(progress)
+                    except Exception as callback_error:
+                        print(f"⚠️ Ошибка обработчика прогресса: {callback_error}")
+                raw = {}
+
+    async def read_stderr():
+        async for line in process.stderr:
+            stderr_tail.append(line.decode('utf-8', 'replace').rstrip())
+
+    readers = [asyncio.ensure_future(read_progress()), asyncio.ensure_future(read_stderr())]
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+        # Дочитываем остаток вывода после завершения процесса
+        await asyncio.gather(*readers)
+    except asyncio.TimeoutError:
+        kill_process_group(process)
+        await process.wait()
+        raise FFmpegTimeout(cmd, timeout, '\n'.join(stderr_tail))
+    except BaseException:
+        # Отмена задачи (или ошибка чтения): FFmpeg не должен пережить корутину
+        kill_process_group(process)
+        await asyncio.shield(process.wait())
+        raise
+    finally:
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+    return FFmpegResult(cmd, process.returncode, '\n'.join(stderr_tail), last_speed)
@@ -0,0 +1,135 @@
+"""
+Хранилище исходных видео по содержимому (SHA-256), общее для веб-приложения и бота
+"""
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+import aiofiles
+
+from config import INPUT_STORE_DIR, INPUT_STORE_MAX_BYTES
+
+# Недавно использованные файлы не вытесняются: их может обрабатывать задача
+EVICT_MIN_AGE_SECONDS = 3600
+
+TMP_DIR_NAME = ".tmp"
+
+
+class InputTooLargeError(Exception):
+    """Файл больше допустимого размера; запись прервана"""
+
+    def __init__(self, max_size: int):
+        super().__init__(f"Размер файла не должен превышать {max_size // (1024 * 1024)}MB")
+        self.max_size = max_size
+
+
+class InputStore:
+    """
+    Исходные видео в файлах <hash[:2]>/<hash><расширение>.
+
+    Файл пишется во временный, хэш считается по ходу записи, затем файл
+    публикуется атомарным rename. Одинаковые загрузки хранятся один раз.
+    При переполнении вытесняются давно не использованные файлы (LRU по mtime).
+    """
+
+    def __init__(self, store_dir: Path, max_bytes: int):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.tmp_dir = store_dir / TMP_DIR_NAME
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def find(self, content_hash: str) -> Optional[Path]:
+        """Файл с таким содержимым, если он есть; отмечает использование для LRU"""
+        for path in (self.store_dir / content_hash[:2]).glob(f"{content_hash}*"):
+            try:
+                os.utime(path)
+            except OSError:
+                continue
+            return path
+        return None
+
+    async def save_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        suffix: str = ".mp4",
+        max_size: Optional[int] = None
+    ) -> Tuple[str, Path, int]:
+        """
+        Записывает поток в хранилище, считая SHA-256 по ходу записи.
+        Возвращает (хэш, путь, размер). Если такой файл уже есть,
+        новая копия не сохраняется.
+
+        Raises:
+            InputTooLargeError: Поток длиннее max_size (частичный файл удален)
+        """
+        tmp_path = self.tmp_dir / f"{uuid.uuid4().hex}{suffix}"
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    written += len(chunk)
+                    if max_size is not None and written > max_size:
+                        raise InputTooLargeError(max_size)
+                    digest.update(chunk)
+                    await f.write(chunk)
+
+            content_hash = digest.hexdigest()
+            existing = self.find(content_hash)
+            if existing is not None:
+                print(f"♻️ Исходное видео {content_hash[:12]} уже в хранилище")
+                return content_hash, existing, written
+
+            path = self.store_dir / content_hash[:2] / f"{content_hash}{suffix}"
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        print(f"💾 Исходное видео сохранено: {path} ({written} байт)")
+        self.evict()
+        return content_hash, path, written
+
+    def _entries(self):
+        """Список (mtime, размер, путь) сохраненных файлов"""
+        entries = []
+        for shard in self.store_dir.iterdir():
+            if not shard.is_dir() or shard.name == TMP_DIR_NAME:
+                continue
+            for path in shard.iterdir():
+                try:
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self):
+        """Удаляет давно не использованные файлы, пока хранилище больше max_bytes"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            deadline = time.time() - EVICT_MIN_AGE_SECONDS
+            for mtime, size, path in entries:
+                if total <= self.max_bytes or mtime > deadline:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                print(f"🧹 Исходное видео вытеснено из хранилища: {path.name}")
+
+
+_input_store: Optional[InputStore] = None
+
+
+def get_input_store() -> InputStore:
+    """Общее для процесса хранилище исходных видео"""
+    global _input_store
+    if _input_store is None:
+        _input_store = InputStore(Path(INPUT_STORE_DIR), INPUT_STORE_MAX_BYTES)
+    return _input_store
@@ -0,0 +1,461 @@
+"""
+Хранилище сессий и задач на SQLite (WAL), общее для веб-приложения и бота
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import JOB_STORE_PATH, JOB_STORE_TTL_SECONDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    user_id TEXT,
+    source TEXT NOT NULL DEFAULT 'web',
+    status TEXT NOT NULL,
+    params TEXT NOT NULL DEFAULT '{}',
+    progress TEXT NOT NULL DEFAULT '{}',
+    files TEXT NOT NULL DEFAULT '[]',
+    copy_results TEXT NOT NULL DEFAULT '[]',
+    message TEXT,
+    error TEXT,
+    input_path TEXT,
+    output_dir TEXT,
+    worker_id TEXT,
+    heartbeat_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs(session_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs(expires_at);
+
+CREATE TABLE IF NOT EXISTS telegram_files (
+    content_hash TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    file_unique_id TEXT,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_telegram_files_unique ON telegram_files(file_unique_id);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Колонки задач, которых нет в базах, созданных раньше (очередь обработчиков, итоги копий)
+QUEUE_COLUMNS = {
+    "input_path": "TEXT",
+    "output_dir": "TEXT",
+    "worker_id": "TEXT",
+    "heartbeat_at": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+    "copy_results": "TEXT NOT NULL DEFAULT '[]'",
+}
+
+# Поля задачи, которые хранятся как JSON
+JSON_FIELDS = ("params", "progress", "files", "copy_results")
+
+ACTIVE_JOB_STATUSES = ("queued", "processing")
+FINISHED_JOB_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobStore:
+    """
+    Сессии и задачи обработки в SQLite.
+
+    Каждый поток работает со своим соединением; WAL позволяет читать во время
+    записи и безопасно работать нескольким процессам (веб и бот) с одним файлом.
+    Частые обновления прогресса копятся в памяти и пишутся пачкой.
+    """
+
+    def __init__(self, db_path: Path, ttl_seconds: int):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+        # Отложенные обновления прогресса: job_id -> (progress, updated_at)
+        self._pending_progress: Dict[str, tuple] = {}
+        self._pending_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Добавляет новые колонки в таблицу задач старой базы"""
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in QUEUE_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    # Сессии
+
+    def link_session(self, session_id: str, user_id: str):
+        """Привязывает пользователя к сессии"""
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sessions (session_id, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (session_id, user_id, now, now + self.ttl_seconds)
+        )
+
+    def get_session_user(self, session_id: str) -> Optional[str]:
+        """Пользователь сессии, если она не истекла"""
+        row = self._connect().execute(
+            "SELECT user_id FROM sessions WHERE session_id = ? AND expires_at >= ?",
+            (session_id, time.time())
+        ).fetchone()
+        return row["user_id"] if row else None
+
+    def get_user_sessions(self, user_id: str) -> List[str]:
+        """Действующие сессии пользователя, новые первыми"""
+        rows = self._connect().execute(
+            "SELECT session_id FROM sessions WHERE user_id = ? AND expires_at >= ? ORDER BY created_at DESC",
+            (user_id, time.time())
+        ).fetchall()
+        return [row["session_id"] for row in rows]
+
+    # Задачи
+
+    def create_job(self, job_id: str, session_id: str, user_id: Optional[str],
+                   params: dict, source: str = "web", message: str = None,
+                   input_path: Optional[Path] = None, output_dir: Optional[Path] = None) -> dict:
+        """
+        Создает задачу в статусе queued. Задачи веб-приложения с input_path
+        и output_dir забирают обработчики (claim_job)
+        """
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (job_id, session_id, user_id, source, status, params, message, "
+            "input_path, output_dir, created_at, updated_at, expires_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, session_id, user_id, source, json.dumps(params), message,
+             str(input_path) if input_path else None, str(output_dir) if output_dir else None,
+             now, now, now + self.ttl_seconds)
+        )
+        return self.get_job(job_id)
+
+    def update_job(self, job_id: str, **fields):
+        """Сразу записывает изменения задачи (статус, файлы, ошибку)"""
+        with self._pending_lock:
+            pending = self._pending_progress.pop(job_id, None)
+        if pending is not None and "progress" not in fields:
+            fields["progress"] = pending[0]
+
+        now = time.time()
+        fields["updated_at"] = now
+        fields["expires_at"] = now + self.ttl_seconds
+        for key in JSON_FIELDS:
+            if key in fields:
+                fields[key] = json.dumps(fields[key], ensure_ascii=False)
+
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        self._connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE job_id = ?",
+            (*fields.values(), job_id)
+        )
+
+    def update_progress(self, job_id: str, progress: dict):
+        """
+        Запоминает прогресс задачи без записи в базу. Можно вызывать из
+        потоков FFmpeg; в базу попадает при flush() пачкой.
+        """
+        with self._pending_lock:
+            self._pending_progress[job_id] = (progress, time.time())
+
+    def flush(self):
+        """Пишет накопленный прогресс одной транзакцией"""
+        with self._pending_lock:
+            pending = self._pending_progress
+            self._pending_progress = {}
+        if not pending:
+            return
+
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE job_id = ?",
+                [(json.dumps(progress, ensure_ascii=False), updated_at, job_id)
+                 for job_id, (progress, updated_at) in pending.items()]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def start_background_flush(self, interval: float = 1.0):
+        """Фоновый поток, который раз в interval секунд пишет прогресс"""
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"❌ Ошибка записи прогресса задач: {e}")
+
+        self._flusher = threading.Thread(target=run, name="job-store-flush", daemon=True)
+        self._flusher.start()
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """Задача с учетом еще не записанного прогресса"""
+        row = self._connect().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        for key in JSON_FIELDS:
+            job[key] = json.loads(job[key])
+        with self._pending_lock:
+            pending = self._pending_progress.get(job_id)
+        if pending is not None:
+            job["progress"], job["updated_at"] = pending
+        return job
+
+    def get_user_jobs(self, user_id: str, limit: int = 20) -> List[dict]:
+        """Последние задачи пользователя"""
+        rows = self._connect().execute(
+            "SELECT job_id FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        return [job for job in (self.get_job(row["job_id"]) for row in rows) if job]
+
+    def is_job_active(self, job_id: str) -> bool:
+        row = self._connect().execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None and row["status"] in ACTIVE_JOB_STATUSES
+
+    def purge_expired(self) -> int:
+        """Удаляет истекшие сессии и завершенные задачи, возвращает число удаленных строк"""
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            sessions = conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,)).rowcount
+            jobs = conn.execute(
+                f"DELETE FROM jobs WHERE expires_at < ? AND status IN ({','.join('?' * len(FINISHED_JOB_STATUSES))})",
+                (now, *FINISHED_JOB_STATUSES)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return sessions + jobs
+
+    # Очередь задач для обработчиков
+
+    def claim_job(self, worker_id: str, source: str = "web") -> Optional[dict]:
+        """
+        Забирает самую старую задачу из очереди. BEGIN IMMEDIATE берет блокировку
+        записи сразу, поэтому одну задачу не заберут два обработчика.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT job_id FROM jobs WHERE status = 'queued' AND source = ? AND cancel_requested = 0 "
+                "ORDER BY created_at LIMIT 1",
+                (source,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'processing', message = 'Обрабатываем видео...', worker_id = ?, "
+                    "heartbeat_at = ?, attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+                    (worker_id, now, now, row["job_id"])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get_job(row["job_id"]) if row is not None else None
+
+    def heartbeat(self, job_id: str):
+        """Отмечает, что обработчик задачи жив"""
+        self._connect().execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def release_job(self, job_id: str):
+        """Возвращает задачу в очередь (обработчик останавливается)"""
+        self.update_job(job_id, status="queued", message="Видео в очереди на обработку", worker_id=None)
+
+    def requeue_stale(self, timeout: float, max_attempts: int) -> int:
+        """
+        Возвращает в очередь задачи, обработчик которых не отмечался дольше timeout
+        (процесс упал). Задача, уронившая обработчик max_attempts раз, считается
+        неудачной. Возвращает число затронутых задач.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            stale = "status = 'processing' AND worker_id IS NOT NULL AND heartbeat_at < ?"
+            failed = conn.execute(
+                f"UPDATE jobs SET status = 'failed', message = 'Ошибка обработки видео', "
+                f"error = 'Обработчик задачи завершился аварийно', worker_id = NULL, updated_at = ? "
+                f"WHERE {stale} AND attempts >= ?",
+                (now, now - timeout, max_attempts)
+            ).rowcount
+            requeued = conn.execute(
+                f"UPDATE jobs SET status = 'queued', message = 'Видео в очереди на обработку', "
+                f"worker_id = NULL, updated_at = ? WHERE {stale}",
+                (now, now - timeout)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return failed + requeued
+
+    def request_cancel(self, job_id: str):
+        """
+        Отмена задачи из любого процесса: задача в очереди отменяется сразу,
+        задачу в работе останавливает ее обработчик, увидев флаг
+        """
+        now = time.time()
+        conn = self._connect()
+        cancelled = conn.execute(
+            "UPDATE jobs SET status = 'cancelled', message = 'Обработка отменена', updated_at = ? "
+            "WHERE job_id = ? AND status = 'queued'",
+            (now, job_id)
+        ).rowcount
+        if not cancelled:
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE job_id = ? AND status = 'processing'",
+                (now, job_id)
+            )
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None and bool(row["cancel_requested"])
+
+    def count_jobs(self) -> Dict[str, int]:
+        """Число задач по статусам"""
+        rows = self._connect().execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["count"] for row in rows}
+
+    # Счетчики, общие для всех процессов (веб, обработчики, бот)
+
+    def increment_counter(self, name: str, amount: int = 1):
+        """Увеличивает счетчик name на amount"""
+        self._connect().execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def get_counters(self, *names: str) -> Dict[str, int]:
+        """Значения счетчиков names (0 для еще не увеличенных)"""
+        placeholders = ", ".join("?" for _ in names)
+        rows = self._connect().execute(
+            f"SELECT name, value FROM counters WHERE name IN ({placeholders})", names
+        ).fetchall()
+        counters = dict.fromkeys(names, 0)
+        counters.update((row["name"], row["value"]) for row in rows)
+        return counters
+
+    # Загруженные в Telegram файлы
+
+    def get_telegram_file_id(self, content_hash: str) -> Optional[str]:
+        """file_id ранее загруженного файла с таким содержимым"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT file_id FROM telegram_files WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE telegram_files SET last_used_at = ? WHERE content_hash = ?",
+            (time.time(), content_hash)
+        )
+        return row["file_id"]
+
+    def save_telegram_file(self, content_hash: str, file_id: str, file_unique_id: Optional[str] = None):
+        """Запоминает file_id файла, загруженного в Telegram или скачанного из него"""
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO telegram_files (content_hash, file_id, file_unique_id, created_at, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (content_hash, file_id, file_unique_id, now, now)
+        )
+
+    def get_content_hash(self, file_unique_id: str) -> Optional[str]:
+        """Хэш содержимого файла Telegram, если он уже скачивался или загружался"""
+        row = self._connect().execute(
+            "SELECT content_hash FROM telegram_files WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+        return row["content_hash"] if row else None
+
+    def forget_telegram_file(self, content_hash: str):
+        """Удаляет file_id, который Telegram перестал принимать"""
+        self._connect().execute("DELETE FROM telegram_files WHERE content_hash = ?", (content_hash,))
+
+    def import_legacy_sessions(self, path: Path):
+        """Однократный перенос связей из старого user_sessions.json"""
+        if not path.exists():
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                sessions = json.load(f)
+            now = time.time()
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO sessions (session_id, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                [(session_id, str(user_id), now, now + self.ttl_seconds) for session_id, user_id in sessions.items()]
+            )
+            conn.execute("COMMIT")
+            path.rename(path.with_suffix(".json.migrated"))
+            print(f"📦 Перенесено {len(sessions)} сессий из {path}")
+        except Exception as e:
+            # Иначе соединение потока останется в открытой транзакции
+            conn = self._connect()
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"❌ Ошибка переноса сессий из {path}: {e}")
+
+
+_job_store: Optional[JobStore] = None
+
+
+def get_job_store() -> JobStore:
+    """Общее для процесса хранилище задач"""
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore(Path(JOB_STORE_PATH), JOB_STORE_TTL_SECONDS)
+    return _job_store
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Optional
@@ -8,39 +8,42 @@ import uuid
 import shutil
 from pathlib import Path
 import asyncio
-from video_processor import VideoProcessor
-import httpx
+from video_processor import get_encode_scheduler
+from result_cache import get_result_cache
+from media_probe import FFPROBE_AVAILABLE, MediaProbeError, probe_media_async
+from encoder_profiles import ENCODER_PROFILES
+from job_store import FINISHED_JOB_STATUSES, get_job_store
+from input_store import InputTooLargeError, get_input_store
+from config import EMBEDDED_WORKER, JOB_STORE_TTL_SECONDS, MAX_FILE_SIZE, PROFILING_ENABLED, RESULT_TTL_SECONDS
+from telegram_api import close_http_client
+from metrics import CONTENT_TYPE, JOBS, UPLOAD_BYTES, render_metrics
+from tracing import job_trace, purge_traces, read_trace, span
+from profiling import RequestProfiler
+import aiofiles
 import json
+import re
 import threading
+import time
+from urllib.parse import quote
 
 
 app = FastAPI(title="VideoBot App", description="Приложение для обработки видео")
 
-# Создаем директории для загрузок и результатов
-UPLOAD_DIR = Path("uploads")
+# Создаем директорию для результатов (исходники хранит input_store)
 RESULT_DIR = Path("results")
-TEMP_DIR = Path("temp_downloads")
-UPLOAD_DIR.mkdir(exist_ok=True)
 RESULT_DIR.mkdir(exist_ok=True)
-TEMP_DIR.mkdir(exist_ok=True)
 
-# Очищаем старые временные файлы при запуске
-def cleanup_temp_files():
-    """Очищает старые временные файлы"""
-    temp_dirs = [TEMP_DIR, Path("temp_processing")]
-    
-    for temp_dir in temp_dirs:
-        try:
-            if temp_dir.exists():
-                for temp_file in temp_dir.iterdir():
-                    if temp_file.is_file():
-                        temp_file.unlink()
-                        print(f"Удален старый временный файл: {temp_file}")
-        except Exception as e:
-            print(f"Ошибка при очистке временных файлов из {temp_dir}: {e}")
+# Размер части при потоковой записи загрузки на диск
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-# Очищаем временные файлы при запуске
-cleanup_temp_files()
+# Запас на поля формы и заголовки multipart сверх MAX_FILE_SIZE
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+# Размер части при отдаче диапазона файла (Range)
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Как часто проверять устаревшие результаты
+REAPER_INTERVAL_SECONDS = 60
 
 # Функция для запуска Telegram бота в отдельном потоке (отключена для Railway)
 def start_telegram_bot():
@@ -60,150 +63,114 @@ def start_telegram_bot():
 # Бот запускается как отдельный сервис на Railway
 print("ℹ️ Telegram бот запускается как отдельный сервис")
 
-# Система привязки пользователей к сессиям
-USER_SESSIONS_FILE = Path("user_sessions.json")
-
-def load_user_sessions():
-    """Загружает связи пользователей с сессиями"""
-    if USER_SESSIONS_FILE.exists():
-        try:
-            with open(USER_SESSIONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Ошибка загрузки сессий пользователей: {e}")
-    return {}
+# Сессии и задачи хранятся в SQLite, общем для веб-приложения и бота
+job_store = get_job_store()
+job_store.import_legacy_sessions(Path("user_sessions.json"))
+job_store.start_background_flush()
 
-def save_user_sessions(sessions):
-    """Сохраняет связи пользователей с сессиями"""
-    try:
-        with open(USER_SESSIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(sessions, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Ошибка сохранения сессий пользователей: {e}")
+# Исходные видео хранятся по содержимому, общий каталог с ботом
+input_store = get_input_store()
 
 def link_user_to_session(user_id: str, session_id: str):
     """Привязывает пользователя к сессии"""
-    sessions = load_user_sessions()
-    sessions[session_id] = user_id
-    save_user_sessions(sessions)
+    job_store.link_session(session_id, user_id)
     print(f"🔗 Пользователь {user_id} привязан к сессии {session_id}")
 
 def get_user_for_session(session_id: str) -> str:
     """Получает пользователя для сессии"""
-    sessions = load_user_sessions()
-    return sessions.get(session_id, None)
+    return job_store.get_session_user(session_id)
 
-# Функция для отправки уведомлений в Telegram
-async def send_telegram_notification(message: str, chat_id: str = None):
-    """Отправляет уведомление в Telegram"""
-    try:
-        from config import TELEGRAM_BOT_TOKEN
-        
-        if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-            print("⚠️ Telegram токен не настроен, уведомления отключены")
-            return
-        
-        # Если chat_id не указан, используем дефолтный (можно настроить в .env)
-        if not chat_id:
-            chat_id = os.getenv("TELEGRAM_CHAT_ID")
-            if not chat_id:
-                print("⚠️ TELEGRAM_CHAT_ID не настроен, уведомления отключены")
-                return
-        
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {
-            "chat_id": chat_id,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=data, timeout=10)
-            if response.status_code == 200:
-                print(f"✅ Уведомление отправлено в Telegram: {chat_id}")
-            else:
-                print(f"❌ Ошибка отправки в Telegram: {response.status_code}")
-                
-    except Exception as e:
-        print(f"❌ Ошибка при отправке уведомления в Telegram: {e}")
-
-# Функция для отправки видео файлов в Telegram
-async def send_video_files_to_telegram(result_files, session_id, copies, add_frames, compression):
-    """Отправляет видео файлы напрямую в Telegram"""
-    try:
-        telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
-        
-        if not telegram_token or telegram_token == "YOUR_BOT_TOKEN_HERE":
-            print("⚠️ Telegram токен не настроен, файлы не отправляются")
+# Задачи обработки: /upload только ставит задачу в очередь (job_store), кодируют ее
+# процессы worker.py; клиент следит за задачей через /jobs/{id}
+PRIVATE_JOB_FIELDS = (
+    "user_id", "expires_at", "input_path", "output_dir",
+    "worker_id", "heartbeat_at", "attempts", "cancel_requested",
+)
+
+def public_job(job: dict) -> dict:
+    """Поля задачи, которые отдаются клиенту"""
+    return {key: value for key, value in job.items() if key not in PRIVATE_JOB_FIELDS}
+
+class UploadSizeLimit:
+    """
+    Обрывает загрузку на path, как только тело запроса больше max_body_size.
+    Starlette записывает multipart во временный файл целиком до вызова обработчика,
+    поэтому лимит проверяется здесь: сразу по Content-Length, а без него (chunked) -
+    по мере чтения тела. Точный размер самого видео проверяет input_store.save_stream
+    """
+
+    def __init__(self, app, path: str, max_body_size: int):
+        self.app = app
+        self.path = path
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
             return
         
-        # Получаем пользователя по сессии
-        user_id = get_user_for_session(session_id)
-        if not user_id:
-            print(f"⚠️ Пользователь для сессии {session_id} не найден, файлы не отправляются")
+        detail = str(InputTooLargeError(MAX_FILE_SIZE))
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+            await response(scope, receive, send)
             return
         
-        print(f"📤 Отправляем файлы пользователю {user_id} для сессии {session_id}")
-        
-        # Отправляем сообщение о начале отправки
-        start_message = f"""
-🎬 <b>Видео обработано!</b>
-
-📁 <b>Сессия:</b> {session_id}
-📊 <b>Создано файлов:</b> {len(result_files)}
-⚙️ <b>Параметры:</b>
-  • Копий: {copies}
-  • Рамки: {'Да' if add_frames else 'Нет'}
-  • Сжатие: {'Да' if compression else 'Нет'}
-
-📤 <b>Отправляю файлы...</b>
-"""
+        received = 0
         
-        # Отправляем начальное сообщение
-        await send_telegram_notification(start_message, user_id)
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # FastAPI пробрасывает HTTPException из разбора тела как есть
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
         
-        # Отправляем каждый видео файл
-        for i, file_path in enumerate(result_files, 1):
-            try:
-                print(f"📤 Отправляем файл {i}: {file_path}")
-                
-                # Читаем файл
-                with open(file_path, 'rb') as video_file:
-                    video_data = video_file.read()
-                
-                # Отправляем видео через Telegram Bot API
-                url = f"https://api.telegram.org/bot{telegram_token}/sendVideo"
-                
-                files = {
-                    'video': (file_path.name, video_data, 'video/mp4')
-                }
-                
-                data = {
-                    'chat_id': user_id,
-                    'caption': f"📹 Обработанное видео #{i}\n"
-                              f"Копий: {copies}\n"
-                              f"Рамки: {'Да' if add_frames else 'Нет'}\n"
-                              f"Сжатие: {'Да' if compression else 'Нет'}"
-                }
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(url, files=files, data=data, timeout=300)
-                    
-                    if response.status_code == 200:
-                        print(f"✅ Файл {i} отправлен успешно")
-                    else:
-                        print(f"❌ Ошибка отправки файла {i}: {response.status_code}")
-                        print(f"Ответ: {response.text}")
-                        
-            except Exception as file_error:
-                print(f"❌ Ошибка при отправке файла {i}: {file_error}")
-        
-        # Отправляем сообщение о завершении
-        completion_message = f"✅ <b>Все файлы отправлены!</b>\n\n📁 Сессия: {session_id}\n📊 Отправлено: {len(result_files)} файлов"
-        await send_telegram_notification(completion_message, user_id)
-        
-    except Exception as e:
-        print(f"❌ Ошибка при отправке видео файлов в Telegram: {e}")
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimit, path="/upload", max_body_size=MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD)
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """Закрывает соединения общего HTTP клиента"""
+    await close_http_client()
+
+async def profile_request(request: Request, call_next):
+    """
+    Профилирует запрос с заголовком X-Profile (cprofile или yappi).
+    Путь к профилю возвращается в заголовке X-Profile-File.
+    """
+    profile_header = request.headers.get("x-profile")
+    if profile_header is None:
+        return await call_next(request)
+    
+    kind = RequestProfiler.resolve_kind(profile_header)
+    if kind is None:
+        return await call_next(request)
+    profiler = RequestProfiler(kind, request.url.path.strip("/").replace("/", "_") or "root")
+    if not profiler.start():
+        # Уже профилируется другой запрос
+        response = await call_next(request)
+        response.headers["X-Profile"] = "busy"
+        return response
+    
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        profile_path = profiler.stop()
+    elapsed = time.perf_counter() - started
+    print(f"🔬 Профиль {request.method} {request.url.path} ({elapsed:.3f} с): {profile_path}")
+    print(profiler.summary())
+    response.headers["X-Profile-File"] = str(profile_path)
+    return response
+
+# HTTP middleware оборачивает каждый ответ, в том числе скачивание файлов и поток
+# прогресса (SSE), поэтому подключается, только если профилирование включено
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_request)
 
 # Подключаем статические файлы (если папка существует)
 if Path("static").exists():
@@ -268,183 +235,386 @@ async def test_params(
         }
     }
 
+async def iter_upload(file: UploadFile, stats: dict):
+    """Читает загрузку частями по UPLOAD_CHUNK_SIZE; время чтения копится в stats["read_seconds"]"""
+    stats.setdefault("read_seconds", 0.0)
+    while True:
+        started = time.perf_counter()
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        stats["read_seconds"] += time.perf_counter() - started
+        if not chunk:
+            break
+        yield chunk
+
 @app.post("/upload")
 async def upload_video(
     file: UploadFile = File(...),
     user_id: str = Form(...),
     copies: int = Form(1),
     compression: str = Form("false"),
-    add_frames: str = Form("false")
+    add_frames: str = Form("false"),
+    profile: str = Form("")
 ):
-    """Обработка загруженного видео"""
+    """Принимает видео и ставит задачу обработки, не дожидаясь ее завершения"""
     
     # Валидация файла
     if not file.content_type or not file.content_type.startswith('video/'):
         raise HTTPException(status_code=400, detail="Файл должен быть видео")
     
-    # Проверка размера файла (50MB)
-    file_size = 0
-    content = await file.read()
-    file_size = len(content)
-    
-    if file_size > 50 * 1024 * 1024:  # 50MB в байтах
-        raise HTTPException(status_code=400, detail="Размер файла не должен превышать 50MB")
-    
     # Валидация количества копий
     if copies < 1 or copies > 3:
         raise HTTPException(status_code=400, detail="Количество копий должно быть от 1 до 3")
     
+    # Профиль кодирования (необязательно): fast, balanced или small
+    profile_name = profile.strip().lower() or None
+    if profile_name is not None and profile_name not in ENCODER_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный профиль кодирования, доступны: {', '.join(ENCODER_PROFILES)}"
+        )
+    
     # Преобразуем строки в boolean
     compression_bool = compression.lower() in ['true', '1', 'yes', 'on']
     add_frames_bool = add_frames.lower() in ['true', '1', 'yes', 'on']
     
     print(f"Получены параметры: copies={copies}, compression='{compression}' -> {compression_bool}, add_frames='{add_frames}' -> {add_frames_bool}")
     
-    # Создаем уникальный ID для сессии
+    # Создаем уникальный ID для сессии (он же ID задачи)
     session_id = str(uuid.uuid4())
-    session_dir = UPLOAD_DIR / session_id
-    session_dir.mkdir(exist_ok=True)
+    
+    with job_trace(session_id):
+        # Сохраняем оригинал в хранилище исходников частями, проверяя размер по ходу
+        # записи (слишком большое тело запроса обрывает еще UploadSizeLimit);
+        # повторная загрузка того же видео не занимает место второй раз.
+        # В спане read_seconds - чтение запроса, остальное - хэширование и запись на диск
+        suffix = Path(file.filename or "").suffix.lower() or ".mp4"
+        with span("upload") as upload_span:
+            try:
+                _, original_path, file_size = await input_store.save_stream(
+                    iter_upload(file, upload_span), suffix, MAX_FILE_SIZE
+                )
+            except InputTooLargeError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            upload_span["bytes_in"] = file_size
+        print(f"Загружен файл {original_path} ({file_size} байт)")
+        UPLOAD_BYTES.labels(source="web").observe(file_size)
+        
+        # Проверяем файл до постановки в очередь: битое видео не должно занимать кодировщик
+        if FFPROBE_AVAILABLE:
+            try:
+                with span("probe"):
+                    await probe_media_async(original_path)
+            except MediaProbeError as e:
+                original_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=400, detail=f"Видео не поддерживается: {e}")
     
     # Привязываем пользователя к сессии
     link_user_to_session(user_id, session_id)
     
-    # Сохраняем оригинальный файл
-    original_path = session_dir / f"original_{file.filename}"
-    with open(original_path, "wb") as buffer:
-        buffer.write(content)
-    
     # Создаем директорию для результатов
     result_session_dir = RESULT_DIR / session_id
     result_session_dir.mkdir(exist_ok=True)
     
+    # Ставим задачу и сразу отвечаем клиенту, видео кодирует обработчик из worker.py
+    job_store.create_job(session_id, session_id, user_id, {
+        "copies": copies,
+        "compression": compression_bool,
+        "add_frames": add_frames_bool,
+        "profile": profile_name,
+        # Исходник хранится по хэшу содержимого - имя нужно для скачивания копий
+        "filename": file.filename,
+    }, message="Видео в очереди на обработку", input_path=original_path, output_dir=result_session_dir)
+    
+    return {
+        "job_id": session_id,
+        "session_id": session_id,
+        "status": "queued",
+        "status_url": f"/jobs/{session_id}",
+        "events_url": f"/jobs/{session_id}/events",
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Статус задачи обработки"""
+    job = job_store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return public_job(job)
+
+@app.get("/jobs/{job_id}/trace")
+async def get_job_trace(job_id: str):
+    """
+    Трассировка задачи: спаны этапов (загрузка, ожидание в очереди, кодирование
+    копий и этапы FFmpeg, подгонка под размер, очистка, отправка в Telegram)
+    """
+    if job_store.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    loop = asyncio.get_running_loop()
+    spans = await loop.run_in_executor(None, read_trace, job_id)
+    if spans is None:
+        raise HTTPException(status_code=404, detail="Трассировка задачи не найдена")
+    
+    # Суммарное время по этапам, чтобы сразу видеть самый долгий
+    totals = {}
+    for record in spans:
+        totals[record["span"]] = round(totals.get(record["span"], 0.0) + record.get("duration", 0.0), 6)
+    return {"job_id": job_id, "spans": spans, "totals": totals}
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Отменяет задачу: FFmpeg останавливается, частичные результаты удаляются"""
+    job = job_store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    
+    if job["status"] == "processing":
+        # FFmpeg остановит обработчик, который ведет задачу, увидев флаг в базе
+        job_store.request_cancel(job_id)
+        return {"job_id": job_id, "status": "cancelling"}
+    if job["status"] == "queued":
+        job_store.request_cancel(job_id)
+        job = job_store.get_job(job_id)
+    return public_job(job)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """Поток прогресса задачи (Server-Sent Events)"""
+    if job_store.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    
+    async def event_stream():
+        last_payload = None
+        last_sent = time.monotonic()
+        while True:
+            if await request.is_disconnected():
+                break
+            
+            job = job_store.get_job(job_id)
+            if job is None:
+                break
+            
+            payload = json.dumps(public_job(job), ensure_ascii=False)
+            if payload != last_payload:
+                last_payload = payload
+                last_sent = time.monotonic()
+                if job["status"] in FINISHED_JOB_STATUSES:
+                    yield f"event: {job['status']}\ndata: {payload}\n\n"
+                    break
+                yield f"event: progress\ndata: {payload}\n\n"
+            elif time.monotonic() - last_sent > 15:
+                # Комментарий-пинг, чтобы прокси не закрывали соединение
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            
+            await asyncio.sleep(0.5)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def parse_range_header(range_header: str, file_size: int):
+    """
+    Разбирает заголовок Range вида bytes=start-end, bytes=start- или bytes=-suffix.
+    Возвращает (start, end) включительно или None, если отдаем файл целиком.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        # Несколько диапазонов не поддерживаем - отдаем файл целиком
+        return None
+    
+    start_str, _, end_str = ranges.strip().partition("-")
     try:
-        # Обрабатываем видео
-        processor = VideoProcessor()
-        result_files = await processor.process_video(
-            input_path=original_path,
-            output_dir=result_session_dir,
-            copies=copies,
-            compression=compression_bool,
-            add_frames=add_frames_bool
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+        else:
+            suffix = int(end_str)
+            start = max(file_size - suffix, 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    
+    end = min(end, file_size - 1)
+    if start > end or start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="Запрошенный диапазон недоступен",
+            headers={"Content-Range": f"bytes */{file_size}"}
         )
-        
-        # Удаляем оригинальный загруженный файл
-        try:
-            original_path.unlink()
-            print(f"Удален оригинальный файл: {original_path}")
-        except Exception as e:
-            print(f"Ошибка при удалении оригинального файла {original_path}: {e}")
-        
-        # Удаляем папку загрузки если она пустая
-        try:
-            if session_dir.exists() and not any(session_dir.iterdir()):
-                session_dir.rmdir()
-                print(f"Удалена пустая папка загрузки: {session_dir}")
-        except Exception as e:
-            print(f"Ошибка при удалении папки загрузки {session_dir}: {e}")
-        
-        # Отправляем видео файлы напрямую в Telegram конкретному пользователю
-        asyncio.create_task(send_video_files_to_telegram(result_files, session_id, copies, add_frames_bool, compression_bool))
-        
-        return {
-            "session_id": session_id,
-            "message": f"Видео успешно обработано. Создано {len(result_files)} файлов.",
-            "files": [f"/download/{session_id}/{file.name}" for file in result_files]
-        }
-        
-    except Exception as e:
-        # Очищаем временные файлы в случае ошибки
-        shutil.rmtree(session_dir, ignore_errors=True)
-        shutil.rmtree(result_session_dir, ignore_errors=True)
-        
-        # Отправляем уведомление об ошибке
-        error_message = f"""
-❌ <b>Ошибка обработки видео!</b>
+    return start, end
 
-📁 <b>Сессия:</b> {session_id}
-🚨 <b>Ошибка:</b> {str(e)}
+async def iter_file_range(file_path: Path, start: int, end: int):
+    """Читает диапазон файла частями без загрузки целиком в память"""
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
-Попробуйте еще раз или обратитесь к администратору.
-"""
-        asyncio.create_task(send_telegram_notification(error_message))
-        
-        raise HTTPException(status_code=500, detail=f"Ошибка обработки видео: {str(e)}")
+def session_result_dir(session_id: str) -> Path:
+    """
+    Папка результатов сессии. Сессия не выходит за пределы RESULT_DIR:
+    session_id ".." (или "%2E%2E") указывал бы на рабочий каталог приложения
+    """
+    session_dir = RESULT_DIR / session_id
+    if session_dir.resolve().parent != RESULT_DIR.resolve():
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    return session_dir
+
+def download_name(session_id: str, filename: str) -> str:
+    """
+    Имя копии для скачивания: на диске копии названы по хэшу исходника
+    (processed_copy_N_<sha256>.mp4), пользователю отдается имя его загрузки
+    """
+    job = job_store.get_job(session_id)
+    original = job["params"].get("filename") if job else None
+    match = re.match(r"processed_copy_(\d+)_", filename)
+    if not original or not match:
+        return filename
+    # Имя приходит от клиента и может содержать путь (в том числе виндовый)
+    stem = Path(original.replace("\\", "/")).stem or "video"
+    return f"processed_copy_{match.group(1)}_{stem}.mp4"
+
+def content_disposition(filename: str) -> str:
+    """Content-Disposition с ASCII-именем и именем в UTF-8 (RFC 6266) для кириллицы"""
+    fallback = "".join(c if c.isascii() and c.isprintable() and c not in '"\\' else "_" for c in filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
 
 @app.get("/download/{session_id}/{filename}")
-async def download_file(session_id: str, filename: str):
-    """Скачивание обработанного файла"""
-    file_path = RESULT_DIR / session_id / filename
+async def download_file(session_id: str, filename: str, request: Request):
+    """Скачивание обработанного файла напрямую из RESULT_DIR с поддержкой Range"""
+    session_dir = session_result_dir(session_id)
+    file_path = session_dir / filename
     
-    if not file_path.exists():
+    # Не выпускаем запрос за пределы папки сессии
+    if file_path.resolve().parent != session_dir.resolve() or not file_path.is_file():
         raise HTTPException(status_code=404, detail="Файл не найден")
     
-    # Создаем временный файл в нашей локальной папке
-    temp_dir = Path("temp_downloads")
-    temp_dir.mkdir(exist_ok=True)
-    
-    temp_filename = f"temp_{session_id}_{filename}"
-    temp_path = temp_dir / temp_filename
+    file_size = file_path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": content_disposition(download_name(session_id, filename)),
+    }
     
-    # Копируем файл во временную директорию
-    shutil.copy2(file_path, temp_path)
+    range_header = request.headers.get("range")
+    byte_range = parse_range_header(range_header, file_size) if range_header else None
     
-    # Удаляем оригинальный файл
-    try:
-        file_path.unlink()
-        print(f"Удален файл: {file_path}")
-    except Exception as e:
-        print(f"Ошибка при удалении файла {file_path}: {e}")
+    if byte_range is None:
+        # Файл целиком: FileResponse использует sendfile, если сервер это поддерживает
+        return FileResponse(path=file_path, media_type="video/mp4", headers=headers)
     
-    # Проверяем, остались ли файлы в сессии
-    session_dir = RESULT_DIR / session_id
-    if session_dir.exists():
-        remaining_files = list(session_dir.iterdir())
-        if not remaining_files:
-            # Если папка пустая, удаляем её
-            try:
-                session_dir.rmdir()
-                print(f"Удалена пустая директория сессии: {session_dir}")
-            except Exception as e:
-                print(f"Ошибка при удалении директории {session_dir}: {e}")
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(file_path, start, end),
+        status_code=206,
+        media_type="video/mp4",
+        headers=headers
+    )
+
+def reap_expired_results(ttl_seconds: int):
+    """Удаляет результаты сессий старше ttl_seconds"""
+    deadline = time.time() - ttl_seconds
     
-    # Функция для удаления временного файла после скачивания
-    def cleanup_temp_file():
+    for session_dir in RESULT_DIR.iterdir():
         try:
-            os.unlink(temp_path)
-            print(f"Удален временный файл: {temp_path}")
+            if session_dir.is_dir() and session_dir.stat().st_mtime < deadline:
+                # Задачи в работе не трогаем
+                if job_store.is_job_active(session_dir.name):
+                    continue
+                shutil.rmtree(session_dir, ignore_errors=True)
+                print(f"🧹 Удалены устаревшие файлы сессии: {session_dir}")
         except Exception as e:
-            print(f"Ошибка при удалении временного файла {temp_path}: {e}")
+            print(f"Ошибка при удалении устаревшей сессии {session_dir}: {e}")
     
-    # Создаем BackgroundTasks и добавляем задачу очистки
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(cleanup_temp_file)
+    # Истекшие сессии и завершенные задачи
+    purged = job_store.purge_expired()
+    if purged:
+        print(f"🧹 Удалено устаревших записей сессий и задач: {purged}")
     
-    return FileResponse(
-        path=temp_path,
-        filename=filename,
-        media_type='application/octet-stream',
-        background=background_tasks
-    )
+    # Трассировки живут столько же, сколько записи задач
+    purged_traces = purge_traces(JOB_STORE_TTL_SECONDS)
+    if purged_traces:
+        print(f"🧹 Удалено устаревших трассировок: {purged_traces}")
+
+async def result_reaper():
+    """Фоновая очистка результатов по TTL вместо удаления при скачивании"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, reap_expired_results, RESULT_TTL_SECONDS)
+        except Exception as e:
+            print(f"❌ Ошибка очистки результатов: {e}")
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_result_reaper():
+    """Запускает очистку устаревших результатов"""
+    app.state.result_reaper = asyncio.create_task(result_reaper())
+
+@app.on_event("startup")
+async def start_embedded_worker():
+    """Обработчик очереди в процессе веб-приложения, если worker.py не запускается отдельно"""
+    if not EMBEDDED_WORKER:
+        return
+    from worker import EncodeWorker
+    app.state.embedded_worker = EncodeWorker(f"web-{os.getpid()}")
+    app.state.embedded_worker_task = asyncio.create_task(app.state.embedded_worker.run())
+
+@app.on_event("shutdown")
+async def stop_embedded_worker():
+    """Останавливает встроенный обработчик; задача в работе возвращается в очередь"""
+    if not EMBEDDED_WORKER:
+        return
+    app.state.embedded_worker.stop()
+    await asyncio.gather(app.state.embedded_worker_task, return_exceptions=True)
+
+@app.get("/queue")
+async def queue_stats():
+    """
+    Очередь задач (число задач по статусам) и, если задачи кодируются в этом
+    процессе, планировщик FFmpeg: занятые слоты, глубина очереди и время ожидания
+    """
+    stats = {"jobs": job_store.count_jobs()}
+    if EMBEDDED_WORKER:
+        stats.update(get_encode_scheduler().stats())
+    return stats
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus. Метрики кодирования отдают обработчики (WORKER_METRICS_PORT)"""
+    for status, count in job_store.count_jobs().items():
+        JOBS.labels(status=status).set(count)
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+@app.get("/cache")
+async def cache_stats():
+    """
+    Состояние кэша результатов: попадания и промахи всех обработчиков
+    (общие счетчики в job_store) и занятое место
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_result_cache().stats)
 
 @app.delete("/cleanup/{session_id}")
 async def cleanup_session(session_id: str):
-    """Очистка временных файлов сессии"""
-    upload_path = UPLOAD_DIR / session_id
-    result_path = RESULT_DIR / session_id
+    """Очистка результатов сессии, не дожидаясь RESULT_TTL_SECONDS"""
+    result_path = session_result_dir(session_id)
+    if job_store.is_job_active(session_id):
+        raise HTTPException(status_code=409, detail="Задача сессии еще обрабатывается")
     
-    if upload_path.exists():
-        shutil.rmtree(upload_path)
     if result_path.exists():
         shutil.rmtree(result_path)
     
     return {"message": "Файлы сессии удалены"}
 
-@app.post("/cleanup-temp")
-async def cleanup_temp():
-    """Очистка всех временных файлов"""
-    cleanup_temp_files()
-    return {"message": "Временные файлы очищены"}
-
 if __name__ == "__main__":
     import uvicorn
     import os
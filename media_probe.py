@@ -0,0 +1,179 @@
+"""
+Инспекция медиафайлов через ffprobe с кэшированием метаданных
+"""
+
+import asyncio
+import json
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from metrics import PROBE_SECONDS
+
+FFPROBE_AVAILABLE = shutil.which('ffprobe') is not None
+
+# Сколько записей метаданных держать в памяти
+PROBE_CACHE_SIZE = 256
+
+
+class MediaProbeError(Exception):
+    """Файл не читается ffprobe или не подходит для обработки"""
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Компактные метаданные входного файла"""
+    format_name: str
+    duration: float
+    size: int
+    bit_rate: Optional[int]
+    video_codec: str
+    width: int
+    height: int
+    fps: float
+    pix_fmt: Optional[str]
+    has_audio: bool
+    audio_codec: Optional[str]
+    audio_bit_rate: Optional[int]
+    # Длительности потоков (если контейнер их сообщает) - для проверки синхронизации
+    video_duration: Optional[float] = None
+    audio_duration: Optional[float] = None
+
+    @property
+    def is_mp4(self) -> bool:
+        return 'mp4' in self.format_name.split(',')
+
+    @property
+    def stream_copy_compatible(self) -> bool:
+        """H.264 видео и AAC аудио (или без аудио) в контейнере MP4/MOV"""
+        return (
+            self.is_mp4
+            and self.video_codec == 'h264'
+            and (not self.has_audio or self.audio_codec == 'aac')
+        )
+
+
+def _parse_rate(rate: Optional[str]) -> float:
+    """'30000/1001' -> 29.97"""
+    try:
+        num, _, den = (rate or '').partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _parse_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_probe_output(data: dict, size: int) -> MediaInfo:
+    """Собирает MediaInfo из JSON ffprobe и проверяет, что файл можно обрабатывать"""
+    fmt = data.get('format', {})
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+    if video is None:
+        raise MediaProbeError("в файле нет видеопотока")
+    if not video.get('codec_name'):
+        raise MediaProbeError("неизвестный видеокодек")
+
+    width = _parse_int(video.get('width')) or 0
+    height = _parse_int(video.get('height')) or 0
+    if width <= 0 or height <= 0:
+        raise MediaProbeError("не удалось определить разрешение видео")
+
+    try:
+        duration = float(fmt.get('duration') or video.get('duration') or 0)
+    except ValueError:
+        duration = 0.0
+    if duration <= 0:
+        raise MediaProbeError("не удалось определить длительность видео")
+
+    return MediaInfo(
+        format_name=fmt.get('format_name', ''),
+        duration=duration,
+        size=size,
+        bit_rate=_parse_int(fmt.get('bit_rate')),
+        video_codec=video['codec_name'],
+        width=width,
+        height=height,
+        fps=_parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')),
+        pix_fmt=video.get('pix_fmt'),
+        has_audio=audio is not None,
+        audio_codec=audio.get('codec_name') if audio else None,
+        audio_bit_rate=_parse_int(audio.get('bit_rate')) if audio else None,
+        video_duration=_parse_float(video.get('duration')),
+        audio_duration=_parse_float(audio.get('duration')) if audio else None,
+    )
+
+
+_cache: "OrderedDict[tuple, MediaInfo]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def probe_media(path: Path) -> MediaInfo:
+    """
+    Запускает ffprobe один раз на файл. Повторные вызовы для того же файла
+    (устройство, inode, размер, mtime) отдаются из кэша.
+    """
+    stat = path.stat()
+    identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        info = _cache.get(identity)
+        if info is not None:
+            _cache.move_to_end(identity)
+            return info
+
+    if not FFPROBE_AVAILABLE:
+        raise MediaProbeError("ffprobe не установлен")
+
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_format', '-show_streams',
+        '-of', 'json',
+        str(path)
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    except subprocess.TimeoutExpired:
+        raise MediaProbeError("ffprobe не ответил за 30 секунд")
+    if result.returncode != 0:
+        raise MediaProbeError(f"файл поврежден или не является видео: {result.stderr.strip()}")
+
+    try:
+        data = json.loads(result.stdout)
+    except ValueError:
+        raise MediaProbeError("не удалось разобрать ответ ffprobe")
+
+    info = _parse_probe_output(data, stat.st_size)
+    print(f"🔍 {path.name}: {info.video_codec} {info.width}x{info.height} "
+          f"{info.fps:.2f} fps, {info.duration:.1f} с, аудио: {info.audio_codec or 'нет'}")
+
+    with _cache_lock:
+        _cache[identity] = info
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
+
+
+async def probe_media_async(path: Path) -> MediaInfo:
+    """probe_media без блокировки event loop"""
+    loop = asyncio.get_running_loop()
+    with PROBE_SECONDS.time():
+        return await loop.run_in_executor(None, probe_media, path)
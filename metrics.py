@@ -0,0 +1,298 @@
+"""
+Метрики обработки в текстовом формате Prometheus: реестр процесса и HTTP-сервер для бота и обработчиков
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric"):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Метрика с метками. Без меток методы вызываются у самой метрики,
+    с метками - у дочерней: metric.labels(stage="concat").inc()
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"Метрике {self.name} нужны метки: {', '.join(self.labelnames)}")
+        return self.labels()
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при каждом чтении метрик"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+                for key, child in self._items()]
+
+
+class Gauge(Counter):
+    """Значение, которое может расти и уменьшаться"""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+    def track_inprogress(self):
+        return self._default().track_inprogress()
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """Наблюдает длительность блока в секундах"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, child in self._items():
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы сборщика метрик не пишем в лог
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """HTTP-сервер /metrics в фоновом потоке (бот и обработчики без FastAPI)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+
+# Метрики конвейера обработки
+
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 2, 5, 10, 20, 30, 40, 50, 100, 200))
+SPEED_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 20)
+
+UPLOAD_BYTES = Histogram(
+    "videobot_upload_bytes", "Размер исходных видео (веб-загрузки и скачивания ботом)",
+    ["source"], buckets=SIZE_BUCKETS
+)
+PROBE_SECONDS = Histogram("videobot_probe_seconds", "Время ffprobe")
+QUEUE_WAIT_SECONDS = Histogram(
+    "videobot_queue_wait_seconds", "Ожидание в очереди: jobs - задача до обработчика, ffmpeg - слот планировщика",
+    ["queue"]
+)
+ENCODE_SECONDS = Histogram("videobot_encode_seconds", "Время этапа обработки с занятым слотом FFmpeg", ["stage"])
+ENCODE_SPEED = Histogram(
+    "videobot_encode_speed_ratio", "Скорость кодирования libx264 на один выход (x реального времени)",
+    buckets=SPEED_BUCKETS
+)
+FFMPEG_FAILURES = Counter("videobot_ffmpeg_failures_total", "Неудачные запуски FFmpeg (код возврата или таймаут)", ["stage"])
+FALLBACKS = Counter("videobot_fallbacks_total", "Переходы на запасной способ обработки", ["fallback"])
+RESULT_CACHE_LOOKUPS = Counter("videobot_result_cache_lookups_total", "Обращения к кэшу результатов", ["result"])
+RESULT_CACHE_HIT_RATIO = Gauge("videobot_result_cache_hit_ratio", "Доля попаданий в кэш результатов в этом процессе")
+JOBS_IN_FLIGHT = Gauge("videobot_jobs_in_flight", "Задачи, которые сейчас обрабатывает этот процесс")
+JOBS = Gauge("videobot_jobs", "Задачи в хранилище по статусам", ["status"])
+TELEGRAM_SEND_SECONDS = Histogram(
+    "videobot_telegram_send_seconds", "Отправка видео в Telegram: по file_id или загрузкой файла", ["method"]
+)
+
+
+def _result_cache_hit_ratio() -> float:
+    hits = RESULT_CACHE_LOOKUPS.labels(result="hit").get()
+    misses = RESULT_CACHE_LOOKUPS.labels(result="miss").get()
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+RESULT_CACHE_HIT_RATIO.set_function(_result_cache_hit_ratio)
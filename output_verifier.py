@@ -0,0 +1,144 @@
+"""
+Проверка готовых копий перед отдачей пользователю
+
+Дешевая проверка через ffprobe: есть видеопоток (и аудио, если оно есть во входе),
+длительность совпадает со входом, атом moov стоит перед mdat (faststart).
+Дополнительно (VERIFY_OUTPUT_SSIM) фрагмент копии сравнивается с исходником по SSIM.
+"""
+
+import asyncio
+import os
+import re
+import struct
+from pathlib import Path
+from typing import Optional
+
+from config import VERIFY_MIN_SSIM, VERIFY_OUTPUT_SSIM
+from ffmpeg_runner import run_ffmpeg
+from media_probe import MediaInfo, MediaProbeError, probe_media_async
+
+# Допустимое расхождение длительности копии и входа: секунды и доля длительности
+DURATION_TOLERANCE_SECONDS = 0.5
+DURATION_TOLERANCE_RATIO = 0.02
+# Фрагмент для SSIM: длительность в секундах и таймаут FFmpeg
+SSIM_SAMPLE_SECONDS = 3
+SSIM_TIMEOUT = 60
+# Толщина рамки копии в пикселях (pad=iw+60:ih+60:30:30, drawbox t=30)
+FRAME_BORDER = 30
+
+
+class OutputVerificationError(Exception):
+    """Копия не прошла проверку"""
+
+
+def moov_before_mdat(path: Path) -> bool:
+    """Проверяет, что атом moov MP4 стоит перед mdat (faststart)"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box_type = struct.unpack('>I4s', header)
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat':
+                return False
+            if size == 1:
+                # 64-битный размер атома
+                size = struct.unpack('>Q', f.read(8))[0]
+                f.seek(size - 16, os.SEEK_CUR)
+            elif size == 0 or size < 8:
+                # Атом до конца файла или битый заголовок
+                return False
+            else:
+                f.seek(size - 8, os.SEEK_CUR)
+
+
+def ssim_graph(frame: Optional[str], output_info: Optional[MediaInfo]) -> str:
+    """
+    Граф SSIM: копия [0:v] против исходника [1:v]. Рамка обрезается до сравнения,
+    иначе она считается искажением: pad добавляет FRAME_BORDER пикселей вокруг кадра,
+    drawbox закрашивает края кадра - у исходника обрезается та же доля кадра
+    """
+    dist, ref = "[0:v]", "[1:v]"
+    graph = []
+    if frame in ("pad", "drawbox"):
+        # Рамка рисуется в пикселях копии, поэтому обрезается до приведения к размеру входа
+        graph.append(f"{dist}crop=iw-{2 * FRAME_BORDER}:ih-{2 * FRAME_BORDER}:{FRAME_BORDER}:{FRAME_BORDER}[cropped]")
+        dist = "[cropped]"
+    if frame == "drawbox" and output_info is not None:
+        x = FRAME_BORDER / output_info.width
+        y = FRAME_BORDER / output_info.height
+        graph.append(f"{ref}crop=iw*{1 - 2 * x:.6f}:ih*{1 - 2 * y:.6f}:iw*{x:.6f}:ih*{y:.6f}[refcropped]")
+        ref = "[refcropped]"
+    graph.append(f"{dist}{ref}scale2ref[dist][ref];[dist][ref]ssim")
+    return ";".join(graph)
+
+
+async def sample_ssim(
+    output_path: Path,
+    input_path: Path,
+    input_info: MediaInfo,
+    frame: Optional[str] = None,
+    output_info: Optional[MediaInfo] = None
+) -> Optional[float]:
+    """
+    SSIM фрагмента из середины ролика без рамки frame. Копия приводится к размеру
+    входа, поэтому сжатие немного снижает оценку - порог VERIFY_MIN_SSIM отсекает
+    только копии, не похожие на исходник
+    """
+    start = max(0.0, input_info.duration / 2 - SSIM_SAMPLE_SECONDS / 2)
+    cmd = [
+        'ffmpeg', '-hide_banner',
+        '-ss', f"{start:.3f}", '-t', str(SSIM_SAMPLE_SECONDS), '-i', str(output_path),
+        '-ss', f"{start:.3f}", '-t', str(SSIM_SAMPLE_SECONDS), '-i', str(input_path),
+        '-lavfi', ssim_graph(frame, output_info),
+        '-f', 'null', '-'
+    ]
+    result = await run_ffmpeg(cmd, SSIM_TIMEOUT)
+    match = re.search(r"SSIM .*All:([\d.]+)", result.stderr or "")
+    return float(match.group(1)) if result.returncode == 0 and match else None
+
+
+async def verify_output(
+    output_path: Path,
+    input_path: Path,
+    input_info: Optional[MediaInfo],
+    frame: Optional[str] = None,
+    check_ssim: bool = VERIFY_OUTPUT_SSIM
+) -> MediaInfo:
+    """
+    Проверяет копию и возвращает ее метаданные. frame - способ рамки копии
+    (pad, drawbox или None), рамка не учитывается при сравнении по SSIM
+
+    Raises:
+        OutputVerificationError: Файла нет, он не читается или не похож на исходник
+    """
+    if not output_path.is_file() or output_path.stat().st_size == 0:
+        raise OutputVerificationError("файл копии не создан или пуст")
+    try:
+        # ffprobe заодно проверяет, что есть видеопоток, разрешение и длительность
+        info = await probe_media_async(output_path)
+    except MediaProbeError as e:
+        raise OutputVerificationError(f"ffprobe не читает копию: {e}")
+
+    if input_info is not None:
+        if input_info.has_audio and not info.has_audio:
+            raise OutputVerificationError("в копии пропал звук")
+        tolerance = max(DURATION_TOLERANCE_SECONDS, input_info.duration * DURATION_TOLERANCE_RATIO)
+        if input_info.duration and abs(info.duration - input_info.duration) > tolerance:
+            raise OutputVerificationError(
+                f"длительность копии {info.duration:.2f} с вместо {input_info.duration:.2f} с"
+            )
+
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, moov_before_mdat, output_path):
+        raise OutputVerificationError("атом moov не в начале файла (нет faststart)")
+
+    if check_ssim and input_info is not None:
+        ssim = await sample_ssim(output_path, input_path, input_info, frame, info)
+        if ssim is None:
+            raise OutputVerificationError("не удалось посчитать SSIM копии")
+        if ssim < VERIFY_MIN_SSIM:
+            raise OutputVerificationError(f"SSIM копии {ssim:.3f} ниже {VERIFY_MIN_SSIM}")
+    return info
@@ -0,0 +1,86 @@
+"""
+Профилирование отдельных запросов веб-приложения для поиска блокировок event loop
+
+Включается PROFILING_ENABLED, для запроса - заголовком X-Profile: cprofile или yappi
+(yappi - если установлен). Профиль пишется в PROFILE_DIR в формате pstats, путь
+возвращается в заголовке X-Profile-File, самые дорогие функции выводятся в лог.
+"""
+
+import cProfile
+import io
+import pstats
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from config import PROFILE_DIR
+
+try:
+    import yappi
+    YAPPI_AVAILABLE = True
+except ImportError:
+    YAPPI_AVAILABLE = False
+
+PROFILERS = ("cprofile", "yappi")
+# Сколько функций выводить в лог
+PROFILE_TOP_FUNCTIONS = 15
+
+# Профилировщик один на процесс: пока профилируется один запрос, остальные идут без профиля
+_profile_lock = threading.Lock()
+
+
+class RequestProfiler:
+    """
+    Профиль всего потока event loop за время запроса: кроме обработчика в него
+    попадают и остальные корутины, поэтому видно, что именно блокировало loop
+    """
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.path = Path(PROFILE_DIR) / f"{time.strftime('%Y%m%d-%H%M%S')}_{name}_{kind}.prof"
+        self._profile: Optional[cProfile.Profile] = None
+
+    @staticmethod
+    def resolve_kind(value: str) -> Optional[str]:
+        """Профилировщик по значению заголовка; None - недоступен"""
+        kind = value.strip().lower()
+        if kind in ("1", "true", ""):
+            kind = "cprofile"
+        if kind not in PROFILERS or (kind == "yappi" and not YAPPI_AVAILABLE):
+            return None
+        return kind
+
+    def start(self) -> bool:
+        if not _profile_lock.acquire(blocking=False):
+            return False
+        if self.kind == "yappi":
+            # Время по часам: ожидания в корутинах тоже видны
+            yappi.set_clock_type("wall")
+            yappi.clear_stats()
+            yappi.start()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return True
+
+    def stop(self) -> Path:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.kind == "yappi":
+                yappi.stop()
+                yappi.get_func_stats().save(str(self.path), type="pstat")
+                yappi.clear_stats()
+            else:
+                self._profile.disable()
+                self._profile.dump_stats(str(self.path))
+        finally:
+            _profile_lock.release()
+        return self.path
+
+    def summary(self) -> str:
+        """Самые дорогие функции по суммарному времени"""
+        output = io.StringIO()
+        stats = pstats.Stats(str(self.path), stream=output)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        return output.getvalue()
@@ -0,0 +1,190 @@
+"""
+Дисковый кэш результатов обработки, адресуемый по содержимому входа
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+from job_store import get_job_store
+from metrics import RESULT_CACHE_LOOKUPS
+
+# Меняется при изменении формата выходных файлов, чтобы старые записи не попадали в выдачу
+CACHE_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+MANIFEST_NAME = "manifest.json"
+
+
+def hash_file(path: Path) -> str:
+    """Потоковый SHA-256 файла без чтения целиком в память"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(input_hash: str, params: dict) -> str:
+    """Ключ кэша: хэш входа + параметры обработки"""
+    payload = json.dumps(
+        {"version": CACHE_VERSION, "input": input_hash, "params": params},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path):
+    """Жесткая ссылка, если файловая система позволяет, иначе копия"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """
+    Кэш готовых копий видео с вытеснением давно не использованных записей (LRU).
+
+    Каждая запись - папка <key>/ с файлами копий и manifest.json. Запись
+    собирается во временной папке и публикуется атомарным rename.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str, output_paths: List[Path]) -> bool:
+        """
+        Ищет запись и раскладывает ее файлы по output_paths.
+        Возвращает True при попадании в кэш.
+        """
+        entry_dir = self.cache_dir / key
+        try:
+            with open(entry_dir / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            files = manifest["files"]
+            if len(files) != len(output_paths):
+                raise ValueError("количество файлов не совпадает")
+            for name, output_path in zip(files, output_paths):
+                output_path.unlink(missing_ok=True)
+                link_or_copy(entry_dir / name, output_path)
+            # Отмечаем использование для LRU
+            os.utime(entry_dir)
+        except (OSError, ValueError, KeyError) as e:
+            if entry_dir.exists():
+                print(f"⚠️ Запись кэша {key[:12]} повреждена, игнорируем: {e}")
+            for output_path in output_paths:
+                output_path.unlink(missing_ok=True)
+            self._count("miss")
+            return False
+
+        self._count("hit")
+        return True
+
+    def _count(self, result: str):
+        """
+        Учитывает попадание или промах: в метриках процесса и в общем счетчике
+        job_store - поиск идет в обработчиках, а статистику отдает веб-приложение
+        """
+        RESULT_CACHE_LOOKUPS.labels(result=result).inc()
+        try:
+            get_job_store().increment_counter(f"result_cache_{result}")
+        except sqlite3.Error as e:
+            print(f"⚠️ Не удалось обновить счетчик кэша: {e}")
+
+    def put(self, key: str, files: List[Path]):
+        """Сохраняет результаты в кэш и вытесняет старые записи при переполнении"""
+        entry_dir = self.cache_dir / key
+        if entry_dir.exists():
+            return
+
+        tmp_dir = self.cache_dir / f".tmp-{uuid.uuid4().hex}"
+        try:
+            tmp_dir.mkdir()
+            names = []
+            for i, file_path in enumerate(files, 1):
+                name = f"copy_{i}.mp4"
+                link_or_copy(file_path, tmp_dir / name)
+                names.append(name)
+            with open(tmp_dir / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+                json.dump({"files": names}, f)
+
+            # Атомарная публикация: запись либо видна целиком, либо не видна вовсе
+            os.rename(tmp_dir, entry_dir)
+            print(f"💾 Результат сохранен в кэш: {key[:12]}")
+        except OSError as e:
+            # Запись могла появиться параллельно - это не ошибка
+            if not entry_dir.exists():
+                print(f"⚠️ Не удалось сохранить результат в кэш: {e}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def _entries(self):
+        """Список (mtime, размер, папка) опубликованных записей"""
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if not entry_dir.is_dir() or entry_dir.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry_dir.iterdir())
+                entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока кэш больше max_bytes"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                print(f"🧹 Запись кэша вытеснена: {entry_dir.name[:12]}")
+
+    def stats(self) -> dict:
+        """Счетчики всех процессов и размер кэша"""
+        entries = self._entries()
+        counters = get_job_store().get_counters("result_cache_hit", "result_cache_miss")
+        hits, misses = counters["result_cache_hit"], counters["result_cache_miss"]
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> ResultCache:
+    """Общий для процесса кэш результатов"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(Path(RESULT_CACHE_DIR), RESULT_CACHE_MAX_BYTES)
+    return _result_cache
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """
-Запуск веб-приложения и Telegram бота одновременно на Railway
+Запуск веб-приложения, обработчиков задач и Telegram бота одновременно на Railway
+
+    python start_all.py            # веб + обработчики + бот (если задан токен)
+    python start_all.py --no-bot   # бот запущен отдельным сервисом
 """
 
 import asyncio
@@ -11,8 +14,10 @@ import os
 import time
 from pathlib import Path
 
+from config import WEB_WORKERS
+
 def start_web():
-    """Запуск веб-приложения"""
+    """Запуск веб-приложения: несколько процессов uvicorn только принимают и отдают файлы"""
     print("🌐 Запускаем веб-приложение...")
     port = os.getenv("PORT", "8000")
     
@@ -21,13 +26,25 @@ def start_web():
             sys.executable, "-m", "uvicorn", 
             "main:app", 
             "--host", "0.0.0.0", 
-            "--port", port
+            "--port", port,
+            "--workers", str(WEB_WORKERS)
         ], check=True)
     except subprocess.CalledProcessError as e:
         print(f"❌ Ошибка запуска веб-приложения: {e}")
     except KeyboardInterrupt:
         print("🛑 Веб-приложение остановлено")
 
+def start_workers():
+    """Запуск обработчиков задач с перезапуском при падении"""
+    print("👷 Запускаем обработчиков задач...")
+    
+    try:
+        subprocess.run([sys.executable, "start_workers.py"], check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Ошибка запуска обработчиков: {e}")
+    except KeyboardInterrupt:
+        print("🛑 Обработчики остановлены")
+
 def start_bot():
     """Запуск Telegram бота"""
     print("🤖 Запускаем Telegram бота...")
@@ -62,6 +79,16 @@ def main():
     print(f"🔑 BOT_TOKEN найден: {'Да' if bot_token and bot_token != 'YOUR_BOT_TOKEN_HERE' else 'Нет'}")
     print(f"🌐 PORT: {port}")
     
+    # Обработчики кодируют видео в отдельных процессах и нужны в любом случае
+    workers_thread = threading.Thread(target=start_workers, daemon=True)
+    workers_thread.start()
+    print("✅ Обработчики задач запущены")
+    
+    if "--no-bot" in sys.argv:
+        print("ℹ️ Бот запускается отдельным сервисом, запускаем только веб-приложение")
+        start_web()
+        return
+    
     if not bot_token or bot_token == "YOUR_BOT_TOKEN_HERE":
         print("⚠️ TELEGRAM_BOT_TOKEN не найден, запускаем только веб-приложение")
         start_web()
@@ -9,6 +9,8 @@ import subprocess
 import threading
 import time
 
+from config import WEB_WORKERS
+
 def start_web():
     """Запуск веб-приложения"""
     print("🌐 Запускаем веб-приложение...")
@@ -19,11 +21,21 @@ def start_web():
             sys.executable, "-m", "uvicorn", 
             "main:app", 
             "--host", "0.0.0.0", 
-            "--port", port
+            "--port", port,
+            "--workers", str(WEB_WORKERS)
         ], check=True)
     except Exception as e:
         print(f"❌ Ошибка веб-приложения: {e}")
 
+def start_workers():
+    """Запуск обработчиков задач"""
+    print("👷 Запускаем обработчиков...")
+    
+    try:
+        subprocess.run([sys.executable, "start_workers.py"], check=True)
+    except Exception as e:
+        print(f"❌ Ошибка обработчиков: {e}")
+
 def start_bot():
     """Запуск бота"""
     print("🤖 Запускаем бота...")
@@ -43,6 +55,9 @@ def main():
     bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
     print(f"🔑 Токен: {'Есть' if bot_token else 'Нет'}")
     
+    # Видео кодируют обработчики, веб только ставит задачи
+    threading.Thread(target=start_workers, daemon=True).start()
+    
     if not bot_token or bot_token == "YOUR_BOT_TOKEN_HERE":
         print("⚠️ Запускаем только веб")
         start_web()
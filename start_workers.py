@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Запуск обработчиков задач (worker.py) с перезапуском при падении
+
+Число обработчиков - ENCODE_WORKERS (0 - по одному на каждые четыре ядра). Ядра делятся между
+обработчиками: каждому достается своя доля процессов и потоков FFmpeg.
+"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from config import ENCODE_WORKERS, FFMPEG_MAX_PROCESSES, FFMPEG_THREADS_PER_JOB, WORKER_METRICS_PORT
+
+WORKER_SCRIPT = str(Path(__file__).resolve().parent / "worker.py")
+
+# Пауза перед перезапуском упавшего обработчика: растет, пока он падает сразу после старта
+RESTART_DELAY_MIN = 1.0
+RESTART_DELAY_MAX = 60.0
+# Обработчик, проработавший дольше этого времени, считается стабильным
+STABLE_UPTIME = 60.0
+# Сколько ждать завершения обработчиков при остановке
+STOP_TIMEOUT = 30.0
+# Временный каталог FFmpeg обработчиков (VideoProcessor.temp_dir): статистика
+# двухпроходного кодирования и сегменты длинных роликов
+TEMP_DIR = Path("temp_processing")
+
+
+def worker_count() -> int:
+    """Число обработчиков: по одному на каждые четыре ядра"""
+    return ENCODE_WORKERS or max(1, (os.cpu_count() or 1) // 4)
+
+
+def cleanup_temp_files():
+    """
+    Удаляет то, что оставили во временном каталоге упавшие обработчики.
+    Вызывается до запуска обработчиков, пока ни одна задача не кодируется
+    """
+    if not TEMP_DIR.exists():
+        return
+    for temp_path in TEMP_DIR.iterdir():
+        try:
+            if temp_path.is_dir():
+                shutil.rmtree(temp_path)
+            else:
+                temp_path.unlink()
+            print(f"Удален старый временный файл: {temp_path}")
+        except Exception as e:
+            print(f"Ошибка при очистке временного файла {temp_path}: {e}")
+
+
+def worker_env(count: int) -> dict:
+    """
+    Окружение обработчика. Без явных настроек FFmpeg каждому достается
+    1/count от планировщика по умолчанию (процесс libx264 на два ядра),
+    чтобы обработчики вместе не перегружали хост.
+    """
+    env = os.environ.copy()
+    cores = os.cpu_count() or 1
+    max_processes = FFMPEG_MAX_PROCESSES or max(1, cores // 2 // count)
+    if not FFMPEG_MAX_PROCESSES:
+        env["FFMPEG_MAX_PROCESSES"] = str(max_processes)
+    if not FFMPEG_THREADS_PER_JOB:
+        env["FFMPEG_THREADS_PER_JOB"] = str(max(1, cores // (count * max_processes)))
+    env["PYTHONUNBUFFERED"] = "1"
+    return env
+
+
+class WorkerSupervisor:
+    """Держит запущенными count процессов worker.py"""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.env = worker_env(count)
+        self.processes: List[Optional[subprocess.Popen]] = [None] * count
+        self.started_at = [0.0] * count
+        self.restart_delay = [RESTART_DELAY_MIN] * count
+        self.next_start = [0.0] * count
+        self._stopping = False
+
+    def _start(self, i: int):
+        cmd = [sys.executable, WORKER_SCRIPT, "--id", f"worker-{i + 1}"]
+        if WORKER_METRICS_PORT:
+            # У каждого обработчика свой реестр метрик и свой порт
+            cmd += ["--metrics-port", str(WORKER_METRICS_PORT + i)]
+        self.processes[i] = subprocess.Popen(cmd, env=self.env)
+        self.started_at[i] = time.monotonic()
+        print(f"🚀 Обработчик worker-{i + 1} запущен (PID {self.processes[i].pid})")
+
+    def _check(self, i: int):
+        """Перезапускает обработчик i, если он завершился"""
+        process = self.processes[i]
+        now = time.monotonic()
+        if process is not None:
+            if process.poll() is None:
+                if now - self.started_at[i] >= STABLE_UPTIME:
+                    self.restart_delay[i] = RESTART_DELAY_MIN
+                return
+            print(f"💥 Обработчик worker-{i + 1} завершился с кодом {process.returncode}, "
+                  f"перезапуск через {self.restart_delay[i]:.0f} с")
+            self.processes[i] = None
+            self.next_start[i] = now + self.restart_delay[i]
+            if now - self.started_at[i] < STABLE_UPTIME:
+                self.restart_delay[i] = min(self.restart_delay[i] * 2, RESTART_DELAY_MAX)
+            return
+        if now >= self.next_start[i]:
+            self._start(i)
+
+    def run(self):
+        """Запускает обработчики и следит за ними до stop()"""
+        print(f"👷 Запускаем обработчиков: {self.count} "
+              f"(FFmpeg: процессов={self.env.get('FFMPEG_MAX_PROCESSES')}, "
+              f"потоков={self.env.get('FFMPEG_THREADS_PER_JOB')})")
+        try:
+            while not self._stopping:
+                for i in range(self.count):
+                    self._check(i)
+                time.sleep(1)
+        finally:
+            self._terminate()
+
+    def stop(self, *_):
+        self._stopping = True
+
+    def _terminate(self):
+        """SIGTERM обработчикам: задачи в работе возвращаются в очередь"""
+        running = [p for p in self.processes if p is not None and p.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        print("🛑 Обработчики остановлены")
+
+
+def main():
+    cleanup_temp_files()
+    supervisor = WorkerSupervisor(worker_count())
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
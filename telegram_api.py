@@ -0,0 +1,182 @@
+"""
+Отправка уведомлений и видео через Telegram Bot API (веб-приложение и обработчики задач)
+"""
+
+import asyncio
+import os
+from pathlib import Path
+
+import httpx
+
+from config import TELEGRAM_MAX_UPLOAD_SIZE
+from job_store import get_job_store
+from metrics import TELEGRAM_SEND_SECONDS
+from result_cache import hash_file
+from tracing import span
+from video_processor import VideoProcessor
+
+# Общий HTTP клиент процесса: keep-alive и пул соединений на все время работы
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий HTTP клиент приложения"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Закрывает соединения общего HTTP клиента"""
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+async def send_telegram_notification(message: str, chat_id: str = None):
+    """Отправляет уведомление в Telegram"""
+    try:
+        from config import TELEGRAM_BOT_TOKEN
+        
+        if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+            print("⚠️ Telegram токен не настроен, уведомления отключены")
+            return
+        
+        # Если chat_id не указан, используем дефолтный (можно настроить в .env)
+        if not chat_id:
+            chat_id = os.getenv("TELEGRAM_CHAT_ID")
+            if not chat_id:
+                print("⚠️ TELEGRAM_CHAT_ID не настроен, уведомления отключены")
+                return
+        
+        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        data = {
+            "chat_id": chat_id,
+            "text": message,
+            "parse_mode": "HTML"
+        }
+        
+        response = await get_http_client().post(url, json=data, timeout=10)
+        if response.status_code == 200:
+            print(f"✅ Уведомление отправлено в Telegram: {chat_id}")
+        else:
+            print(f"❌ Ошибка отправки в Telegram: {response.status_code}")
+                
+    except Exception as e:
+        print(f"❌ Ошибка при отправке уведомления в Telegram: {e}")
+
+
+async def send_telegram_video(telegram_token: str, user_id: str, file_path: Path, caption: str) -> bool:
+    """
+    Отправляет видео через sendVideo. Если файл с таким содержимым уже
+    загружался, отправляет его file_id вместо повторной загрузки байтов.
+    """
+    url = f"https://api.telegram.org/bot{telegram_token}/sendVideo"
+    data = {'chat_id': user_id, 'caption': caption}
+
+    loop = asyncio.get_running_loop()
+    content_hash = await loop.run_in_executor(None, hash_file, file_path)
+    file_id = get_job_store().get_telegram_file_id(content_hash)
+    if file_id:
+        with TELEGRAM_SEND_SECONDS.labels(method="file_id").time(), span("telegram_send", method="file_id"):
+            response = await get_http_client().post(url, data={**data, 'video': file_id}, timeout=60)
+        if response.status_code == 200:
+            print(f"♻️ {file_path.name} отправлен по file_id без загрузки")
+            return True
+        # file_id мог стать недействительным - загружаем файл заново
+        print(f"⚠️ Telegram не принял file_id для {file_path.name}: {response.text}")
+        get_job_store().forget_telegram_file(content_hash)
+
+    # Передаем открытый файл: httpx читает его частями при отправке,
+    # а не держит все видео в памяти
+    with open(file_path, 'rb') as video_file, TELEGRAM_SEND_SECONDS.labels(method="upload").time(), \
+            span("telegram_send", method="upload", bytes_out=file_path.stat().st_size):
+        files = {
+            'video': (file_path.name, video_file, 'video/mp4')
+        }
+        response = await get_http_client().post(url, files=files, data=data, timeout=300)
+
+    if response.status_code != 200:
+        print(f"❌ Ошибка отправки {file_path.name}: {response.status_code}")
+        print(f"Ответ: {response.text}")
+        return False
+
+    # Telegram может сохранить файл как документ, если не распознал видео
+    message = response.json().get('result', {})
+    media = message.get('video') or message.get('document')
+    if media:
+        get_job_store().save_telegram_file(content_hash, media['file_id'], media.get('file_unique_id'))
+    return True
+
+
+async def send_video_files_to_telegram(result_files, session_id, copies, add_frames, compression):
+    """Отправляет видео файлы напрямую в Telegram"""
+    try:
+        telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
+        
+        if not telegram_token or telegram_token == "YOUR_BOT_TOKEN_HERE":
+            print("⚠️ Telegram токен не настроен, файлы не отправляются")
+            return
+        
+        # Получаем пользователя по сессии
+        user_id = get_job_store().get_session_user(session_id)
+        if not user_id:
+            print(f"⚠️ Пользователь для сессии {session_id} не найден, файлы не отправляются")
+            return
+        
+        print(f"📤 Отправляем файлы пользователю {user_id} для сессии {session_id}")
+        
+        # Отправляем сообщение о начале отправки
+        start_message = f"""
+🎬 <b>Видео обработано!</b>
+
+📁 <b>Сессия:</b> {session_id}
+📊 <b>Создано файлов:</b> {len(result_files)}
+⚙️ <b>Параметры:</b>
+  • Копий: {copies}
+  • Рамки: {'Да' if add_frames else 'Нет'}
+  • Сжатие: {'Да' if compression else 'Нет'}
+
+📤 <b>Отправляю файлы...</b>
+"""
+        
+        # Отправляем начальное сообщение
+        await send_telegram_notification(start_message, user_id)
+        
+        # Отправляем каждый видео файл
+        for i, file_path in enumerate(result_files, 1):
+            try:
+                print(f"📤 Отправляем файл {i}: {file_path}")
+                
+                with span("telegram_delivery", copy=i):
+                    # Bot API не примет файл больше лимита - кодируем его под размер
+                    # до отправки, а не после неудачной загрузки
+                    if file_path.stat().st_size > TELEGRAM_MAX_UPLOAD_SIZE:
+                        print(f"🎯 Файл {i} больше лимита Telegram, кодируем под размер")
+                        file_path = await VideoProcessor().fit_to_size(
+                            file_path,
+                            file_path.with_name(f"telegram_{file_path.name}"),
+                            TELEGRAM_MAX_UPLOAD_SIZE,
+                            session_id
+                        )
+                    
+                    caption = (f"📹 Обработанное видео #{i}\n"
+                               f"Копий: {copies}\n"
+                               f"Рамки: {'Да' if add_frames else 'Нет'}\n"
+                               f"Сжатие: {'Да' if compression else 'Нет'}")
+                    sent = await send_telegram_video(telegram_token, user_id, file_path, caption)
+                if sent:
+                    print(f"✅ Файл {i} отправлен успешно")
+                        
+            except Exception as file_error:
+                print(f"❌ Ошибка при отправке файла {i}: {file_error}")
+        
+        # Отправляем сообщение о завершении
+        completion_message = f"✅ <b>Все файлы отправлены!</b>\n\n📁 Сессия: {session_id}\n📊 Отправлено: {len(result_files)} файлов"
+        await send_telegram_notification(completion_message, user_id)
+        
+    except Exception as e:
+        print(f"❌ Ошибка при отправке видео файлов в Telegram: {e}")
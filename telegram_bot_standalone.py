@@ -15,8 +15,19 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 try:
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
     from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+    from telegram.error import BadRequest, RetryAfter
     from video_processor import VideoProcessor
+    from result_cache import hash_file
+    from media_probe import MediaProbeError
+    from job_store import get_job_store
+    from input_store import get_input_store
+    from config import BOT_METRICS_PORT, MAX_FILE_SIZE, TELEGRAM_MAX_UPLOAD_SIZE
+    from metrics import TELEGRAM_SEND_SECONDS, UPLOAD_BYTES, start_metrics_server
+    from tracing import job_trace, span
+    from telegram_api import close_http_client, get_http_client
     import shutil
+    import tempfile
+    import uuid
 except ImportError as e:
     print(f"❌ Ошибка импорта: {e}")
     print("🔍 Проверьте установку зависимостей")
@@ -28,6 +39,13 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Скачивание видео из Telegram: размер части и таймаут (секунды)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+# Как часто обновлять сообщение с прогрессом обработки (секунды)
+PROGRESS_EDIT_INTERVAL = 3
+
 # Токен бота из переменных окружения
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
@@ -41,6 +59,12 @@ class VideoBot:
     def __init__(self):
         self.processor = None
         self.processing_users = set()
+        # Запущенные задачи обработки по пользователям (для отмены)
+        self.processing_tasks = {}
+        # Задачи бота пишутся в то же хранилище, что и задачи веб-приложения
+        self.job_store = get_job_store()
+        self.job_store.start_background_flush()
+        self.input_store = get_input_store()
     
     def _get_processor(self):
         if self.processor is None:
@@ -92,6 +116,7 @@ class VideoBot:
 /start - Начать работу
 /help - Помощь
 /myid - Показать мой ID
+/cancel - Отменить текущую обработку
         """
         
         await update.message.reply_text(instruction_text)
@@ -155,12 +180,6 @@ class VideoBot:
         
         print(f"📹 Получено видео от пользователя {user_id}")
         
-        # Проверяем, не обрабатывает ли пользователь уже видео
-        if user_id in self.processing_users:
-            print(f"⏳ Пользователь {user_id} уже обрабатывает видео")
-            await update.message.reply_text("⏳ Пожалуйста, дождитесь завершения текущей обработки!")
-            return
-        
         # Проверяем размер файла
         video = update.message.video
         print(f"📹 Информация о видео: размер={video.file_size}, длительность={video.duration}")
@@ -170,23 +189,15 @@ class VideoBot:
             await update.message.reply_text("❌ Размер файла превышает 50MB!")
             return
         
+        # Новое видео заменяет текущую обработку пользователя
+        if await self._cancel_processing(user_id):
+            await update.message.reply_text("🛑 Предыдущая обработка отменена, беру новое видео")
+        
         self.processing_users.add(user_id)
         
         try:
-            # Отправляем сообщение о начале обработки
-            processing_msg = await update.message.reply_text("🔄 Начинаю обработку видео...")
-            
-            # Скачиваем видео
-            file = await context.bot.get_file(video.file_id)
-            
-            # Создаем временную папку для пользователя
-            temp_dir = Path(f"temp_{user_id}")
-            temp_dir.mkdir(exist_ok=True)
-            
-            input_path = temp_dir / f"input_{video.file_id}.mp4"
-            await file.download_to_drive(input_path)
-            
-            # Создаем клавиатуру для выбора параметров
+            # Создаем клавиатуру для выбора параметров. Само видео скачивается
+            # только по кнопке "Обработать": брошенные сессии не тратят трафик и диск
             keyboard = [
                 [InlineKeyboardButton("📊 Копии: 1", callback_data="copies_1")],
                 [InlineKeyboardButton("📊 Копии: 2", callback_data="copies_2")],
@@ -199,27 +210,54 @@ class VideoBot:
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await processing_msg.edit_text(
+            await update.message.reply_text(
                 "⚙️ Выберите параметры обработки:",
                 reply_markup=reply_markup
             )
             
-            # Сохраняем путь к файлу в контексте
-            context.user_data['video_path'] = str(input_path)
-            context.user_data['temp_dir'] = str(temp_dir)
+            # Сохраняем данные файла в контексте
+            context.user_data['file_id'] = video.file_id
+            context.user_data['file_unique_id'] = video.file_unique_id
             context.user_data['copies'] = 1
             context.user_data['add_frames'] = False
             context.user_data['compression'] = False
+            context.user_data['duration'] = video.duration
             
             print(f"💾 Сохранены данные пользователя {user_id}:")
-            print(f"  📁 Путь к видео: {input_path}")
-            print(f"  📁 Временная папка: {temp_dir}")
+            print(f"  🆔 Файл: {video.file_unique_id}")
             print(f"  ⚙️ Параметры по умолчанию: копии=1, рамки=False, сжатие=False")
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка при обработке видео: {str(e)}")
             self.processing_users.discard(user_id)
     
+    async def _fetch_input(self, bot, user_data) -> Path:
+        """
+        Путь к исходному видео в хранилище исходников. Из Telegram файл
+        скачивается, только если такое содержимое еще не сохранено; запись
+        идет потоком прямо в хранилище с подсчетом хэша.
+        """
+        file_unique_id = user_data['file_unique_id']
+        content_hash = self.job_store.get_content_hash(file_unique_id)
+        if content_hash:
+            path = self.input_store.find(content_hash)
+            if path is not None:
+                print(f"♻️ Видео {file_unique_id} уже в хранилище, не скачиваем")
+                return path
+        
+        tg_file = await bot.get_file(user_data['file_id'])
+        suffix = Path(tg_file.file_path).suffix.lower() or ".mp4"
+        # Общий клиент процесса (пул соединений), таймаут скачивания - на запрос
+        client = get_http_client()
+        async with client.stream("GET", tg_file.file_path, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            content_hash, path, size = await self.input_store.save_stream(
+                response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), suffix, MAX_FILE_SIZE
+            )
+        UPLOAD_BYTES.labels(source="telegram").observe(size)
+        self.job_store.save_telegram_file(content_hash, user_data['file_id'], file_unique_id)
+        return path
+    
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
         query = update.callback_query
@@ -256,7 +294,36 @@ class VideoBot:
             await query.edit_message_reply_markup(reply_markup=reply_markup)
             
         elif data.startswith("process_"):
-            await self._process_video(query, context)
+            if user_id in self.processing_tasks:
+                print(f"⏳ Пользователь {user_id} уже обрабатывает видео")
+                return
+            # Обработка идет отдельной задачей, чтобы бот отвечал на /cancel
+            task = context.application.create_task(self._process_video(query, context), update=update)
+            self.processing_tasks[user_id] = task
+            task.add_done_callback(lambda _: self.processing_tasks.pop(user_id, None))
+            
+        elif data == "cancel_job":
+            if not await self._cancel_processing(user_id):
+                await query.edit_message_text("ℹ️ Нет активной обработки")
+    
+    async def _cancel_processing(self, user_id) -> bool:
+        """Отменяет обработку пользователя и ждет, пока FFmpeg будет остановлен"""
+        task = self.processing_tasks.get(user_id)
+        if task is None or task.done():
+            return False
+        
+        print(f"🛑 Отменяем обработку пользователя {user_id}")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+    
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /cancel"""
+        user_id = update.effective_user.id
+        if await self._cancel_processing(user_id):
+            await update.message.reply_text("🛑 Обработка отменена")
+        else:
+            await update.message.reply_text("ℹ️ Нет активной обработки")
     
     def _create_keyboard(self, user_data):
         """Создает клавиатуру с текущими настройками"""
@@ -292,73 +359,210 @@ class VideoBot:
         
         return keyboard
     
+    async def _send_video(self, message, path: Path, caption: str):
+        """
+        Отправляет видео в ответ на сообщение. Файл с уже загруженным
+        содержимым отправляется по file_id без повторной загрузки.
+        """
+        loop = asyncio.get_running_loop()
+        content_hash = await loop.run_in_executor(None, hash_file, path)
+        file_id = self.job_store.get_telegram_file_id(content_hash)
+        if file_id:
+            try:
+                with TELEGRAM_SEND_SECONDS.labels(method="file_id").time(), span("telegram_send", method="file_id"):
+                    await message.reply_video(video=file_id, caption=caption)
+                print(f"♻️ {path.name} отправлен по file_id без загрузки")
+                return
+            except BadRequest as e:
+                # file_id мог стать недействительным - загружаем файл заново
+                print(f"⚠️ Telegram не принял file_id для {path.name}: {e}")
+                self.job_store.forget_telegram_file(content_hash)
+
+        with open(path, 'rb') as video_file, TELEGRAM_SEND_SECONDS.labels(method="upload").time(), \
+                span("telegram_send", method="upload", bytes_out=path.stat().st_size):
+            sent = await message.reply_video(video=video_file, caption=caption)
+        # Telegram может сохранить файл как документ, если не распознал видео
+        media = sent.video or sent.document
+        if media:
+            self.job_store.save_telegram_file(content_hash, media.file_id, media.file_unique_id)
+    
+    @staticmethod
+    def _progress_text(state: dict, copies: int, duration) -> str:
+        """Текст сообщения о ходе обработки"""
+        progress = state["progress"]
+        text = "🔄 Обрабатываю видео..."
+        if progress.get('copy'):
+            text += f"\n🎞️ Копия {progress['copy']} из {copies}"
+        if progress.get('segment'):
+            text += f", сегмент {progress['segment']} из {progress['segments']}"
+        if duration and progress.get('out_time_seconds') and not progress.get('segment'):
+            percent = min(100, int(progress['out_time_seconds'] * 100 / duration))
+            text += f"\n📊 {percent}%"
+        if progress.get('speed'):
+            text += f" (скорость {progress['speed']:.1f}x)"
+        if state["sent"]:
+            text += f"\n📤 Отправлено: {state['sent']} из {copies}"
+        return text
+    
+    async def _edit_progress(self, query, state: dict, copies: int, duration, reply_markup):
+        """
+        Обновляет сообщение с прогрессом не чаще раза в PROGRESS_EDIT_INTERVAL секунд:
+        Telegram ограничивает частоту редактирования сообщений
+        """
+        last_text = None
+        while True:
+            await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+            text = self._progress_text(state, copies, duration)
+            if text == last_text:
+                continue
+            try:
+                await query.edit_message_text(text, reply_markup=reply_markup)
+                last_text = text
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                print(f"⚠️ Не удалось обновить прогресс: {e}")
+    
     async def _process_video(self, query, context):
         """Обрабатывает видео с выбранными параметрами"""
         user_id = query.from_user.id
+        temp_dir = Path(tempfile.mkdtemp(prefix=f"videobot_{user_id}_"))
+        session_id = f"telegram_{user_id}"
+        job_id = f"{session_id}_{uuid.uuid4().hex[:8]}"
         
         print(f"🎬 Начинаем обработку видео для пользователя {user_id}")
-        
-        try:
-            await query.edit_message_text("🔄 Обрабатываю видео...")
-            
-            video_path = Path(context.user_data['video_path'])
-            temp_dir = Path(context.user_data['temp_dir'])
-            copies = context.user_data['copies']
-            add_frames = context.user_data['add_frames']
-            compression = context.user_data['compression']
-            
-            print(f"📁 Путь к видео: {video_path}")
-            print(f"📁 Временная папка: {temp_dir}")
-            print(f"⚙️ Параметры: копии={copies}, рамки={add_frames}, сжатие={compression}")
-            
-            # Создаем папку для результатов
-            result_dir = temp_dir / "results"
-            result_dir.mkdir(exist_ok=True)
-            print(f"📁 Папка результатов: {result_dir}")
-            
-            # Обрабатываем видео
-            print("🔄 Начинаем обработку видео...")
-            processor = self._get_processor()
-            result_files = await processor.process_video(
-                input_path=video_path,
-                output_dir=result_dir,
-                copies=copies,
-                compression=compression,
-                add_frames=add_frames
-            )
-            print(f"✅ Обработка завершена. Получено {len(result_files)} файлов")
-            
-            # Отправляем обработанные видео
-            print(f"📤 Отправляем {len(result_files)} файлов пользователю {user_id}")
-            for i, file_path in enumerate(result_files):
-                print(f"📤 Отправляем файл {i+1}: {file_path}")
+        self.job_store.link_session(session_id, str(user_id))
+        self.job_store.create_job(job_id, session_id, str(user_id), {
+            "copies": context.user_data.get('copies'),
+            "compression": context.user_data.get('compression'),
+            "add_frames": context.user_data.get('add_frames'),
+        }, source="telegram")
+        
+        # Итоги копий: готова или нет, каким способом, с какой попытки
+        copy_statuses = []
+        with job_trace(job_id):
+            try:
+                cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data="cancel_job")]])
+                await query.edit_message_text("📥 Получаю видео...", reply_markup=cancel_markup)
+                with span("fetch_input") as fetch_span:
+                    video_path = await self._fetch_input(context.bot, context.user_data)
+                    fetch_span["bytes_in"] = video_path.stat().st_size
+                await query.edit_message_text("🔄 Обрабатываю видео...", reply_markup=cancel_markup)
+                
+                copies = context.user_data['copies']
+                add_frames = context.user_data['add_frames']
+                compression = context.user_data['compression']
+                
+                print(f"📁 Путь к видео: {video_path}")
+                print(f"📁 Временная папка: {temp_dir}")
+                print(f"⚙️ Параметры: копии={copies}, рамки={add_frames}, сжатие={compression}")
+                
+                # Создаем папку для результатов
+                result_dir = temp_dir / "results"
+                result_dir.mkdir(exist_ok=True)
+                print(f"📁 Папка результатов: {result_dir}")
+                
+                # Обрабатываем видео и отправляем каждую копию, как только она готова
+                print("🔄 Начинаем обработку видео...")
+                processor = self._get_processor()
+                self.job_store.update_job(job_id, status="processing", message="Обрабатываем видео...")
+                
+                state = {"progress": {}, "sent": 0}
+                
+                def on_progress(progress: dict):
+                    self.job_store.update_progress(job_id, progress)
+                    state["progress"] = progress
+                
+                updater = asyncio.create_task(self._edit_progress(
+                    query, state, copies, context.user_data.get('duration'), cancel_markup
+                ))
                 try:
-                    with open(file_path, 'rb') as video_file:
-                        await query.message.reply_video(
-                            video=video_file,
-                            caption=f"📹 Обработанное видео #{i+1}\n"
-                                   f"Копий: {copies}\n"
-                                   f"Рамки: {'Да' if add_frames else 'Нет'}\n"
-                                   f"Сжатие: {'Да' if compression else 'Нет'}"
-                        )
-                    print(f"✅ Файл {i+1} отправлен успешно")
-                except Exception as send_error:
-                    print(f"❌ Ошибка при отправке файла {i+1}: {send_error}")
-                    await query.message.reply_text(f"❌ Ошибка при отправке видео #{i+1}: {str(send_error)}")
+                    async for result in processor.iter_process_video(
+                        input_path=video_path,
+                        output_dir=result_dir,
+                        copies=copies,
+                        compression=compression,
+                        add_frames=add_frames,
+                        session_id=session_id,
+                        progress_callback=on_progress,
+                        # reply_video не примет файл больше лимита Bot API
+                        max_output_size=TELEGRAM_MAX_UPLOAD_SIZE,
+                        status_callback=copy_statuses.append
+                    ):
+                        print(f"📤 Отправляем копию {result.copy_num}: {result.path}")
+                        try:
+                            with span("telegram_delivery", copy=result.copy_num):
+                                await self._send_video(
+                                    query.message,
+                                    result.path,
+                                    caption=f"📹 Обработанное видео #{result.copy_num}\n"
+                                           f"Копий: {copies}\n"
+                                           f"Рамки: {'Да' if add_frames else 'Нет'}\n"
+                                           f"Сжатие: {'Да' if compression else 'Нет'}"
+                                )
+                            state["sent"] += 1
+                            print(f"✅ Копия {result.copy_num} отправлена успешно")
+                        except Exception as send_error:
+                            print(f"❌ Ошибка при отправке копии {result.copy_num}: {send_error}")
+                            await query.message.reply_text(
+                                f"❌ Ошибка при отправке видео #{result.copy_num}: {str(send_error)}"
+                            )
+                finally:
+                    updater.cancel()
+                print(f"✅ Обработка завершена. Отправлено {state['sent']} файлов")
+                
+                failed = [status.copy_num for status in copy_statuses if not status.ok]
+                created = len(copy_statuses) - len(failed)
+                self.job_store.update_job(
+                    job_id,
+                    status="done",
+                    message=f"Видео успешно обработано. Создано {created} файлов, отправлено {state['sent']}.",
+                    copy_results=[status.to_dict() for status in copy_statuses]
+                )
+                if failed:
+                    # Неудавшиеся копии не подменяются исходником - сообщаем о них
+                    await query.edit_message_text(
+                        f"⚠️ Видео обработано частично: не удалось создать копии "
+                        f"{', '.join(f'#{num}' for num in failed)}. "
+                        f"Отправлено {state['sent']} из {created} готовых."
+                    )
+                elif state["sent"] < created:
+                    # Об ошибке отправки каждой копии пользователь уже получил сообщение
+                    await query.edit_message_text(
+                        f"⚠️ Видео обработано, но отправлено только {state['sent']} из {created} копий"
+                    )
+                else:
+                    await query.edit_message_text("✅ Видео успешно обработано и отправлено!")
+                
+            except asyncio.CancelledError:
+                print(f"🛑 Обработка пользователя {user_id} отменена")
+                self.job_store.update_job(job_id, status="cancelled", message="Обработка отменена")
+                try:
+                    await query.edit_message_text("🛑 Обработка отменена")
+                except Exception:
+                    pass
+                raise
             
-            await query.edit_message_text("✅ Видео успешно обработано и отправлено!")
+            except MediaProbeError as e:
+                print(f"❌ Видео пользователя {user_id} не поддерживается: {e}")
+                self.job_store.update_job(job_id, status="failed", message="Видео не поддерживается", error=str(e))
+                await query.edit_message_text(f"❌ Видео не поддерживается: {e}")
             
-        except Exception as e:
-            await query.edit_message_text(f"❌ Ошибка при обработке: {str(e)}")
-        
-        finally:
-            # Очищаем временные файлы
-            try:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            except:
-                pass
+            except Exception as e:
+                self.job_store.update_job(
+                    job_id, status="failed", message="Ошибка обработки видео", error=str(e),
+                    copy_results=[status.to_dict() for status in copy_statuses]
+                )
+                await query.edit_message_text(f"❌ Ошибка при обработке: {str(e)}")
             
-            self.processing_users.discard(user_id)
+            finally:
+                # Очищаем временные файлы
+                try:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                except:
+                    pass
+                
+                self.processing_users.discard(user_id)
 
 async def main():
     """Запуск бота"""
@@ -372,14 +576,18 @@ async def main():
     
     try:
         bot = VideoBot()
+        if BOT_METRICS_PORT:
+            # Тот же реестр метрик, что и у обработчиков, на отдельном порту
+            start_metrics_server(BOT_METRICS_PORT)
         application = Application.builder().token(BOT_TOKEN).build()
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", bot.start))
         application.add_handler(CommandHandler("help", bot.help))
         application.add_handler(CommandHandler("myid", bot.myid))
+        application.add_handler(CommandHandler("cancel", bot.cancel))
         application.add_handler(MessageHandler(filters.VIDEO, bot.handle_video))
-        application.add_handler(CallbackQueryHandler(bot.button_callback))
+        application.add_handler(CallbackQueryHandler(bot.button_callback, pattern=r"^copy_id_"))
         application.add_handler(CallbackQueryHandler(bot.handle_callback))
         
         print("🤖 Telegram бот запущен!")
@@ -402,6 +610,9 @@ async def main():
         print("🔍 Проверьте правильность токена и интернет-соединение")
         import traceback
         traceback.print_exc()
+    
+    finally:
+        await close_http_client()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,61 @@
+"""
+Регрессионные тесты GET /download: запрос не должен выходить за пределы RESULT_DIR
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    from fastapi.testclient import TestClient
+
+    # Приложение создает каталоги и базу относительно рабочего каталога
+    work_dir = tmp_path_factory.mktemp("app")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    os.environ["JOB_STORE_PATH"] = str(work_dir / "test.db")
+    os.environ["INPUT_STORE_DIR"] = str(work_dir / "input_store")
+    os.environ["TRACE_DIR"] = str(work_dir / "traces")
+    os.environ["EMBEDDED_WORKER"] = "false"
+    try:
+        import main
+
+        (work_dir / "secret.txt").write_text("secret", encoding="utf-8")
+        session_dir = main.RESULT_DIR / "session"
+        session_dir.mkdir()
+        (session_dir / "processed_copy_1_video.mp4").write_bytes(b"video")
+        yield TestClient(main.app)
+    finally:
+        os.chdir(cwd)
+
+
+def test_download_result(client):
+    response = client.get("/download/session/processed_copy_1_video.mp4")
+    assert response.status_code == 200
+    assert response.content == b"video"
+
+
+@pytest.mark.parametrize("path", [
+    "/download/%2E%2E/secret.txt",
+    "/download/%2e%2e/secret.txt",
+    "/download/session/%2E%2E%2F%2E%2E%2Fsecret.txt",
+])
+def test_download_rejects_traversal(client, path):
+    response = client.get(path)
+    assert response.status_code == 404
+    assert b"secret" not in response.content
+
+
+def test_cleanup_rejects_traversal(client):
+    response = client.delete("/cleanup/%2E%2E")
+    assert response.status_code == 404
+    assert Path("secret.txt").exists()
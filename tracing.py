@@ -0,0 +1,151 @@
+"""
+Трассировка задач: этапы обработки (спаны) пишутся JSON-строками в TRACE_DIR/<job_id>.jsonl
+
+Текущая задача и спан хранятся в contextvars, поэтому спаны из планировщика FFmpeg,
+процессора и фоновой отправки в Telegram сами попадают в трассировку своей задачи:
+asyncio копирует контекст в каждую создаваемую задачу.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import List, Optional
+
+from config import TRACE_DIR
+
+# Атрибуты, которые дочерние спаны наследуют от родителя (этап FFmpeg внутри копии)
+INHERITED_ATTRS = ("copy",)
+
+_current_trace: ContextVar[Optional["JobTrace"]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[dict]] = ContextVar("current_span", default=None)
+
+# Идентификаторы спанов уникальны в пределах процесса, pid делает их уникальными в файле
+_span_ids = itertools.count(1)
+
+
+class JobTrace:
+    """Файл трассировки задачи; одну задачу пишут веб-приложение (загрузка) и обработчик"""
+
+    def __init__(self, job_id: str, trace_dir: Path = Path(TRACE_DIR)):
+        self.job_id = job_id
+        self.path = trace_dir / f"{job_id}.jsonl"
+        trace_dir.mkdir(parents=True, exist_ok=True)
+
+    def write(self, record: dict):
+        # Одна запись O_APPEND на строку: строки разных процессов не перемешиваются
+        line = json.dumps({"job_id": self.job_id, "pid": os.getpid(), **record}, ensure_ascii=False, default=str)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, (line + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def record(self, name: str, start: float, duration: float, **attrs):
+        """Спан, измеренный не через span() (например, ожидание в очереди по created_at)"""
+        parent = _current_span.get()
+        self.write({
+            "span": name,
+            "span_id": f"{os.getpid()}-{next(_span_ids)}",
+            "parent_id": parent["span_id"] if parent else None,
+            "start": round(start, 6),
+            "duration": round(duration, 6),
+            "status": "ok",
+            **attrs,
+        })
+
+
+@contextmanager
+def job_trace(job_id: str):
+    """Делает трассировку задачи текущей для блока (и задач, созданных внутри него)"""
+    trace_token = _current_trace.set(JobTrace(job_id))
+    span_token = _current_span.set(None)
+    try:
+        yield _current_trace.get()
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Спан этапа текущей задачи. Отдает словарь атрибутов, который можно дополнить
+    по ходу этапа (bytes_out, speed). Без текущей задачи ничего не пишет.
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    if parent is not None:
+        for key in INHERITED_ATTRS:
+            if key in parent["attrs"] and key not in attrs:
+                attrs[key] = parent["attrs"][key]
+    if trace is None:
+        yield attrs
+        return
+
+    current = {"span_id": f"{os.getpid()}-{next(_span_ids)}", "attrs": attrs}
+    token = _current_span.set(current)
+    start = time.time()
+    started = time.perf_counter()
+    status, error = "ok", None
+    try:
+        yield attrs
+    except BaseException as e:
+        # Отмена задачи - не ошибка этапа
+        status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+        error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        record = {
+            "span": name,
+            "span_id": current["span_id"],
+            "parent_id": parent["span_id"] if parent else None,
+            "start": round(start, 6),
+            "duration": round(time.perf_counter() - started, 6),
+            "status": status,
+            **attrs,
+        }
+        if error is not None:
+            record["error"] = error
+        try:
+            trace.write(record)
+        except OSError as e:
+            print(f"⚠️ Не удалось записать трассировку {trace.job_id}: {e}")
+
+
+def read_trace(job_id: str, trace_dir: Path = Path(TRACE_DIR)) -> Optional[List[dict]]:
+    """Спаны задачи по времени начала; None, если трассировки нет"""
+    path = trace_dir / f"{job_id}.jsonl"
+    if not path.is_file():
+        return None
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                # Строка, которую процесс не успел дописать
+                continue
+    spans.sort(key=lambda record: record.get("start", 0))
+    return spans
+
+
+def purge_traces(ttl_seconds: int, trace_dir: Path = Path(TRACE_DIR)) -> int:
+    """Удаляет трассировки старше ttl_seconds, возвращает число удаленных"""
+    if not trace_dir.is_dir():
+        return 0
+    deadline = time.time() - ttl_seconds
+    removed = 0
+    for path in trace_dir.glob("*.jsonl"):
+        try:
+            if path.stat().st_mtime < deadline:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    return removed
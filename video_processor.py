@@ -1,10 +1,24 @@
 import asyncio
 import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from dataclasses import dataclass, replace
+import hashlib
 import os
 import shutil
-import random
+
+from config import FFMPEG_MAX_PROCESSES, FFMPEG_THREADS_PER_JOB, SEGMENT_PARALLEL_MIN_DURATION
+from ffmpeg_runner import FFmpegResult, FFmpegTimeout, ProgressCallback, run_ffmpeg
+from metrics import ENCODE_SECONDS, ENCODE_SPEED, FALLBACKS, FFMPEG_FAILURES, JOBS_IN_FLIGHT, QUEUE_WAIT_SECONDS
+from encoder_profiles import EncodingProfile, select_profile, target_size_profile
+from media_probe import FFPROBE_AVAILABLE, MediaInfo, MediaProbeError, probe_media_async
+from output_verifier import OutputVerificationError, moov_before_mdat, verify_output
+from result_cache import get_result_cache, hash_file, link_or_copy, make_cache_key
+from tracing import span
 
 # Попытка импорта ffmpeg-python
 try:
@@ -15,11 +29,239 @@ except ImportError:
     FFMPEG_AVAILABLE = False
     print("ffmpeg-python не установлен")
 
+# Цвета рамок: только базовые цвета, которые точно поддерживаются FFmpeg
+BORDER_COLORS = ['red', 'green', 'blue', 'yellow', 'purple', 'orange', 'pink', 'cyan', 'magenta', 'lime']
+
+
+def pick_border_colors(seed: str, copies: int) -> List[str]:
+    """
+    Детерминированно выбирает разные цвета рамок для копий.
+    Одинаковый вход дает одинаковые цвета, поэтому результат можно кэшировать.
+    """
+    start = int(hashlib.sha256(seed.encode('utf-8')).hexdigest(), 16) % len(BORDER_COLORS)
+    return [BORDER_COLORS[(start + i) % len(BORDER_COLORS)] for i in range(copies)]
+
+
+# Таймауты FFmpeg: ожидаемое время по длительности и скорости кодирования,
+# умноженное на запас, в пределах [MIN, MAX]
+FFMPEG_TIMEOUT_FACTOR = 4.0
+FFMPEG_MIN_TIMEOUT = 60
+FFMPEG_MAX_TIMEOUT = 3600
+FFMPEG_DEFAULT_TIMEOUT = 300  # Если длительность неизвестна
+
+# Режим целевого размера: два прохода только для роликов не длиннее этого,
+# для длинных - один проход ABR, чтобы не удваивать время кодирования
+TARGET_SIZE_TWO_PASS_MAX_DURATION = 600
+# Сколько раз перекодировать копию с меньшим битрейтом, если она не уложилась
+TARGET_SIZE_MAX_ATTEMPTS = 3
+
+# Сегментное кодирование: минимальная длина сегмента и сегментов на слот FFmpeg
+# (больше сегментов - ровнее загрузка, но больше ключевых кадров на стыках)
+SEGMENT_MIN_SECONDS = 10
+SEGMENTS_PER_SLOT = 2
+# Допустимое расхождение видео и аудио после склейки, секунды
+SEGMENT_SYNC_TOLERANCE = 0.1
+
+# Пресет последней попытки копии: быстрее, поэтому укладывается в таймаут,
+# если предыдущие попытки не успели
+RETRY_PRESET = 'ultrafast'
+
+
+@dataclass(frozen=True)
+class CopyResult:
+    """Готовая копия, которую iter_process_video отдает, не дожидаясь остальных"""
+    copy_num: int
+    copies: int
+    path: Path
+
+
+@dataclass(frozen=True)
+class CopyStatus:
+    """Итог обработки копии: готова (ok) или нет (failed), каким способом и с какой попытки"""
+    copy_num: int
+    status: str
+    path: Optional[Path]
+    strategy: str
+    attempts: int = 1
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "ok"
+
+    def to_dict(self) -> dict:
+        return {
+            "copy": self.copy_num,
+            "status": self.status,
+            "strategy": self.strategy,
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+
+
+# Вызывается с (индекс копии, путь), когда копия готова
+CopyCallback = Callable[[int, Path], None]
+# Вызывается с итогом каждой копии, когда обработка закончена
+StatusCallback = Callable[[CopyStatus], None]
+
+
+def border_filter(frame_filter: str, border_color: str) -> str:
+    """Фильтр рамки: pad - рамка вокруг кадра, drawbox - поверх краев кадра (размер не меняется)"""
+    if frame_filter == "drawbox":
+        return f'drawbox=x=0:y=0:w=iw:h=ih:color={border_color}:t=30'
+    return f'pad=iw+60:ih+60:30:30:{border_color}'
+
+
+def short_error(error: Exception) -> str:
+    """Последняя строка ошибки (у ошибок FFmpeg - хвост stderr) для итогов копий"""
+    lines = [line for line in str(error).splitlines() if line.strip()]
+    return lines[-1].strip()[:300] if lines else type(error).__name__
+
+
+class EncodeSpeedEstimate:
+    """Скользящая оценка скорости кодирования одного выхода (x реального времени)"""
+    
+    def __init__(self, initial: float = 1.0, alpha: float = 0.3):
+        self.value = initial
+        self.alpha = alpha
+        self._lock = threading.Lock()
+    
+    def update(self, speed: float):
+        if speed <= 0:
+            return
+        with self._lock:
+            self.value = self.alpha * speed + (1 - self.alpha) * self.value
+
+
+encode_speed = EncodeSpeedEstimate()
+
+
+class EncodeScheduler:
+    """
+    Очередь задач FFmpeg с ограничением числа одновременных процессов на хосте.
+    
+    Слоты раздаются по кругу между сессиями (внутри сессии - FIFO),
+    поэтому одна сессия с тремя копиями не блокирует остальных пользователей.
+    """
+    
+    def __init__(self, max_processes: int = 0, threads_per_job: int = 0):
+        cores = os.cpu_count() or 1
+        # По умолчанию: один процесс libx264 на каждые два ядра
+        self.max_processes = max_processes or max(1, cores // 2)
+        self.threads_per_job = threads_per_job or max(1, cores // self.max_processes)
+        self._running = 0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        
+        # Метрики
+        self.jobs_total = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        
+        print(f"🔧 Планировщик FFmpeg: процессов={self.max_processes}, потоков на задачу={self.threads_per_job}")
+    
+    def free_slots(self) -> int:
+        """Сколько задач можно запустить прямо сейчас без ожидания в очереди"""
+        if self._queues:
+            return 0
+        return max(0, self.max_processes - self._running)
+    
+    def queue_depth(self) -> int:
+        """Количество задач, ожидающих слот"""
+        return sum(len(queue) for queue in self._queues.values())
+    
+    def stats(self) -> dict:
+        """Метрики очереди: глубина, занятость и время ожидания"""
+        return {
+            "max_processes": self.max_processes,
+            "threads_per_job": self.threads_per_job,
+            "running": self._running,
+            "queue_depth": self.queue_depth(),
+            "sessions_waiting": len(self._queues),
+            "jobs_total": self.jobs_total,
+            "wait_avg": self.wait_total / self.jobs_total if self.jobs_total else 0.0,
+            "wait_max": self.wait_max,
+        }
+    
+    async def _acquire(self, session_id: str):
+        """Ждет свободный слот для сессии"""
+        if self._running < self.max_processes and not self._queues:
+            self._running += 1
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(session_id, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже был передан нам - возвращаем его
+                self._release()
+            else:
+                queue = self._queues.get(session_id)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[session_id]
+            raise
+    
+    def _release(self):
+        """Передает освободившийся слот следующей сессии по кругу"""
+        while self._queues:
+            session_id, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            if not waiter.done():
+                # Слот переходит к ожидающему, счетчик занятых не меняется
+                waiter.set_result(None)
+                return
+        self._running -= 1
+    
+    async def run(self, session_id: str, func, *args):
+        """
+        Выполняет корутину func(*args), заняв слот. Планировщик только ограничивает
+        число одновременных процессов: FFmpeg запускается через asyncio, без потоков,
+        а отмена корутины убивает процесс и освобождает слот.
+        """
+        queued_at = time.monotonic()
+        await self._acquire(session_id)
+        
+        wait = time.monotonic() - queued_at
+        QUEUE_WAIT_SECONDS.labels(queue="ffmpeg").observe(wait)
+        self.jobs_total += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        if wait > 0.1:
+            print(f"⏳ Задача сессии {session_id} ждала слот {wait:.1f} с (в очереди: {self.queue_depth()})")
+        
+        # Этап для метрик - имя функции без префикса: _run_single_pass -> single_pass
+        stage = func.__name__.removeprefix('_run_')
+        try:
+            with ENCODE_SECONDS.labels(stage=stage).time(), span(stage, queue_wait=round(wait, 3)):
+                return await func(*args)
+        finally:
+            self._release()
+
+
+_encode_scheduler: Optional[EncodeScheduler] = None
+
+
+def get_encode_scheduler() -> EncodeScheduler:
+    """Общий для процесса планировщик FFmpeg"""
+    global _encode_scheduler
+    if _encode_scheduler is None:
+        _encode_scheduler = EncodeScheduler(FFMPEG_MAX_PROCESSES, FFMPEG_THREADS_PER_JOB)
+    return _encode_scheduler
+
+
 class VideoProcessor:
     """Класс для обработки видео с различными параметрами"""
     
     def __init__(self):
         self.supported_formats = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv']
+        self.scheduler = get_encode_scheduler()
         
         # Создаем локальную папку для временных файлов
         self.temp_dir = Path("temp_processing")
@@ -66,7 +308,15 @@ class VideoProcessor:
         output_dir: Path,
         copies: int = 1,
         compression: bool = False,
-        add_frames: bool = False
+        add_frames: bool = False,
+        single_pass: bool = True,
+        session_id: str = "default",
+        progress_callback: Optional[ProgressCallback] = None,
+        profile_name: Optional[str] = None,
+        max_output_size: Optional[int] = None,
+        segmented: Optional[bool] = None,
+        copy_callback: Optional[CopyCallback] = None,
+        status_callback: Optional[StatusCallback] = None
     ) -> List[Path]:
         """
         Обрабатывает видео согласно заданным параметрам
@@ -77,251 +327,1021 @@ class VideoProcessor:
             copies: Количество копий (1-3)
             compression: Включить сжатие
             add_frames: Добавить рамки для уникализации
+            single_pass: Один процесс FFmpeg на все копии (одно декодирование)
+            session_id: Сессия, от имени которой задачи ставятся в очередь FFmpeg
+            progress_callback: Вызывается в цикле событий (не из отдельного потока)
+                с данными прогресса FFmpeg (frame, fps, out_time, speed, copy, copies);
+                не должен блокировать
+            profile_name: Профиль кодирования (fast, balanced, small); по умолчанию
+                выбирается по сжатию и параметрам входа
+            max_output_size: Максимальный размер каждой копии в байтах (например,
+                лимит Telegram); копии, которые не укладываются, кодируются под размер
+            segmented: Кодировать сегменты ролика параллельно; None - автоматически
+                для роликов не короче SEGMENT_PARALLEL_MIN_DURATION
+            copy_callback: Вызывается с (индекс, путь), как только копия готова,
+                не дожидаясь остальных (при кодировании по копиям)
+            status_callback: Вызывается с CopyStatus каждой копии по окончании
+                обработки, в том числе когда не удалась ни одна копия
         
         Returns:
-            Список путей к обработанным файлам
+            Пути к готовым копиям, прошедшим проверку. Копии, которые не удалось
+            создать, в список не попадают (их итог - в status_callback)
+        
+        Raises:
+            MediaProbeError: Файл поврежден или не поддерживается
+            ValueError: Неизвестный профиль кодирования или видео не уместить в max_output_size
+            Exception: Не удалось создать ни одной копии
         """
         print(f"Начинаем обработку видео: {input_path}")
-        print(f"Параметры: копии={copies}, сжатие={compression}, рамки={add_frames}")
+        print(f"Параметры: копии={copies}, сжатие={compression}, рамки={add_frames}, один проход={single_pass}")
         print(f"FFmpeg доступен: {FFMPEG_AVAILABLE}")
         
-        result_files = []
+        output_paths = [
+            output_dir / f"processed_copy_{i+1}_{input_path.stem}.mp4"
+            for i in range(copies)
+        ]
+        try:
+            with JOBS_IN_FLIGHT.track_inprogress():
+                statuses = await self._process_video(
+                    input_path, output_paths, profile_name, compression, add_frames,
+                    single_pass, session_id, progress_callback, max_output_size, segmented,
+                    copy_callback
+                )
+        except asyncio.CancelledError:
+            # Отмененная задача не должна оставлять частично записанные файлы
+            print(f"🛑 Обработка {input_path.name} отменена, удаляем незавершенные копии")
+            for output_path in output_paths:
+                output_path.unlink(missing_ok=True)
+            raise
         
-        for i in range(copies):
-            output_filename = f"processed_copy_{i+1}_{input_path.stem}.mp4"
-            output_path = output_dir / output_filename
-            
-            print(f"Обрабатываем копию {i+1}: {output_filename}")
-            
-            try:
-                if add_frames:
-                    print(f"Добавляем рамки к копии {i+1}")
-                    await self._add_frames_ffmpeg(input_path, output_path, i+1)
-                else:
-                    print(f"Копируем без рамок копию {i+1}")
-                    await self._copy_video_ffmpeg(input_path, output_path)
-                
-                # Применяем сжатие если нужно
-                if compression:
-                    print(f"Сжимаем копию {i+1}")
-                    compressed_path = output_dir / f"compressed_{output_filename}"
-                    await self._compress_video_ffmpeg(output_path, compressed_path)
-                    # Заменяем оригинальный файл сжатой версией
-                    output_path.unlink()
-                    compressed_path.rename(output_path)
-                
-                result_files.append(output_path)
-                print(f"Копия {i+1} готова: {output_path}")
+        if status_callback is not None:
+            for status in statuses:
+                status_callback(status)
+        failed = [status for status in statuses if not status.ok]
+        if len(failed) == len(statuses):
+            raise Exception("Не удалось создать ни одной копии: " + "; ".join(
+                f"копия {status.copy_num}: {status.error}" for status in failed
+            ))
+        if failed:
+            print(f"⚠️ Не созданы копии {[status.copy_num for status in failed]}, "
+                  f"готово {len(statuses) - len(failed)} из {len(statuses)}")
+        return [status.path for status in statuses if status.ok]
+    
+    async def iter_process_video(
+        self,
+        input_path: Path,
+        output_dir: Path,
+        copies: int = 1,
+        **options
+    ) -> AsyncIterator[CopyResult]:
+        """
+        То же, что process_video, но отдает копии по мере готовности, чтобы их
+        можно было отправлять, пока кодируются остальные. Копии, которые
+        готовятся вместе (один проход, кэш, сегменты), отдаются по порядку в конце.
+        Отдаются только готовые копии; если генератор закрыт раньше времени,
+        обработка отменяется.
+        
+        Args:
+            options: Остальные параметры process_video
+        """
+        ready: asyncio.Queue = asyncio.Queue()
+        statuses = {}
+        status_callback = options.pop("status_callback", None)
+        
+        def on_status(status: CopyStatus):
+            statuses[status.copy_num] = status
+            if status_callback is not None:
+                status_callback(status)
+        
+        task = asyncio.create_task(self.process_video(
+            input_path, output_dir, copies,
+            copy_callback=lambda i, path: ready.put_nowait((i, path)),
+            status_callback=on_status,
+            **options
+        ))
+        yielded = set()
+        getter = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(ready.get())
+                done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    i, path = getter.result()
+                    yielded.add(i)
+                    yield CopyResult(i + 1, copies, path)
+                    continue
+                getter.cancel()
                 
+                # Обработка закончилась: остальные готовые копии по порядку (или ошибка задачи)
+                task.result()
+                for copy_num in sorted(statuses):
+                    status = statuses[copy_num]
+                    if status.ok and copy_num - 1 not in yielded:
+                        yield CopyResult(copy_num, copies, status.path)
+                return
+        finally:
+            if getter is not None:
+                getter.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+    
+    async def _process_video(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        profile_name: Optional[str],
+        compression: bool,
+        add_frames: bool,
+        single_pass: bool,
+        session_id: str,
+        progress_callback: Optional[ProgressCallback],
+        max_output_size: Optional[int] = None,
+        segmented: Optional[bool] = None,
+        copy_callback: Optional[CopyCallback] = None
+    ) -> List[CopyStatus]:
+        """
+        Выбирает путь обработки: копирование потоков, кэш, целевой размер, сегменты,
+        один проход или по копиям. Копии проверяются (output_verifier); копии, не
+        прошедшие проверку, перекодируются по одной с запасными способами
+        """
+        copies = len(output_paths)
+        loop = asyncio.get_running_loop()
+        
+        # Один ffprobe на вход (результат кэшируется); битые и неподдерживаемые
+        # файлы отклоняются с MediaProbeError до запуска кодировщика
+        if FFPROBE_AVAILABLE:
+            with span("probe"):
+                media_info = await probe_media_async(input_path)
+        else:
+            media_info = None
+        
+        # Вход уже больше лимита - обычное кодирование почти наверняка тоже не уложится,
+        # поэтому сразу кодируем под размер, а не кодируем дважды
+        target_size = bool(max_output_size and media_info is not None and media_info.size > max_output_size)
+        
+        # Без рамок, сжатия и явного профиля перекодировать нечего:
+        # пробуем обойтись копированием потоков
+        if (not add_frames and not compression and profile_name is None
+                and media_info is not None and not target_size):
+            try:
+                if await self._stream_copy(input_path, output_paths, media_info, session_id):
+                    statuses = await self._verify_outputs(input_path, output_paths, media_info, "stream_copy")
+                    failed = [status for status in statuses if not status.ok]
+                    if failed:
+                        raise OutputVerificationError(failed[0].error)
+                    print(f"⚡ Копии созданы без перекодирования. Создано {len(output_paths)} файлов")
+                    return statuses
             except Exception as e:
-                print(f"Ошибка при обработке копии {i+1}: {e}")
-                # В случае ошибки просто копируем файл
-                shutil.copy2(input_path, output_path)
-                result_files.append(output_path)
+                print(f"❌ Ошибка копирования потоков: {e}")
+                FALLBACKS.labels(fallback="stream_copy_to_encode").inc()
+                for output_path in output_paths:
+                    output_path.unlink(missing_ok=True)
         
-        print(f"Обработка завершена. Создано {len(result_files)} файлов")
-        return result_files
-    
-    async def _copy_video_ffmpeg(self, input_path: Path, output_path: Path):
-        """Копирует видео с помощью ffmpeg"""
-        if not FFMPEG_AVAILABLE:
-            shutil.copy2(input_path, output_path)
-            return
+        # Все параметры кодирования определяются до первого вызова FFmpeg,
+        # поэтому каждая копия кодируется ровно один раз
+        profile = select_profile(media_info, compression, profile_name)
+        print(f"Профиль кодирования: {profile}")
+        
+        # Хэш входа задает цвета рамок и ключ кэша результатов
+        with span("hash_input"):
+            input_hash = await loop.run_in_executor(None, hash_file, input_path)
+        border_colors = pick_border_colors(input_hash, copies) if add_frames else [None] * copies
+        
+        cache = get_result_cache()
+        cache_key = make_cache_key(input_hash, {
+            "copies": copies,
+            "compression": compression,
+            "add_frames": add_frames,
+            "border_colors": border_colors,
+            "profile": repr(profile),
+            "max_output_size": max_output_size,
+        })
+        if cache.enabled:
+            with span("cache_lookup") as cache_span:
+                cache_span["hit"] = await loop.run_in_executor(None, cache.get, cache_key, output_paths)
+            if cache_span["hit"]:
+                # В кэш попадают только проверенные копии
+                print(f"⚡ Результат найден в кэше ({cache_key[:12]}), FFmpeg не запускается")
+                return [CopyStatus(i+1, "ok", path, "cache") for i, path in enumerate(output_paths)]
+        
+        # Способ, которым все копии созданы за один заход (проверяются потом вместе)
+        bulk = None
+        
+        if target_size and FFMPEG_AVAILABLE:
+            print(f"🎯 Вход больше {max_output_size} байт, кодируем сразу под целевой размер")
+            await self._encode_target_size(
+                input_path, output_paths, border_colors, profile, media_info,
+                max_output_size, session_id, progress_callback
+            )
+            bulk = "target_size"
+        
+        if segmented is None:
+            segmented = bool(
+                SEGMENT_PARALLEL_MIN_DURATION
+                and media_info is not None
+                and media_info.duration >= SEGMENT_PARALLEL_MIN_DURATION
+                and self.scheduler.max_processes > 1
+            )
+        if bulk is None and segmented and FFMPEG_AVAILABLE and media_info is not None:
+            try:
+                await self._process_segmented(
+                    input_path, output_paths, border_colors, profile, media_info,
+                    session_id, progress_callback
+                )
+                await self._fit_outputs(
+                    input_path, output_paths, border_colors, profile, media_info,
+                    max_output_size, session_id, progress_callback
+                )
+                bulk = "segmented"
+            except Exception as e:
+                print(f"❌ Ошибка сегментного кодирования: {e}")
+                print("🔄 Кодируем ролик целиком...")
+                FALLBACKS.labels(fallback="segmented_to_whole").inc()
+                for output_path in output_paths:
+                    output_path.unlink(missing_ok=True)
+        
+        # Если свободных слотов хватает на все копии, параллельное кодирование
+        # копий дает время одной копии; иначе один процесс с одним декодированием
+        # занимает один слот и не ждет очереди за каждую копию
+        free_slots = self.scheduler.free_slots()
+        parallel = copies > 1 and free_slots >= copies
+        if bulk is None and parallel:
+            print(f"⚡ Свободных слотов FFmpeg: {free_slots}, кодируем {copies} копии параллельно")
+        
+        if bulk is None and single_pass and FFMPEG_AVAILABLE and not parallel:
+            try:
+                await self._process_single_pass(
+                    input_path, output_paths, profile, border_colors, session_id,
+                    self._copy_progress(progress_callback, None, copies)
+                )
+                await self._fit_outputs(
+                    input_path, output_paths, border_colors, profile, media_info,
+                    max_output_size, session_id, progress_callback
+                )
+                bulk = "single_pass"
+                print(f"Обработка завершена за один проход. Создано {len(output_paths)} файлов")
+            except Exception as e:
+                print(f"❌ Ошибка однопроходной обработки: {e}")
+                print("🔄 Переходим к обработке каждой копии отдельно...")
+                FALLBACKS.labels(fallback="single_pass_to_copies").inc()
+                for output_path in output_paths:
+                    output_path.unlink(missing_ok=True)
+        
+        statuses: List[Optional[CopyStatus]] = [None] * copies
+        if bulk is not None:
+            for status in await self._verify_outputs(input_path, output_paths, media_info, bulk, border_colors):
+                if status.ok:
+                    statuses[status.copy_num - 1] = status
+                    continue
+                print(f"❌ Копия {status.copy_num} не прошла проверку ({bulk}): {status.error}")
+                FALLBACKS.labels(fallback=f"{bulk}_to_copy").inc()
+                output_paths[status.copy_num - 1].unlink(missing_ok=True)
+        pending = [i for i, status in enumerate(statuses) if status is None]
+        
+        if pending:
+            # Копии кодируются одновременно, каждая в своем слоте планировщика.
+            # Потоки свободных слотов делятся между копиями, чтобы простаивающие ядра
+            # тоже работали; при нехватке слотов копии ждут очереди с обычным бюджетом
+            threads = self.scheduler.threads_per_job
+            if parallel:
+                threads = max(1, free_slots * self.scheduler.threads_per_job // len(pending))
             
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._copy_video_ffmpeg_sync, input_path, output_path)
+            async def finish_copy(i: int, output_path: Path) -> CopyStatus:
+                # Копия отдается наружу только окончательной: уложенной в размер и проверенной
+                copy_progress = self._copy_progress(progress_callback, i+1, copies)
+                with span("copy", copy=i+1) as copy_span:
+                    status = await self._process_copy(
+                        input_path, output_path, i+1, border_colors[i], profile, media_info,
+                        max_output_size, session_id, copy_progress, threads
+                    )
+                    copy_span["copy_status"] = status.status
+                    copy_span["strategy"] = status.strategy
+                    copy_span["attempts"] = status.attempts
+                    if status.ok:
+                        copy_span["bytes_out"] = output_path.stat().st_size
+                if status.ok and copy_callback is not None:
+                    copy_callback(i, output_path)
+                return status
+            
+            for status in await asyncio.gather(*(finish_copy(i, output_paths[i]) for i in pending)):
+                statuses[status.copy_num - 1] = status
+        
+        # В кэш попадают только результаты, в которых все копии готовы и проверены
+        if cache.enabled and all(status.ok for status in statuses):
+            await loop.run_in_executor(None, cache.put, cache_key, output_paths)
+        
+        print(f"Обработка завершена. Готово копий: {sum(status.ok for status in statuses)} из {copies}")
+        return statuses
+    
+    async def _verify_outputs(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        media_info: Optional[MediaInfo],
+        strategy: str,
+        border_colors: Optional[List[Optional[str]]] = None
+    ) -> List[CopyStatus]:
+        """Проверяет копии, созданные за один заход способом strategy (рамки - через pad)"""
+        statuses = []
+        for i, output_path in enumerate(output_paths):
+            frame = "pad" if border_colors and border_colors[i] else None
+            try:
+                if FFPROBE_AVAILABLE:
+                    with span("verify", copy=i+1):
+                        await verify_output(output_path, input_path, media_info, frame)
+                statuses.append(CopyStatus(i+1, "ok", output_path, strategy))
+            except OutputVerificationError as e:
+                statuses.append(CopyStatus(i+1, "failed", None, strategy, error=str(e)))
+        return statuses
     
-    def _copy_video_ffmpeg_sync(self, input_path: Path, output_path: Path):
-        """Синхронная версия копирования видео"""
+    async def _process_segmented(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        border_colors: List[Optional[str]],
+        profile: EncodingProfile,
+        media_info: MediaInfo,
+        session_id: str,
+        progress_callback: Optional[ProgressCallback] = None
+    ):
+        """
+        Сегментное кодирование длинного ролика: видео режется по ключевым кадрам
+        без перекодирования, сегменты всех копий кодируются параллельно в слотах
+        планировщика, затем склеиваются concat-демультиплексором без перекодирования
+        с аудио из оригинала. Стыки проверяются на расхождение длительностей.
+        """
+        copies = len(output_paths)
+        work_dir = self.temp_dir / f"segments_{uuid.uuid4().hex}"
+        work_dir.mkdir()
         try:
-            # Создаем простую команду FFmpeg для копирования
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(input_path),
-                '-c:v', 'libx264',
-                '-preset', 'ultrafast',  # Быстрая обработка
-                '-crf', '23',  # Качество
-                '-c:a', 'copy',  # Просто копируем аудио без перекодирования
-                str(output_path)
+            segment_time = max(
+                SEGMENT_MIN_SECONDS,
+                media_info.duration / (self.scheduler.max_processes * SEGMENTS_PER_SLOT)
+            )
+            sources = await self.scheduler.run(
+                session_id, self._run_split_segments, input_path, work_dir, segment_time
+            )
+            if len(sources) < 2:
+                raise Exception("ролик не разделился на сегменты (мало ключевых кадров)")
+            print(f"✂️ Ролик разделен на {len(sources)} сегментов по ~{segment_time:.0f} с")
+            
+            encoded = [
+                [work_dir / f"copy{i+1}_{source.name}" for source in sources]
+                for i in range(copies)
             ]
+            await asyncio.gather(*(
+                self.scheduler.run(
+                    session_id, self._run_encode_segment,
+                    source, encoded[i][n], border_colors[i], profile,
+                    self._segment_progress(progress_callback, i+1, copies, n+1, len(sources))
+                )
+                for i in range(copies)
+                for n, source in enumerate(sources)
+            ))
             
-            print(f"Выполняем копирование: {' '.join(cmd)}")
+            # Стыки: длительность каждого закодированного сегмента должна совпадать
+            # с исходным, иначе видео накопит сдвиг относительно аудио оригинала
+            source_durations = [(await probe_media_async(source)).duration for source in sources]
+            for i in range(copies):
+                drift = 0.0
+                for n, (segment, expected) in enumerate(zip(encoded[i], source_durations)):
+                    drift += (await probe_media_async(segment)).duration - expected
+                    if abs(drift) > SEGMENT_SYNC_TOLERANCE:
+                        raise Exception(
+                            f"копия {i+1}: после сегмента {n+1} видео смещено на {drift:.3f} с"
+                        )
             
-            # Выполняем команду с нашими переменными окружения
-            env = os.environ.copy()
-            temp_path = str(self.temp_dir.absolute())
-            env['TMPDIR'] = temp_path
-            env['TMP'] = temp_path
-            env['TEMP'] = temp_path
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300, env=env)
-            
-            if result.returncode == 0:
-                print(f"✅ Видео скопировано: {output_path}")
-            else:
-                print(f"❌ Ошибка FFmpeg при копировании:")
-                print(f"   stdout: {result.stdout}")
-                print(f"   stderr: {result.stderr}")
-                raise Exception(f"FFmpeg copy error: {result.stderr}")
-                
-        except Exception as e:
-            print(f"❌ Ошибка при копировании: {e}")
-            # В случае ошибки просто копируем файл
-            shutil.copy2(input_path, output_path)
-            print(f"📁 Файл скопирован через shutil: {output_path}")
+            for i, output_path in enumerate(output_paths):
+                await self.scheduler.run(
+                    session_id, self._run_concat_segments, input_path, encoded[i], work_dir, output_path
+                )
+                self._check_av_sync(await probe_media_async(output_path), media_info, i+1)
+            print(f"✅ Сегментное кодирование завершено. Создано {copies} файлов")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _segment_progress(
+        progress_callback: Optional[ProgressCallback],
+        copy_num: int,
+        copies: int,
+        segment: int,
+        segments: int
+    ) -> Optional[ProgressCallback]:
+        """Добавляет к прогрессу номер копии и сегмента"""
+        if progress_callback is None:
+            return None
+        
+        def callback(progress: dict):
+            progress_callback({
+                **progress, 'copy': copy_num, 'copies': copies,
+                'segment': segment, 'segments': segments
+            })
+        return callback
     
-    async def _add_frames_ffmpeg(self, input_path: Path, output_path: Path, copy_num: int):
-        """Добавляет рамки с помощью ffmpeg"""
+    @staticmethod
+    def _check_av_sync(output_info: MediaInfo, input_info: MediaInfo, copy_num: int):
+        """Видео склеенной копии не должно расходиться с аудио и длительностью оригинала"""
+        video_duration = output_info.video_duration or output_info.duration
+        if abs(video_duration - input_info.duration) > SEGMENT_SYNC_TOLERANCE + 1 / max(input_info.fps, 1):
+            raise Exception(
+                f"копия {copy_num}: длительность видео {video_duration:.3f} с "
+                f"вместо {input_info.duration:.3f} с"
+            )
+        if output_info.video_duration and output_info.audio_duration:
+            if abs(output_info.video_duration - output_info.audio_duration) > SEGMENT_SYNC_TOLERANCE + 0.05:
+                raise Exception(
+                    f"копия {copy_num}: рассинхронизация видео и аудио "
+                    f"{output_info.video_duration - output_info.audio_duration:.3f} с"
+                )
+    
+    async def _run_split_segments(self, input_path: Path, work_dir: Path, segment_time: float) -> List[Path]:
+        """Режет видеопоток по ключевым кадрам без перекодирования"""
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', str(input_path),
+            '-map', '0:v:0',
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_time', f"{segment_time:.3f}",
+            '-reset_timestamps', '1',
+            str(work_dir / "source_%04d.mp4")
+        ]
+        print(f"Режем на сегменты: {' '.join(cmd)}")
+        result = await self._run_ffmpeg(
+            cmd, max(await self._encode_timeout(input_path) / 10, FFMPEG_MIN_TIMEOUT), stage="split_segments"
+        )
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg segment error: {result.stderr}")
+        return sorted(work_dir.glob("source_*.mp4"))
+    
+    async def _run_encode_segment(
+        self,
+        source_path: Path,
+        output_path: Path,
+        border_color: Optional[str],
+        profile: EncodingProfile,
+        progress_callback: Optional[ProgressCallback] = None
+    ):
+        """Кодирует один сегмент (без аудио) с фильтрами профиля и рамкой"""
+        filters = profile.video_filters()
+        if border_color:
+            filters.append(border_filter("pad", border_color))
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', str(source_path),
+            *(['-vf', ','.join(filters)] if filters else []),
+            *profile.codec_args(self.scheduler.threads_per_job),
+            '-an',
+            str(output_path)
+        ]
+        result = await self._run_ffmpeg(cmd, await self._encode_timeout(source_path), progress_callback, stage="encode_segment")
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg segment encode error: {result.stderr}")
+    
+    async def _run_concat_segments(
+        self,
+        input_path: Path,
+        segment_paths: List[Path],
+        work_dir: Path,
+        output_path: Path
+    ):
+        """Склеивает сегменты concat-демультиплексором и добавляет аудио оригинала"""
+        list_path = work_dir / f"{output_path.stem}_concat.txt"
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for segment_path in segment_paths:
+                f.write(f"file '{segment_path.absolute()}'\n")
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat', '-safe', '0', '-i', str(list_path),
+            '-i', str(input_path),
+            '-map', '0:v', '-map', '1:a?',
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            str(output_path)
+        ]
+        print(f"Склеиваем сегменты: {' '.join(cmd)}")
+        result = await self._run_ffmpeg(
+            cmd, max(await self._encode_timeout(input_path) / 10, FFMPEG_MIN_TIMEOUT), stage="concat_segments"
+        )
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg concat error: {result.stderr}")
+    
+    async def _process_copy(
+        self,
+        input_path: Path,
+        output_path: Path,
+        copy_num: int,
+        border_color: Optional[str],
+        profile: EncodingProfile,
+        media_info: Optional[MediaInfo],
+        max_output_size: Optional[int],
+        session_id: str,
+        progress_callback: Optional[ProgressCallback],
+        threads: int
+    ) -> CopyStatus:
+        """
+        Обрабатывает одну копию, перебирая способы (_copy_strategies), пока копия
+        не пройдет проверку. Ошибка копии не прерывает остальные: если все способы
+        не сработали, возвращает статус failed - исходник вместо копии не отдается
+        """
         if not FFMPEG_AVAILABLE:
-            shutil.copy2(input_path, output_path)
+            return CopyStatus(copy_num, "failed", None, "encode", attempts=0, error="FFmpeg недоступен")
+        
+        print(f"Обрабатываем копию {copy_num}: {output_path.name}")
+        strategies = self._copy_strategies(border_color, profile)
+        errors = []
+        for attempt, (strategy, frame_filter, attempt_profile) in enumerate(strategies, 1):
+            try:
+                if frame_filter:
+                    await self.scheduler.run(
+                        session_id, self._run_add_frames,
+                        input_path, output_path, copy_num, border_color, frame_filter, attempt_profile,
+                        progress_callback, threads
+                    )
+                else:
+                    await self.scheduler.run(
+                        session_id, self._run_copy_video,
+                        input_path, output_path, attempt_profile, progress_callback, threads
+                    )
+                # Под размер копия перекодируется той же рамкой, что и в этой попытке
+                await self._fit_outputs(
+                    input_path, [output_path], [border_color], attempt_profile, media_info,
+                    max_output_size, session_id, progress_callback, frame_filter or "pad"
+                )
+                if FFPROBE_AVAILABLE:
+                    with span("verify", copy=copy_num):
+                        await verify_output(output_path, input_path, media_info, frame_filter)
+                print(f"Копия {copy_num} готова ({strategy}): {output_path}")
+                return CopyStatus(copy_num, "ok", output_path, strategy, attempts=attempt)
+            except asyncio.CancelledError:
+                output_path.unlink(missing_ok=True)
+                raise
+            except Exception as e:
+                errors.append(f"{strategy}: {short_error(e)}")
+                output_path.unlink(missing_ok=True)
+                next_strategy = strategies[attempt][0] if attempt < len(strategies) else "failed"
+                print(f"❌ Копия {copy_num} не получилась ({strategy}): {e}")
+                FALLBACKS.labels(fallback=f"{strategy}_to_{next_strategy}").inc()
+        
+        return CopyStatus(copy_num, "failed", None, strategies[-1][0], attempts=len(strategies), error="; ".join(errors))
+    
+    @staticmethod
+    def _copy_strategies(
+        border_color: Optional[str],
+        profile: EncodingProfile
+    ) -> List[Tuple[str, Optional[str], EncodingProfile]]:
+        """
+        Способы создания копии по порядку: (имя, фильтр рамки, профиль).
+        Рамка: pad, затем drawbox (не меняет размер кадра), затем pad с быстрым пресетом
+        """
+        retry_profile = replace(profile, preset=RETRY_PRESET)
+        if border_color:
+            strategies = [
+                ("pad", "pad", profile),
+                ("drawbox", "drawbox", profile),
+                (f"pad_{RETRY_PRESET}", "pad", retry_profile),
+            ]
+        else:
+            strategies = [
+                ("encode", None, profile),
+                (f"encode_{RETRY_PRESET}", None, retry_profile),
+            ]
+        if profile.preset == RETRY_PRESET:
+            strategies.pop()
+        return strategies
+    
+    async def _stream_copy(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        media_info: MediaInfo,
+        session_id: str
+    ) -> bool:
+        """
+        Создает копии без перекодирования. Возвращает False, если вход
+        требует перекодирования и нужно идти обычным путем.
+        """
+        if not media_info.stream_copy_compatible:
+            return False
+        loop = asyncio.get_running_loop()
+        
+        first_output = output_paths[0]
+        if input_path.suffix.lower() == '.mp4' and await loop.run_in_executor(None, moov_before_mdat, input_path):
+            # Вход уже H.264/AAC MP4 с faststart - ремукс дал бы тот же результат
+            print("⚡ Вход уже в нужном формате, создаем жесткие ссылки")
+            await loop.run_in_executor(None, link_or_copy, input_path, first_output)
+        else:
+            print("⚡ Перепаковываем потоки без перекодирования (-c copy, +faststart)")
+            await self.scheduler.run(session_id, self._run_remux, input_path, first_output)
+        
+        # Остальные копии побайтно совпадают с первой
+        for output_path in output_paths[1:]:
+            await loop.run_in_executor(None, link_or_copy, first_output, output_path)
+        return True
+    
+    async def fit_to_size(
+        self,
+        input_path: Path,
+        output_path: Path,
+        max_output_size: int,
+        session_id: str = "default"
+    ) -> Path:
+        """
+        Перекодирует готовый файл так, чтобы он уложился в max_output_size
+        (например, результат, который не проходит в лимит Telegram).
+        Рамки уже на кадре, поэтому кодируется только сам файл.
+        
+        Raises:
+            OutputVerificationError: Результат не прошел проверку
+        """
+        media_info = await probe_media_async(input_path)
+        profile = select_profile(media_info)
+        try:
+            await self._encode_target_size(
+                input_path, [output_path], [None], profile, media_info, max_output_size, session_id
+            )
+            if FFPROBE_AVAILABLE:
+                await verify_output(output_path, input_path, media_info)
+        except (asyncio.CancelledError, OutputVerificationError):
+            # Битый результат не отправляется вместо исходника
+            output_path.unlink(missing_ok=True)
+            raise
+        return output_path
+    
+    async def _fit_outputs(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        border_colors: List[Optional[str]],
+        profile: EncodingProfile,
+        media_info: Optional[MediaInfo],
+        max_output_size: Optional[int],
+        session_id: str,
+        progress_callback: Optional[ProgressCallback] = None,
+        frame_filter: str = "pad"
+    ):
+        """
+        Перекодирует под целевой размер только копии, которые превысили max_output_size.
+        frame_filter - способ рамки, которым копии были закодированы (pad или drawbox)
+        """
+        if not max_output_size or media_info is None or not FFMPEG_AVAILABLE:
             return
-            
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._add_frames_ffmpeg_sync, input_path, output_path, copy_num)
+        oversized = [i for i, path in enumerate(output_paths) if path.stat().st_size > max_output_size]
+        if not oversized:
+            return
+        
+        print(f"🎯 Копии {[i + 1 for i in oversized]} больше {max_output_size} байт, кодируем под размер")
+        await self._encode_target_size(
+            input_path,
+            [output_paths[i] for i in oversized],
+            [border_colors[i] for i in oversized],
+            profile, media_info, max_output_size, session_id, progress_callback, frame_filter
+        )
+    
+    async def _encode_target_size(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        border_colors: List[Optional[str]],
+        profile: EncodingProfile,
+        media_info: MediaInfo,
+        max_output_size: int,
+        session_id: str,
+        progress_callback: Optional[ProgressCallback] = None,
+        frame_filter: str = "pad"
+    ):
+        """Кодирует копии со средним битрейтом так, чтобы каждая уложилась в max_output_size"""
+        with span("fit_to_size", copies=len(output_paths), max_output_size=max_output_size) as fit_span:
+            await self.scheduler.run(
+                session_id, self._run_target_size,
+                input_path, output_paths, border_colors, profile, media_info,
+                max_output_size, progress_callback, frame_filter
+            )
+            fit_span["bytes_out"] = sum(path.stat().st_size for path in output_paths)
     
-    def _add_frames_ffmpeg_sync(self, input_path: Path, output_path: Path, copy_num: int):
-        """Синхронная версия добавления рамок"""
+    async def _run_target_size(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        border_colors: List[Optional[str]],
+        profile: EncodingProfile,
+        media_info: MediaInfo,
+        max_output_size: int,
+        progress_callback: Optional[ProgressCallback] = None,
+        frame_filter: str = "pad"
+    ):
+        """
+        ABR-кодирование под размер, рамки - способом frame_filter (pad или drawbox). Для роликов не длиннее TARGET_SIZE_TWO_PASS_MAX_DURATION
+        первый проход анализирует вход один раз, и его статистика используется для всех
+        копий: рамки отличаются только цветом, геометрия кадра одна и та же.
+        Копия, которая все равно не уложилась, перекодируется с меньшим битрейтом.
+        """
+        target = target_size_profile(profile, media_info, max_output_size)
+        two_pass = media_info.duration <= TARGET_SIZE_TWO_PASS_MAX_DURATION
+        threads = self.scheduler.threads_per_job
+        copies = len(output_paths)
+        passlog = self.temp_dir / f"passlog_{uuid.uuid4().hex}"
+        print(f"🎯 Целевой размер {max_output_size} байт: видео {target.bitrate} бит/с, "
+              f"{'два прохода' if two_pass else 'один проход'}")
+        
         try:
-            # Генерируем случайный цвет для рамки
-            # Используем только базовые цвета, которые точно поддерживаются
-            colors = ['red', 'green', 'blue', 'yellow', 'purple', 'orange', 'pink', 'cyan', 'magenta', 'lime']
-            border_color = random.choice(colors)
-            
-            print(f"Добавляем рамку цвета {border_color} для копии {copy_num}")
-            print(f"Входной файл: {input_path}")
-            print(f"Выходной файл: {output_path}")
-            
-            # Пробуем добавить рамку с улучшенной обработкой ошибок
-            try:
-                # Создаем простую команду FFmpeg для добавления рамки
+            if two_pass:
+                filters = target.video_filters()
+                if any(border_colors):
+                    filters.append(border_filter(frame_filter, "black"))
                 cmd = [
-                    'ffmpeg', '-y',  # -y для перезаписи файла
+                    'ffmpeg', '-y',
                     '-i', str(input_path),
-                    '-vf', f'pad=iw+60:ih+60:30:30:{border_color}',
-                    '-c:v', 'libx264',
-                    '-preset', 'ultrafast',  # Быстрая обработка
-                    '-crf', '23',  # Качество
-                    '-c:a', 'copy',  # Просто копируем аудио без перекодирования
-                    str(output_path)
+                    *(['-vf', ','.join(filters)] if filters else []),
+                    *target.codec_args(threads),
+                    '-pass', '1', '-passlogfile', str(passlog),
+                    '-an', '-f', 'null', '-'
                 ]
+                print(f"Первый проход: {' '.join(cmd)}")
+                result = await self._run_ffmpeg(
+                    cmd, await self._encode_timeout(input_path),
+                    self._copy_progress(progress_callback, None, copies), stage="target_size_pass1"
+                )
+                if result.returncode != 0:
+                    raise Exception(f"FFmpeg first pass error: {result.stderr}")
+            
+            for i, (output_path, border_color) in enumerate(zip(output_paths, border_colors)):
+                filters = target.video_filters()
+                if border_color:
+                    filters.append(border_filter(frame_filter, border_color))
+                bitrate = target.bitrate
                 
-                print(f"Выполняем команду: {' '.join(cmd)}")
-                
-                # Выполняем команду с нашими переменными окружения
-                env = os.environ.copy()
-                temp_path = str(self.temp_dir.absolute())
-                env['TMPDIR'] = temp_path
-                env['TMP'] = temp_path
-                env['TEMP'] = temp_path
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, env=env)
-                
-                if result.returncode == 0:
-                    print(f"✅ Рамка добавлена: {output_path}")
-                else:
-                    print(f"❌ Ошибка FFmpeg:")
-                    print(f"   stdout: {result.stdout}")
-                    print(f"   stderr: {result.stderr}")
-                    raise Exception(f"FFmpeg error: {result.stderr}")
-                    
-            except Exception as pad_error:
-                print(f"❌ Ошибка при добавлении рамки: {pad_error}")
-                
-                # Пробуем альтернативный способ - через drawbox
-                try:
+                for attempt in range(1, TARGET_SIZE_MAX_ATTEMPTS + 1):
                     cmd = [
                         'ffmpeg', '-y',
                         '-i', str(input_path),
-                        '-vf', f'drawbox=x=0:y=0:w=iw:h=ih:color={border_color}:t=30',
-                        '-c:v', 'libx264',
-                        '-preset', 'ultrafast',  # Быстрая обработка
-                        '-crf', '23',  # Качество
-                        '-c:a', 'copy',  # Просто копируем аудио без перекодирования
+                        '-map', '0:v', '-map', '0:a?',
+                        *(['-vf', ','.join(filters)] if filters else []),
+                        *replace(target, bitrate=bitrate).codec_args(threads),
+                        *(['-pass', '2', '-passlogfile', str(passlog)] if two_pass else []),
+                        '-c:a', 'copy',
+                        '-movflags', '+faststart',
                         str(output_path)
                     ]
+                    print(f"Кодирование под размер, копия {i+1}, попытка {attempt}: {' '.join(cmd)}")
+                    result = await self._run_ffmpeg(
+                        cmd, await self._encode_timeout(input_path),
+                        self._copy_progress(progress_callback, i+1, copies), stage="target_size_pass2"
+                    )
+                    if result.returncode != 0:
+                        raise Exception(f"FFmpeg target size error: {result.stderr}")
                     
-                    print(f"Пробуем альтернативную команду: {' '.join(cmd)}")
-                    
-                    env = os.environ.copy()
-                    temp_path = str(self.temp_dir.absolute())
-                    env['TMPDIR'] = temp_path
-                    env['TMP'] = temp_path
-                    env['TEMP'] = temp_path
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, env=env)
-                    
-                    if result.returncode == 0:
-                        print(f"✅ Рамка добавлена (альтернативный способ): {output_path}")
-                    else:
-                        print(f"❌ Альтернативная команда тоже не сработала:")
-                        print(f"   stdout: {result.stdout}")
-                        print(f"   stderr: {result.stderr}")
-                        raise Exception(f"Alternative FFmpeg error: {result.stderr}")
-                        
-                except Exception as alt_error:
-                    print(f"❌ Альтернативный способ тоже не сработал: {alt_error}")
-                    # В случае ошибки просто копируем файл
-                    shutil.copy2(input_path, output_path)
-                    print(f"📁 Файл скопирован без рамки: {output_path}")
-            
-        except Exception as e:
-            print(f"❌ Общая ошибка при добавлении рамки: {e}")
-            print("🔄 Пробуем простое копирование файла...")
-            # В случае ошибки просто копируем файл
-            try:
-                shutil.copy2(input_path, output_path)
-                print(f"✅ Файл скопирован без рамки: {output_path}")
-            except Exception as copy_error:
-                print(f"❌ Ошибка при копировании: {copy_error}")
-                # Последняя попытка - простое копирование байтов
-                try:
-                    with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
-                        dst.write(src.read())
-                    print(f"✅ Файл скопирован байтами: {output_path}")
-                except Exception as final_error:
-                    print(f"❌ Критическая ошибка: {final_error}")
-                    raise
-    
-    async def _compress_video_ffmpeg(self, input_path: Path, output_path: Path):
-        """Сжимает видео с помощью ffmpeg"""
-        if not FFMPEG_AVAILABLE:
-            shutil.copy2(input_path, output_path)
-            return
-            
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._compress_video_ffmpeg_sync, input_path, output_path)
+                    size = output_path.stat().st_size
+                    if size <= max_output_size:
+                        print(f"✅ Копия {i+1} уложилась в размер: {size} байт")
+                        break
+                    # Уменьшаем битрейт пропорционально превышению
+                    bitrate = int(bitrate * max_output_size / size * 0.95)
+                    print(f"⚠️ Копия {i+1}: {size} байт больше лимита, повторяем с {bitrate} бит/с")
+                else:
+                    output_path.unlink(missing_ok=True)
+                    raise Exception(
+                        f"Не удалось уложить копию {i+1} в {max_output_size} байт "
+                        f"за {TARGET_SIZE_MAX_ATTEMPTS} попытки"
+                    )
+        finally:
+            for log_file in self.temp_dir.glob(f"{passlog.name}*"):
+                log_file.unlink(missing_ok=True)
     
-    def _compress_video_ffmpeg_sync(self, input_path: Path, output_path: Path):
-        """Синхронная версия сжатия видео"""
+    async def _run_remux(self, input_path: Path, output_path: Path):
+        """Перепаковка в MP4 с копированием потоков и moov в начале файла"""
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', str(input_path),
+            '-map', '0:v', '-map', '0:a?',
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            str(output_path)
+        ]
+        print(f"Выполняем перепаковку: {' '.join(cmd)}")
+        
+        # Перепаковка на порядки быстрее кодирования
+        result = await self._run_ffmpeg(
+            cmd, max(await self._encode_timeout(input_path) / 10, FFMPEG_MIN_TIMEOUT), stage="remux"
+        )
+        if result.returncode != 0:
+            print(f"❌ Ошибка FFmpeg при перепаковке:")
+            print(f"   stderr: {result.stderr}")
+            raise Exception(f"FFmpeg remux error: {result.stderr}")
+        print(f"✅ Видео перепаковано: {output_path}")
+    
+    @staticmethod
+    def _copy_progress(
+        progress_callback: Optional[ProgressCallback],
+        copy_num: Optional[int],
+        copies: int
+    ) -> Optional[ProgressCallback]:
+        """Добавляет к прогрессу номер копии (None - все копии сразу)"""
+        if progress_callback is None:
+            return None
+        
+        def callback(progress: dict):
+            progress_callback({**progress, 'copy': copy_num, 'copies': copies})
+        return callback
+    
+    def _ffmpeg_env(self) -> dict:
+        """Переменные окружения FFmpeg с нашей временной папкой"""
+        env = os.environ.copy()
+        temp_path = str(self.temp_dir.absolute())
+        env['TMPDIR'] = temp_path
+        env['TMP'] = temp_path
+        env['TEMP'] = temp_path
+        return env
+    
+    async def _encode_timeout(self, input_path: Path, outputs: int = 1) -> float:
+        """
+        Таймаут FFmpeg по длительности входа и измеренной скорости кодирования,
+        вместо фиксированных 60/300 секунд для любых роликов
+        """
         try:
-            # Создаем простую команду FFmpeg для сжатия
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(input_path),
-                '-c:v', 'libx264',
-                '-crf', '28',  # качество сжатия (18-28, где 28 - больше сжатие)
-                '-preset', 'ultrafast',  # Быстрая обработка
+            duration = (await probe_media_async(input_path)).duration if FFPROBE_AVAILABLE else None
+        except (MediaProbeError, OSError):
+            duration = None
+        if duration is None:
+            return FFMPEG_DEFAULT_TIMEOUT
+        
+        expected = duration * outputs / encode_speed.value
+        return min(max(expected * FFMPEG_TIMEOUT_FACTOR, FFMPEG_MIN_TIMEOUT), FFMPEG_MAX_TIMEOUT)
+    
+    async def _run_ffmpeg(
+        self,
+        cmd: List[str],
+        timeout: float,
+        progress_callback: Optional[ProgressCallback] = None,
+        outputs: int = 1,
+        stage: str = "encode"
+    ) -> FFmpegResult:
+        """
+        Запускает FFmpeg с нашими переменными окружения (см. ffmpeg_runner.run_ffmpeg),
+        обновляет оценку скорости кодирования и метрики этапа stage
+        """
+        with span("ffmpeg", stage=stage, outputs=outputs) as ffmpeg_span:
+            try:
+                result = await run_ffmpeg(cmd, timeout, progress_callback, env=self._ffmpeg_env())
+            except FFmpegTimeout:
+                FFMPEG_FAILURES.labels(stage=stage).inc()
+                raise
+            ffmpeg_span["returncode"] = result.returncode
+            ffmpeg_span["speed"] = result.speed
+            if result.returncode != 0:
+                FFMPEG_FAILURES.labels(stage=stage).inc()
+            elif 'libx264' in cmd:
+                # Скорость процесса с N выходами -> скорость на один выход
+                encode_speed.update(result.speed * outputs)
+                ENCODE_SPEED.observe(result.speed * outputs)
+        return result
+    
+    async def _process_single_pass(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        profile: EncodingProfile,
+        border_colors: List[Optional[str]],
+        session_id: str,
+        progress_callback: Optional[ProgressCallback] = None
+    ):
+        """Создает все копии одним процессом FFmpeg"""
+        await self.scheduler.run(
+            session_id, self._run_single_pass,
+            input_path, output_paths, profile, border_colors, progress_callback
+        )
+    
+    def _build_single_pass_cmd(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        border_colors: List[Optional[str]],
+        profile: EncodingProfile
+    ) -> List[str]:
+        """
+        Строит команду FFmpeg с графом фильтров: одно декодирование,
+        split на N веток, рамка на каждой ветке и N закодированных выходов
+        """
+        copies = len(output_paths)
+        # Бюджет потоков задачи делится между кодировщиками всех выходов
+        threads = max(1, self.scheduler.threads_per_job // copies)
+        
+        # [0:v]split=N[s0][s1]... - видео декодируется один раз
+        graph = [f"[0:v]split={copies}" + "".join(f"[s{i}]" for i in range(copies))]
+        for i in range(copies):
+            filters = profile.video_filters()
+            if border_colors[i]:
+                filters.append(border_filter("pad", border_colors[i]))
+            graph.append(f"[s{i}]{','.join(filters) or 'null'}[v{i}]")
+        
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', str(input_path),
+            '-filter_complex', ';'.join(graph),
+        ]
+        for i, output_path in enumerate(output_paths):
+            cmd += [
+                '-map', f'[v{i}]',
+                '-map', '0:a?',  # Аудио, если оно есть
+                *profile.codec_args(threads),
                 '-c:a', 'copy',  # Просто копируем аудио без перекодирования
+                '-movflags', '+faststart',
                 str(output_path)
             ]
-            
-            print(f"Выполняем сжатие: {' '.join(cmd)}")
-            
-            # Выполняем команду с нашими переменными окружения
-            env = os.environ.copy()
-            temp_path = str(self.temp_dir.absolute())
-            env['TMPDIR'] = temp_path
-            env['TMP'] = temp_path
-            env['TEMP'] = temp_path
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300, env=env)
-            
-            if result.returncode == 0:
-                print(f"✅ Видео сжато: {output_path}")
-            else:
-                print(f"❌ Ошибка FFmpeg при сжатии:")
-                print(f"   stdout: {result.stdout}")
-                print(f"   stderr: {result.stderr}")
-                raise Exception(f"FFmpeg compression error: {result.stderr}")
-                
-        except Exception as e:
-            print(f"❌ Ошибка при сжатии: {e}")
-            # В случае ошибки просто копируем файл
-            shutil.copy2(input_path, output_path)
-            print(f"📁 Файл скопирован без сжатия: {output_path}")
\ No newline at end of file
+        return cmd
+    
+    async def _run_single_pass(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        profile: EncodingProfile,
+        border_colors: List[Optional[str]],
+        progress_callback: Optional[ProgressCallback] = None
+    ):
+        """Запускает FFmpeg однопроходной обработки (в слоте планировщика)"""
+        cmd = self._build_single_pass_cmd(input_path, output_paths, border_colors, profile)
+        print(f"Выполняем однопроходную обработку: {' '.join(cmd)}")
+        
+        timeout = await self._encode_timeout(input_path, len(output_paths))
+        result = await self._run_ffmpeg(cmd, timeout, progress_callback, outputs=len(output_paths), stage="single_pass")
+        
+        if result.returncode == 0:
+            print(f"✅ Создано {len(output_paths)} копий за один проход (рамки: {border_colors})")
+        else:
+            print(f"❌ Ошибка FFmpeg при однопроходной обработке:")
+            print(f"   stderr: {result.stderr}")
+            raise Exception(f"FFmpeg single-pass error: {result.stderr}")
+    
+    async def _run_copy_video(
+        self,
+        input_path: Path,
+        output_path: Path,
+        profile: EncodingProfile,
+        progress_callback: Optional[ProgressCallback] = None,
+        threads: Optional[int] = None
+    ):
+        """Кодирует копию без рамки"""
+        cmd = ['ffmpeg', '-y', '-i', str(input_path)]
+        filters = profile.video_filters()
+        if filters:
+            cmd += ['-vf', ','.join(filters)]
+        cmd += [
+            *profile.codec_args(threads or self.scheduler.threads_per_job),
+            '-c:a', 'copy',  # Просто копируем аудио без перекодирования
+            '-movflags', '+faststart',
+            str(output_path)
+        ]
+        
+        print(f"Выполняем копирование: {' '.join(cmd)}")
+        
+        # Выполняем команду с нашими переменными окружения и чтением прогресса
+        result = await self._run_ffmpeg(cmd, await self._encode_timeout(input_path), progress_callback, stage="copy_video")
+        
+        if result.returncode != 0:
+            print(f"❌ Ошибка FFmpeg при копировании:")
+            print(f"   stderr: {result.stderr}")
+            raise Exception(f"FFmpeg copy error: {result.stderr}")
+        print(f"✅ Видео скопировано: {output_path}")
+    
+    async def _run_add_frames(
+        self,
+        input_path: Path,
+        output_path: Path,
+        copy_num: int,
+        border_color: str,
+        frame_filter: str,
+        profile: EncodingProfile,
+        progress_callback: Optional[ProgressCallback] = None,
+        threads: Optional[int] = None
+    ):
+        """
+        Кодирует копию с рамкой. frame_filter: pad (рамка вокруг кадра)
+        или drawbox (рамка поверх краев кадра, размер не меняется)
+        """
+        frame = border_filter(frame_filter, border_color)
+        print(f"Добавляем рамку цвета {border_color} ({frame_filter}) для копии {copy_num}")
+        
+        cmd = [
+            'ffmpeg', '-y',  # -y для перезаписи файла
+            '-i', str(input_path),
+            '-vf', ','.join(profile.video_filters() + [frame]),
+            *profile.codec_args(threads or self.scheduler.threads_per_job),
+            '-c:a', 'copy',  # Просто копируем аудио без перекодирования
+            '-movflags', '+faststart',
+            str(output_path)
+        ]
+        
+        print(f"Выполняем команду: {' '.join(cmd)}")
+        
+        # Выполняем команду с нашими переменными окружения и чтением прогресса
+        result = await self._run_ffmpeg(
+            cmd, await self._encode_timeout(input_path), progress_callback, stage=f"add_frames_{frame_filter}"
+        )
+        
+        if result.returncode != 0:
+            print(f"❌ Ошибка FFmpeg:")
+            print(f"   stderr: {result.stderr}")
+            raise Exception(f"FFmpeg error: {result.stderr}")
+        print(f"✅ Рамка добавлена: {output_path}")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Обработчик задач: забирает задачи веб-приложения из очереди в SQLite и кодирует видео
+
+Запуск одного обработчика:
+    python worker.py --id worker-1
+Несколько обработчиков с перезапуском при падении запускает start_workers.py
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import time
+from pathlib import Path
+from typing import Optional, Set
+
+from config import TELEGRAM_MAX_UPLOAD_SIZE
+from job_store import get_job_store
+from metrics import QUEUE_WAIT_SECONDS, start_metrics_server
+from tracing import job_trace, span
+from telegram_api import close_http_client, send_telegram_notification, send_video_files_to_telegram
+from video_processor import VideoProcessor
+
+# Как часто проверять очередь, если она пуста (секунды)
+POLL_INTERVAL = 1.0
+# Как часто проверять флаг отмены задачи в работе
+CANCEL_POLL_INTERVAL = 1.0
+# Как часто обработчик отмечается в задаче
+HEARTBEAT_INTERVAL = 5.0
+# Задача без отметки дольше этого времени считается брошенной упавшим обработчиком
+HEARTBEAT_TIMEOUT = 60.0
+# Сколько раз задача может уронить обработчик, прежде чем считаться неудачной
+MAX_JOB_ATTEMPTS = 3
+
+
+class EncodeWorker:
+    """
+    Цикл обработчика: одна задача за раз. Отмена приходит через флаг
+    cancel_requested в базе, поэтому отменить задачу может любой процесс
+    веб-приложения.
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.job_store = get_job_store()
+        self._stopping = False
+        self._current: Optional[asyncio.Task] = None
+        # Отправка результатов в Telegram идет в фоне, не задерживая следующую задачу
+        self._background: Set[asyncio.Task] = set()
+
+    def stop(self):
+        """Останавливает обработчик; задача в работе возвращается в очередь"""
+        self._stopping = True
+        if self._current is not None:
+            self._current.cancel()
+
+    async def run(self):
+        print(f"👷 Обработчик {self.worker_id} запущен (PID {os.getpid()})")
+        self.job_store.start_background_flush()
+        last_requeue = 0.0
+        try:
+            while not self._stopping:
+                if time.monotonic() - last_requeue >= HEARTBEAT_TIMEOUT / 2:
+                    last_requeue = time.monotonic()
+                    requeued = self.job_store.requeue_stale(HEARTBEAT_TIMEOUT, MAX_JOB_ATTEMPTS)
+                    if requeued:
+                        print(f"♻️ Возвращено в очередь брошенных задач: {requeued}")
+
+                job = self.job_store.claim_job(self.worker_id)
+                if job is None:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+
+                print(f"🎬 Обработчик {self.worker_id} взял задачу {job['job_id']}")
+                QUEUE_WAIT_SECONDS.labels(queue="jobs").observe(time.time() - job["created_at"])
+                # Задача создается в контексте трассировки: ее спаны и спаны фоновой
+                # отправки в Telegram пишутся в трассировку задачи
+                with job_trace(job["job_id"]) as trace:
+                    trace.record("queue_wait", job["created_at"], time.time() - job["created_at"],
+                                 worker_id=self.worker_id, attempt=job["attempts"])
+                    self._current = asyncio.create_task(self.process_job(job))
+                try:
+                    await self._watch(job["job_id"], self._current)
+                finally:
+                    self._current = None
+        finally:
+            for task in self._background:
+                task.cancel()
+            await asyncio.gather(*self._background, return_exceptions=True)
+            self.job_store.flush()
+            await close_http_client()
+            print(f"👷 Обработчик {self.worker_id} остановлен")
+
+    async def _watch(self, job_id: str, task: asyncio.Task):
+        """Ждет задачу, отмечаясь в базе и проверяя флаг отмены"""
+        last_heartbeat = time.monotonic()
+        while not task.done():
+            await asyncio.wait({task}, timeout=CANCEL_POLL_INTERVAL)
+            if task.done():
+                break
+            if self.job_store.is_cancel_requested(job_id):
+                print(f"🛑 Задача {job_id} отменена пользователем")
+                task.cancel()
+            if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                self.job_store.heartbeat(job_id)
+        await asyncio.gather(task, return_exceptions=True)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def process_job(self, job: dict):
+        """Обработка видео для задачи из /upload"""
+        job_id = job["job_id"]
+        session_id = job["session_id"]
+        params = job["params"]
+        result_dir = Path(job["output_dir"])
+        result_dir.mkdir(parents=True, exist_ok=True)
+
+        def on_progress(progress: dict):
+            # В базу прогресс пишется пачкой фоновым потоком
+            self.job_store.update_progress(job_id, progress)
+
+        # Итог каждой копии: готова или нет, каким способом, с какой попытки
+        copy_statuses = []
+
+        try:
+            processor = VideoProcessor()
+            input_path = Path(job["input_path"])
+            with span("process_video", bytes_in=input_path.stat().st_size, copies=params["copies"]) as process_span:
+                result_files = await processor.process_video(
+                    input_path=input_path,
+                    output_dir=result_dir,
+                    copies=params["copies"],
+                    compression=params["compression"],
+                    add_frames=params["add_frames"],
+                    session_id=session_id,
+                    progress_callback=on_progress,
+                    profile_name=params.get("profile"),
+                    # Результаты уходят в Telegram: сразу укладываем их в лимит Bot API
+                    max_output_size=TELEGRAM_MAX_UPLOAD_SIZE,
+                    status_callback=copy_statuses.append
+                )
+                process_span["bytes_out"] = sum(file.stat().st_size for file in result_files)
+
+            message = f"Видео успешно обработано. Создано {len(result_files)} файлов."
+            if len(result_files) < len(copy_statuses):
+                message = f"Видео обработано частично. Создано {len(result_files)} из {len(copy_statuses)} файлов."
+            self.job_store.update_job(
+                job_id,
+                status="done",
+                message=message,
+                files=[f"/download/{result_dir.name}/{file.name}" for file in result_files],
+                copy_results=[
+                    {**status.to_dict(), "file": f"/download/{result_dir.name}/{status.path.name}"}
+                    if status.ok else status.to_dict()
+                    for status in copy_statuses
+                ],
+                worker_id=None
+            )
+
+            # Отправляем видео файлы напрямую в Telegram конкретному пользователю
+            self._spawn(send_video_files_to_telegram(
+                result_files, session_id, params["copies"], params["add_frames"], params["compression"]
+            ))
+
+        except asyncio.CancelledError:
+            # FFmpeg уже убит, незавершенные копии удалены процессором
+            with span("cleanup"):
+                shutil.rmtree(result_dir, ignore_errors=True)
+            if self._stopping and not self.job_store.is_cancel_requested(job_id):
+                # Обработчик останавливается - задачу доделает другой
+                self.job_store.release_job(job_id)
+                print(f"↩️ Задача {job_id} возвращена в очередь")
+            else:
+                self.job_store.update_job(job_id, status="cancelled", message="Обработка отменена", worker_id=None)
+                print(f"🛑 Задача {job_id} отменена")
+            raise
+
+        except Exception as e:
+            # Очищаем временные файлы в случае ошибки
+            with span("cleanup"):
+                shutil.rmtree(result_dir, ignore_errors=True)
+
+            self.job_store.update_job(
+                job_id, status="failed", message="Ошибка обработки видео", error=str(e),
+                copy_results=[status.to_dict() for status in copy_statuses], worker_id=None
+            )
+
+            # Отправляем уведомление об ошибке
+            error_message = f"""
+❌ <b>Ошибка обработки видео!</b>
+
+📁 <b>Сессия:</b> {session_id}
+🚨 <b>Ошибка:</b> {str(e)}
+
+Попробуйте еще раз или обратитесь к администратору.
+"""
+            self._spawn(send_telegram_notification(error_message))
+
+
+async def main(worker_id: str, metrics_port: int = 0):
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    worker = EncodeWorker(worker_id)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            pass
+    await worker.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обработчик задач кодирования видео")
+    parser.add_argument("--id", default=f"worker-{os.getpid()}", help="Имя обработчика в задачах")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Порт /metrics (0 - не запускать)")
+    args = parser.parse_args()
+    asyncio.run(main(args.id, args.metrics_port))